@@ -0,0 +1,774 @@
+#!/usr/bin/env python3
+"""
+Benchmark the hot SQLiteStore methods
+
+Compares the old connect-per-call behaviour (rollback journal, synchronous=FULL)
+against the pooled WAL connection manager, measures event-loop lag while the
+store takes heavy concurrent writes, and checks that keyset pagination cost stays
+flat as a thread grows (including the recent-history windows respond() loads) and
+as the number of users and threads grows. --codec compares the legacy JSON rows
+with the binary item codec, and --search times full-text search as the number
+of stored messages grows. --purge compares foreground write latency while a
+large thread is deleted inline and while it is tombstoned and purged.
+--blobs compares a thread of screenshot messages stored inline with one whose
+images were moved into the attachment blobs. --backup measures foreground
+write latency while the database is backed up, unpaced and paced.
+
+--suite seeds users, threads and items at each scale and records throughput and
+p50/p99 latency for every store operation, one call at a time and under
+concurrent load, in a JSON report; --compare checks it against an earlier one.
+
+    python3 bench_chatkit_store.py --ops 2000
+    python3 bench_chatkit_store.py --loop-lag --writers 64
+    python3 bench_chatkit_store.py --loop-lag --writers 64 --write-behind 5
+    python3 bench_chatkit_store.py --loop-lag --writers 64 --shards 8
+    python3 bench_chatkit_store.py --pagination --scales 10000,100000,1000000
+    python3 bench_chatkit_store.py --thread-listing --users 100000 --threads 10000000
+    python3 bench_chatkit_store.py --codec
+    python3 bench_chatkit_store.py --search --items 1000000
+    python3 bench_chatkit_store.py --purge --items 200000
+    python3 bench_chatkit_store.py --blobs --messages 50
+    python3 bench_chatkit_store.py --backup --items 500000
+    python3 bench_chatkit_store.py --suite --scales 10000,100000,1000000,10000000 --output before.json
+    python3 bench_chatkit_store.py --suite --scales 10000,100000,1000000 --compare before.json
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from chatkit.types import (
+    ThreadMetadata,
+    AssistantMessageItem,
+    AssistantMessageContent,
+    UserMessageItem,
+    UserMessageTextContent,
+    InferenceOptions,
+    FileAttachment,
+)
+from chatkit_backup import StoreBackup
+from chatkit_maintenance import StoreMaintenance
+from chatkit_store import SQLiteStore, SQLiteConnectionManager, SQLiteAttachmentStore, WriteBehindSQLiteStore, ShardedSQLiteStore, shard_paths, encode_item, decode_item, project_item
+
+
+CONFIGS = {
+    "connect-per-call": dict(pooled=False, journal_mode="DELETE", synchronous="FULL", cache_size_kb=2000, mmap_size=0),
+    "pooled-wal": dict(),
+}
+
+
+def make_item(thread_id: str, n: int, base: datetime) -> AssistantMessageItem:
+    """Build a synthetic assistant message"""
+    return AssistantMessageItem(
+        id=f"msg_{thread_id}_{n:08d}",
+        thread_id=thread_id,
+        created_at=base + timedelta(milliseconds=n),
+        content=[AssistantMessageContent(text=f"Critique paragraph {n}. " * 20)],
+    )
+
+
+async def timed(label: str, ops: int, fn) -> dict:
+    """Run fn(i) ops times and report throughput"""
+    start = time.perf_counter()
+    for i in range(ops):
+        await fn(i)
+    elapsed = time.perf_counter() - start
+    return {"op": label, "ops": ops, "ops_per_sec": ops / elapsed if elapsed else float("inf")}
+
+
+async def run_config(name: str, options: dict, ops: int, workdir: str) -> list[dict]:
+    """Benchmark one connection configuration against a fresh database"""
+    db_path = os.path.join(workdir, name, "chatkit.db")
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    store = SQLiteStore(db_path=db_path, connections=SQLiteConnectionManager(db_path, **options))
+    context = {"user_id": "bench"}
+    base = datetime(2025, 1, 1)
+    thread = ThreadMetadata(id="thread_bench", created_at=base)
+    await store.save_thread(thread, context)
+    
+    results = [
+        await timed("save_item", ops, lambda i: store.save_item(thread.id, make_item(thread.id, i, base), context)),
+        await timed("save_thread", ops, lambda i: store.save_thread(thread, context)),
+        await timed("load_thread", ops, lambda i: store.load_thread(thread.id, context)),
+        await timed("load_item", ops, lambda i: store.load_item(thread.id, f"msg_{thread.id}_{i:08d}", context)),
+        await timed("load_thread_items", max(ops // 10, 1), lambda i: store.load_thread_items(thread.id, context, limit=50)),
+    ]
+    store.close()
+    for result in results:
+        result["config"] = name
+    return results
+
+
+async def sample_loop_lag(stop: asyncio.Event, interval: float = 0.001) -> list[float]:
+    """Record how late each short sleep wakes up, in milliseconds"""
+    lags = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - start - interval) * 1000)
+    return lags
+
+
+def percentile(samples: list[float], pct: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * pct))]
+
+
+def summarize_lag(label: str, lags: list[float]) -> str:
+    return f"{label:<14} samples={len(lags):<6} p50={statistics.median(lags):6.2f}ms p99={percentile(lags, 0.99):6.2f}ms max={max(lags):6.2f}ms"
+
+
+async def run_loop_lag(writers: int, ops: int, workdir: str, write_behind_ms: float | None = None, shards: int = 1) -> None:
+    """Compare event-loop lag while idle and while many tasks (one chat each) write concurrently"""
+    db_path = os.path.join(workdir, "loop-lag", "chatkit.db")
+    if shards > 1:
+        store = ShardedSQLiteStore(shard_paths(os.path.dirname(db_path), shards), write_behind_ms=write_behind_ms)
+    elif write_behind_ms:
+        store = WriteBehindSQLiteStore(db_path=db_path, max_delay_ms=write_behind_ms)
+    else:
+        store = SQLiteStore(db_path=db_path)
+    context = {"user_id": "bench"}
+    base = datetime(2025, 1, 1)
+    threads = [ThreadMetadata(id=f"thread_lag_{w}", created_at=base) for w in range(writers)]
+    for thread in threads:
+        await store.save_thread(thread, context)
+    
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_loop_lag(stop))
+    await asyncio.sleep(0.5)
+    stop.set()
+    idle = await sampler
+    
+    async def writer(w: int) -> None:
+        thread_id = threads[w].id
+        for i in range(ops):
+            await store.save_item(thread_id, make_item(thread_id, i, base), context)
+    
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_loop_lag(stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(writer(w) for w in range(writers)))
+    await store.flush()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    loaded = await sampler
+    store.close()
+    
+    print(f"{writers} writers x {ops} save_item ({shards} shard(s)): {writers * ops / elapsed:.0f} writes/sec")
+    print(summarize_lag("idle", idle))
+    print(summarize_lag("under writes", loaded))
+
+
+def seed_thread_items(store: SQLiteStore, thread_id: str, count: int, base: datetime, batch: int = 50_000) -> list[str]:
+    """Bulk insert count items into one thread, bypassing save_item for speed"""
+    ids = []
+    for start in range(0, count, batch):
+        rows = []
+        for n in range(start, min(start + batch, count)):
+            item = make_item(thread_id, n, base)
+            ids.append(item.id)
+            content, content_size = encode_item(item)
+            role, text = project_item(item)
+            rows.append((item.id, thread_id, item.type, content, content_size, role, text, item.created_at.isoformat()))
+        with store.connections.write() as conn:
+            conn.executemany(
+                "INSERT INTO thread_items (id, thread_id, item_type, content, content_size, role, text, created_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+    return ids
+
+
+async def run_purge(items: int, workdir: str) -> None:
+    """Foreground save_item latency while a large thread is deleted inline, and while it is tombstoned and purged"""
+    context = {"user_id": "bench"}
+    base = datetime(2025, 1, 1)
+    for mode in ("inline delete", "tombstone + purge"):
+        db_path = os.path.join(workdir, f"purge-{mode.split()[0]}", "chatkit.db")
+        store = SQLiteStore(db_path=db_path)
+        await store.save_thread(ThreadMetadata(id="thread_big", created_at=base), context)
+        await store.save_thread(ThreadMetadata(id="thread_live", created_at=base), context)
+        seed_thread_items(store, "thread_big", items, base)
+        maintenance = StoreMaintenance(store.connections)
+        
+        done = asyncio.Event()
+        latencies: list[float] = []
+        
+        async def _foreground() -> None:
+            n = 0
+            while not done.is_set():
+                start = time.perf_counter()
+                await store.save_item("thread_live", make_item("thread_live", n, base), context)
+                latencies.append((time.perf_counter() - start) * 1000)
+                n += 1
+                await asyncio.sleep(0.002)
+        
+        writer = asyncio.create_task(_foreground())
+        await asyncio.sleep(0.2)
+        start = time.perf_counter()
+        if mode == "inline delete":
+            # What delete_thread did before tombstones: both DELETEs in the request's transaction
+            await store.connections.run_write(lambda conn: (
+                conn.execute("DELETE FROM thread_items WHERE thread_id = ?", ("thread_big",)),
+                conn.execute("DELETE FROM threads WHERE id = ?", ("thread_big",)),
+            ))
+            call_ms = removed_s = time.perf_counter() - start
+        else:
+            await store.delete_thread("thread_big", context)
+            call_ms = time.perf_counter() - start
+            await maintenance.purge_deleted_threads()
+            removed_s = time.perf_counter() - start
+        done.set()
+        await writer
+        store.close()
+        print(
+            f"{mode:<18} delete call {call_ms * 1000:9.2f}ms  rows gone after {removed_s:6.2f}s  "
+            f"foreground writes={len(latencies):<5} p50={statistics.median(latencies):6.2f}ms "
+            f"p99={percentile(latencies, 0.99):7.2f}ms max={max(latencies):7.2f}ms"
+        )
+
+
+async def run_backup(items: int, workdir: str) -> None:
+    """Foreground save_item latency with no backup running, during an unpaced backup and during a paced one"""
+    context = {"user_id": "bench"}
+    base = datetime(2025, 1, 1)
+    db_path = os.path.join(workdir, "backup", "chatkit.db")
+    store = SQLiteStore(db_path=db_path)
+    await store.save_thread(ThreadMetadata(id="thread_big", created_at=base), context)
+    await store.save_thread(ThreadMetadata(id="thread_live", created_at=base), context)
+    seed_thread_items(store, "thread_big", items, base)
+    size_mb = os.path.getsize(db_path) / 1e6
+    modes = {
+        "no backup": None,
+        "unpaced": dict(pages=-1, pause_ms=0),
+        "paced 256p/10ms": dict(pages=256, pause_ms=10),
+    }
+    n = 0
+    for mode, options in modes.items():
+        done = asyncio.Event()
+        latencies: list[float] = []
+        
+        async def _foreground() -> None:
+            nonlocal n
+            while not done.is_set():
+                start = time.perf_counter()
+                await store.save_item("thread_live", make_item("thread_live", n, base), context)
+                latencies.append((time.perf_counter() - start) * 1000)
+                n += 1
+                await asyncio.sleep(0.002)
+        
+        writer = asyncio.create_task(_foreground())
+        start = time.perf_counter()
+        if options is None:
+            await asyncio.sleep(2)
+        else:
+            await StoreBackup(db_path, os.path.join(workdir, "backups"), **options).backup()
+        elapsed = time.perf_counter() - start
+        done.set()
+        await writer
+        print(
+            f"{mode:<16} {size_mb:7.0f}MB in {elapsed:6.2f}s  foreground writes={len(latencies):<5} "
+            f"p50={statistics.median(latencies):6.2f}ms p99={percentile(latencies, 0.99):7.2f}ms max={max(latencies):7.2f}ms"
+        )
+    store.close()
+
+
+async def run_pagination(scales: list[int], reps: int, workdir: str) -> None:
+    """Time a page at the start, middle and end of ever larger threads, plus the recent-history windows"""
+    context = {"user_id": "bench"}
+    base = datetime(2025, 1, 1)
+    print(f"{'items':>10} {'first page':>12} {'middle page':>12} {'last page':>12} {'recent 50':>12} {'history 50':>12}")
+    for scale in scales:
+        db_path = os.path.join(workdir, f"pagination-{scale}", "chatkit.db")
+        store = SQLiteStore(db_path=db_path)
+        thread_id = f"thread_{scale}"
+        # A second thread of the same size so the index has to discriminate
+        seed_thread_items(store, f"other_{scale}", scale, base)
+        ids = seed_thread_items(store, thread_id, scale, base)
+        
+        timings = []
+        for cursor in (None, ids[len(ids) // 2], ids[-51] if len(ids) > 51 else ids[0]):
+            start = time.perf_counter()
+            for _ in range(reps):
+                page = await store.load_thread_items(thread_id, context, limit=50, after=cursor)
+            timings.append((time.perf_counter() - start) / reps * 1000)
+            assert page, "empty page"
+        start = time.perf_counter()
+        for _ in range(reps):
+            recent = await store.load_recent_thread_items(thread_id, context, limit=50)
+        timings.append((time.perf_counter() - start) / reps * 1000)
+        assert recent[-1].id == ids[-1], "recent window is not the thread tail"
+        start = time.perf_counter()
+        for _ in range(reps):
+            history = await store.load_conversation_history(thread_id, context, limit=50)
+        timings.append((time.perf_counter() - start) / reps * 1000)
+        assert len(history) == 50, "history window is short"
+        store.close()
+        print(f"{scale:>10} " + " ".join(f"{t:>10.3f}ms" for t in timings))
+
+
+def seed_threads(store: SQLiteStore, users: int, threads: int, base: datetime, batch: int = 100_000) -> None:
+    """Bulk insert threads spread uniformly across users"""
+    rng = random.Random(0)
+    for start in range(0, threads, batch):
+        rows = []
+        for n in range(start, min(start + batch, threads)):
+            updated_at = (base + timedelta(seconds=rng.randrange(365 * 24 * 3600))).isoformat()
+            rows.append((f"thread_{n:010d}", f"user_{rng.randrange(users)}", "{}", base.isoformat(), updated_at))
+        with store.connections.write() as conn:
+            conn.executemany(
+                "INSERT INTO threads (id, owner, metadata, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+
+
+async def run_thread_listing(users: int, threads: int, reps: int, workdir: str) -> None:
+    """Time the first and second page of load_threads for random users"""
+    db_path = os.path.join(workdir, "thread-listing", "chatkit.db")
+    store = SQLiteStore(db_path=db_path)
+    base = datetime(2025, 1, 1)
+    start = time.perf_counter()
+    seed_threads(store, users, threads, base)
+    print(f"seeded {threads} threads for {users} users in {time.perf_counter() - start:.1f}s")
+    
+    rng = random.Random(1)
+    first, second = [], []
+    for _ in range(reps):
+        context = {"user_id": f"user_{rng.randrange(users)}"}
+        start = time.perf_counter()
+        page = await store.load_threads(context, limit=20)
+        first.append((time.perf_counter() - start) * 1000)
+        if page:
+            start = time.perf_counter()
+            await store.load_threads(context, limit=20, after=page[-1].id)
+            second.append((time.perf_counter() - start) * 1000)
+    store.close()
+    
+    for label, samples in (("first page", first), ("next page", second)):
+        if samples:
+            print(f"{label:<12} p50={statistics.median(samples):6.3f}ms p99={percentile(samples, 0.99):6.3f}ms")
+
+
+SEARCH_VOCABULARY = (
+    "contrast button hero headline spacing padding color font typography layout grid mobile "
+    "navigation footer image alignment hierarchy whitespace accessibility label form input "
+    "checkout pricing testimonial banner icon shadow border gradient responsive viewport"
+).split()
+
+
+def seed_corpus(store: SQLiteStore, users: int, items: int, base: datetime, items_per_thread: int = 50, batch: int = 50_000) -> int:
+    """
+    Bulk insert critique-like messages in threads spread across users, then
+    build the search index in one pass. Returns the number of threads.
+    """
+    rng = random.Random(3)
+    # Zipf-like weights, so a few words are in most messages and most words are rare
+    weights = [1 / (rank + 1) for rank in range(len(SEARCH_VOCABULARY))]
+    threads = max(items // items_per_thread, 1)
+    with store.connections.write() as conn:
+        store._drop_search_index(conn.cursor())
+        conn.executemany(
+            "INSERT INTO threads (id, owner, metadata, created_at, updated_at) VALUES (?, ?, '{}', ?, ?)",
+            (
+                (f"thread_{n:08d}", f"user_{n % users}", base.isoformat(), (base + timedelta(seconds=rng.randrange(365 * 24 * 3600))).isoformat())
+                for n in range(threads)
+            ),
+        )
+    for start in range(0, items, batch):
+        rows = []
+        for n in range(start, min(start + batch, items)):
+            thread_id = f"thread_{n % threads:08d}"
+            words = rng.choices(SEARCH_VOCABULARY, weights, k=30)
+            # About one message in a thousand mentions a word nothing else uses
+            if rng.random() < 0.001:
+                words.append("zeppelin")
+            item = AssistantMessageItem(
+                id=f"msg_{n:09d}", thread_id=thread_id, created_at=base + timedelta(milliseconds=n),
+                content=[AssistantMessageContent(text=" ".join(words))],
+            )
+            content, content_size = encode_item(item)
+            role, text = project_item(item)
+            rows.append((item.id, thread_id, item.type, content, content_size, role, text, item.created_at.isoformat(), f"user_{n % threads % users}"))
+        with store.connections.write() as conn:
+            conn.executemany(
+                "INSERT INTO thread_items (id, thread_id, item_type, content, content_size, role, text, created_at, owner)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+    # Recreates the triggers and fills the new index from thread_items
+    store._init_db()
+    return threads
+
+
+async def run_search(users: int, items: int, reps: int, workdir: str) -> None:
+    """Time search_items for random users with common, rare, multi-word and prefix queries"""
+    db_path = os.path.join(workdir, "search", "chatkit.db")
+    store = SQLiteStore(db_path=db_path)
+    start = time.perf_counter()
+    seed_corpus(store, users, items, datetime(2025, 1, 1))
+    print(f"seeded {items} messages for {users} users in {time.perf_counter() - start:.1f}s")
+    
+    queries = {
+        "common word": "contrast",
+        "rare word": "zeppelin",
+        "two words": "hero spacing",
+        "prefix": "typo*",
+        "no match": "nonexistent",
+    }
+    rng = random.Random(4)
+    for label, query in queries.items():
+        samples = []
+        hits = 0
+        for _ in range(reps):
+            context = {"user_id": f"user_{rng.randrange(users)}"}
+            start = time.perf_counter()
+            results = await store.search_items(context, query, limit=20)
+            samples.append((time.perf_counter() - start) * 1000)
+            hits += len(results)
+        print(f"{label:<12} p50={statistics.median(samples):7.3f}ms p99={percentile(samples, 0.99):7.3f}ms avg hits={hits / reps:.1f}")
+    store.close()
+
+
+def make_codec_corpus(base: datetime) -> dict[str, object]:
+    """Representative items: critiques of several lengths and a user message with an inlined screenshot"""
+    rng = random.Random(2)
+    # PNG data is already compressed, so random bytes are a fair stand-in
+    screenshot = base64.b64encode(rng.randbytes(150_000)).decode()
+    critique = "\n".join(
+        f"{n}. Issue: The hero CTA has low contrast.\nFix:\n1. Change the button color from #9CA3AF to #6B7280.\n2. Add 16px padding."
+        for n in range(40)
+    )
+    return {
+        "long thread": AssistantMessageItem(
+            id="msg_long", thread_id="thread_codec", created_at=base,
+            content=[AssistantMessageContent(text=critique * 8)],
+        ),
+        "critique": AssistantMessageItem(
+            id="msg_critique", thread_id="thread_codec", created_at=base,
+            content=[AssistantMessageContent(text=critique)],
+        ),
+        "user+image": UserMessageItem(
+            id="msg_user", thread_id="thread_codec", created_at=base,
+            content=[UserMessageTextContent(text=f"Roast this UI data:image/png;base64,{screenshot}")],
+            inference_options=InferenceOptions(),
+        ),
+        "short": make_item("thread_codec", 0, base),
+    }
+
+
+def run_codec(reps: int) -> None:
+    """Compare row size and decode throughput of legacy JSON rows and the item codec"""
+    print(f"{'item':<12} {'json bytes':>11} {'codec bytes':>12} {'json loads/s':>13} {'codec loads/s':>14}")
+    for name, item in make_codec_corpus(datetime(2025, 1, 1)).items():
+        legacy = json.dumps(item.model_dump(mode="json"))
+        encoded, _ = encode_item(item)
+        rates = []
+        for data, load in ((legacy, lambda d: type(item)(**json.loads(d))), (encoded, decode_item)):
+            start = time.perf_counter()
+            for _ in range(reps):
+                load(data)
+            rates.append(reps / (time.perf_counter() - start))
+        print(f"{name:<12} {len(legacy.encode()):>11} {len(encoded):>12} {rates[0]:>13.0f} {rates[1]:>14.0f}")
+
+
+async def run_blobs(messages: int, reps: int, workdir: str) -> None:
+    """Compare saving and loading a thread of screenshot messages with images inline and moved into blobs"""
+    rng = random.Random(5)
+    base = datetime(2025, 1, 1)
+    items = []
+    for n in range(messages):
+        if n % 2:
+            items.append(make_item("thread_blobs", n, base))
+        else:
+            screenshot = base64.b64encode(rng.randbytes(150_000)).decode()
+            items.append(UserMessageItem(
+                id=f"msg_{n:08d}", thread_id="thread_blobs", created_at=base + timedelta(seconds=n),
+                content=[UserMessageTextContent(text=f"Roast this UI data:image/png;base64,{screenshot}")],
+                inference_options=InferenceOptions(),
+            ))
+    context = {"user_id": "user_0"}
+    # recent: the items a client loads, images included; history: what respond() sends the model
+    print(f"{'images':<8} {'save ms':>8} {'row bytes':>10} {'recent ms':>10} {'history ms':>11}")
+    for label, externalize in (("inline", False), ("blobs", True)):
+        db_path = os.path.join(workdir, f"blobs-{label}", "chatkit.db")
+        connections = SQLiteConnectionManager(db_path)
+        blob_store = SQLiteAttachmentStore(db_path, os.path.join(workdir, f"blobs-{label}", "files"), connections=connections) if externalize else None
+        store = SQLiteStore(db_path=db_path, connections=connections, blob_store=blob_store)
+        await store.save_thread(ThreadMetadata(id="thread_blobs", created_at=base), context)
+        start = time.perf_counter()
+        for item in items:
+            await store.save_item("thread_blobs", item, context)
+        save_ms = (time.perf_counter() - start) * 1000 / len(items)
+        with connections.read() as conn:
+            row_bytes = conn.execute("SELECT SUM(length(content)) FROM thread_items").fetchone()[0]
+        
+        samples = {"recent": [], "history": []}
+        for _ in range(reps):
+            start = time.perf_counter()
+            await store.load_recent_thread_items("thread_blobs", context, limit=messages)
+            samples["recent"].append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            await store.load_conversation_history("thread_blobs", context, limit=messages)
+            samples["history"].append((time.perf_counter() - start) * 1000)
+        print(
+            f"{label:<8} {save_ms:>8.2f} {row_bytes:>10} {statistics.median(samples['recent']):>10.2f} "
+            f"{statistics.median(samples['history']):>11.2f}"
+        )
+        store.close()
+
+
+SUITE_FORMAT = "chatkit-store-bench"
+SUITE_VERSION = 1
+
+
+async def measure(op: str, ops: int, concurrency: int, fn) -> dict:
+    """Run fn(i) for every i in range(ops) spread over concurrency tasks, timing each call"""
+    latencies: list[float] = []
+    
+    async def _worker(indices: range) -> None:
+        for i in indices:
+            start = time.perf_counter()
+            await fn(i)
+            latencies.append((time.perf_counter() - start) * 1000)
+    
+    start = time.perf_counter()
+    await asyncio.gather(*(_worker(range(worker, ops, concurrency)) for worker in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "op": op,
+        "concurrency": concurrency,
+        "ops": ops,
+        "seconds": round(elapsed, 4),
+        "ops_per_sec": round(ops / elapsed, 1) if elapsed else None,
+        "p50_ms": round(statistics.median(latencies), 4),
+        "p99_ms": round(percentile(latencies, 0.99), 4),
+        "max_ms": round(max(latencies), 4),
+    }
+
+
+async def run_suite_scale(items: int, ops: int, concurrency: int, workdir: str, write_behind_ms: float | None = None) -> list[dict]:
+    """Seed a store with items messages, then time each operation sequentially and with concurrency tasks"""
+    directory = os.path.join(workdir, f"suite-{items}")
+    db_path = os.path.join(directory, "chatkit.db")
+    connections = SQLiteConnectionManager(db_path)
+    if write_behind_ms is not None:
+        store = WriteBehindSQLiteStore(db_path, connections, max_delay_ms=write_behind_ms)
+    else:
+        store = SQLiteStore(db_path, connections)
+    attachments = SQLiteAttachmentStore(db_path, os.path.join(directory, "files"), connections)
+    base = datetime(2025, 1, 1)
+    # Ten threads of 50 items per user
+    users = max(items // 500, 1)
+    start = time.perf_counter()
+    threads = seed_corpus(store, users, items, base)
+    print(f"seeded {items} items in {threads} threads for {users} users in {time.perf_counter() - start:.1f}s")
+    
+    rng = random.Random(5)
+    # Each phase deletes its own threads, drawn up front so none is deleted twice
+    delete_ops = max(min(ops, threads // 4), 1)
+    doomed = rng.sample(range(threads), min(threads, delete_ops * 2))
+    payload = rng.randbytes(64 * 1024)
+    
+    def _owner(thread: int) -> dict:
+        return {"user_id": f"user_{thread % users}"}
+    
+    results = []
+    for phase, tasks in enumerate((1, concurrency)):
+        async def _save_item(i: int) -> None:
+            thread = rng.randrange(threads)
+            thread_id = f"thread_{thread:08d}"
+            await store.save_item(thread_id, make_item(thread_id, items + phase * ops + i, base), _owner(thread))
+        
+        async def _load_thread_items(i: int) -> None:
+            thread = rng.randrange(threads)
+            await store.load_thread_items(f"thread_{thread:08d}", _owner(thread), limit=50)
+        
+        async def _load_threads(i: int) -> None:
+            await store.load_threads({"user_id": f"user_{rng.randrange(users)}"}, limit=20)
+        
+        async def _delete_thread(i: int) -> None:
+            thread = doomed[(phase * delete_ops + i) % len(doomed)]
+            await store.delete_thread(f"thread_{thread:08d}", _owner(thread))
+        
+        async def _save_attachment(i: int) -> None:
+            attachment = FileAttachment(id=f"file_{phase}_{i:08d}", name="screenshot.png", mime_type="image/png")
+            # Attachment models have no content field; SQLiteAttachmentStore reads it if present.
+            # The suffix makes every upload a new blob rather than a deduplicated reference
+            object.__setattr__(attachment, "content", payload + i.to_bytes(8, "big"))
+            await attachments.save_attachment(attachment, {})
+        
+        async def _load_attachment(i: int) -> None:
+            await attachments.load_attachment(f"file_{phase}_{rng.randrange(ops):08d}", {})
+        
+        for op, count, fn in (
+            ("save_item", ops, _save_item),
+            ("load_thread_items", ops, _load_thread_items),
+            ("load_threads", ops, _load_threads),
+            ("save_attachment", ops, _save_attachment),
+            ("load_attachment", ops, _load_attachment),
+            ("delete_thread", delete_ops, _delete_thread),
+        ):
+            result = await measure(op, count, tasks, fn)
+            # Write-behind saves return before they commit, so include the flush in the timing
+            if hasattr(store, "flush") and op in ("save_item", "delete_thread"):
+                flush_start = time.perf_counter()
+                await store.flush()
+                result["seconds"] = round(result["seconds"] + time.perf_counter() - flush_start, 4)
+                result["ops_per_sec"] = round(count / result["seconds"], 1)
+            results.append({"scale": items, **result})
+    if hasattr(store, "aclose"):
+        await store.aclose()
+    store.close()
+    return results
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_suite(scales: list[int], ops: int, concurrency: int, workdir: str, write_behind_ms: float | None = None) -> dict:
+    """Run the suite at every scale and return a machine-readable report"""
+    report = {
+        "format": SUITE_FORMAT,
+        "version": SUITE_VERSION,
+        "created_at": datetime.now().isoformat(),
+        "git_commit": _git_commit(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "options": {"scales": scales, "ops": ops, "concurrency": concurrency, "write_behind_ms": write_behind_ms},
+        "results": [],
+    }
+    print(f"{'items':>10} {'operation':<18} {'tasks':>5} {'ops/sec':>10} {'p50':>10} {'p99':>10}")
+    for scale in scales:
+        for result in await run_suite_scale(scale, ops, concurrency, workdir, write_behind_ms):
+            report["results"].append(result)
+            print(
+                f"{scale:>10} {result['op']:<18} {result['concurrency']:>5} {result['ops_per_sec']:>10.0f}"
+                f" {result['p50_ms']:>8.3f}ms {result['p99_ms']:>8.3f}ms"
+            )
+    return report
+
+
+def compare_suite(baseline: dict, current: dict, threshold: float) -> int:
+    """Print each result's change against a baseline report; returns how many regressed past threshold"""
+    def _key(result: dict) -> tuple:
+        return result["scale"], result["op"], result["concurrency"]
+    
+    before = {_key(result): result for result in baseline.get("results", [])}
+    print(f"\ncompared with {baseline.get('git_commit') or 'baseline'} from {baseline.get('created_at')}:")
+    # Scales are matched per result, so only the other options have to agree
+    settings = [{**report.get("options", {}), "scales": None, "cpu_count": report.get("cpu_count")} for report in (baseline, current)]
+    if settings[0] != settings[1]:
+        print(f"note: the baseline ran with different options or hardware ({baseline.get('options')}, {baseline.get('cpu_count')} CPUs)")
+    print(f"{'items':>10} {'operation':<18} {'tasks':>5} {'ops/sec':>9} {'p99':>9}")
+    regressions = 0
+    for result in current["results"]:
+        old = before.get(_key(result))
+        if old is None or not old.get("ops_per_sec") or not old.get("p99_ms"):
+            continue
+        throughput = result["ops_per_sec"] / old["ops_per_sec"] - 1
+        p99 = result["p99_ms"] / old["p99_ms"] - 1
+        regressed = throughput < -threshold or p99 > threshold
+        regressions += regressed
+        print(
+            f"{result['scale']:>10} {result['op']:<18} {result['concurrency']:>5} {throughput:>+9.1%} {p99:>+9.1%}"
+            + ("  REGRESSION" if regressed else "")
+        )
+    return regressions
+
+
+async def main(args: argparse.Namespace) -> int:
+    workdir = tempfile.mkdtemp(prefix="chatkit_bench_")
+    try:
+        if args.suite:
+            report = await run_suite([int(s) for s in args.scales.split(",")], args.ops, args.concurrency, workdir, args.write_behind)
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"results written to {args.output}")
+            if args.compare:
+                with open(args.compare) as f:
+                    baseline = json.load(f)
+                return 1 if compare_suite(baseline, report, args.threshold) else 0
+            return 0
+        if args.loop_lag:
+            await run_loop_lag(args.writers, max(args.ops // args.writers, 1), workdir, args.write_behind, args.shards)
+            return
+        if args.codec:
+            run_codec(args.reps * 20)
+            return
+        if args.thread_listing:
+            await run_thread_listing(args.users, args.threads, args.reps, workdir)
+            return
+        if args.purge:
+            await run_purge(args.items, workdir)
+            return
+        if args.backup:
+            await run_backup(args.items, workdir)
+            return
+        if args.blobs:
+            await run_blobs(args.messages, args.reps, workdir)
+            return
+        if args.search:
+            await run_search(args.users, args.items, args.reps, workdir)
+            return
+        if args.pagination:
+            await run_pagination([int(s) for s in args.scales.split(",")], args.reps, workdir)
+            return
+        rows = []
+        for name, options in CONFIGS.items():
+            rows.extend(await run_config(name, options, args.ops, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    baseline = {r["op"]: r["ops_per_sec"] for r in rows if r["config"] == "connect-per-call"}
+    print(f"{'config':<18} {'operation':<20} {'ops/sec':>12} {'speedup':>9}")
+    for r in rows:
+        speedup = r["ops_per_sec"] / baseline[r["op"]]
+        print(f"{r['config']:<18} {r['op']:<20} {r['ops_per_sec']:>12.0f} {speedup:>8.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ops", type=int, default=2000, help="operations per measured method")
+    parser.add_argument("--loop-lag", action="store_true", help="measure event-loop lag under concurrent writes")
+    parser.add_argument("--writers", type=int, default=64, help="concurrent writer tasks for --loop-lag")
+    parser.add_argument("--write-behind", type=float, default=None, metavar="MS", help="use group commit with this delay for --loop-lag")
+    parser.add_argument("--shards", type=int, default=1, help="spread --loop-lag writers over this many database files")
+    parser.add_argument("--pagination", action="store_true", help="measure page cost as a thread grows")
+    parser.add_argument("--scales", default="10000,100000,1000000", help="comma-separated thread sizes for --pagination, item counts for --suite")
+    parser.add_argument("--thread-listing", action="store_true", help="measure per-user thread listing")
+    parser.add_argument("--users", type=int, default=1000, help="users for --thread-listing and --search")
+    parser.add_argument("--threads", type=int, default=100000, help="threads for --thread-listing")
+    parser.add_argument("--search", action="store_true", help="measure full-text search latency")
+    parser.add_argument("--items", type=int, default=1_000_000, help="messages for --search, items in the deleted thread for --purge or the backed-up database for --backup")
+    parser.add_argument("--purge", action="store_true", help="measure foreground write latency while a large thread is deleted")
+    parser.add_argument("--codec", action="store_true", help="compare stored item encodings")
+    parser.add_argument("--backup", action="store_true", help="measure foreground write latency during an online backup")
+    parser.add_argument("--blobs", action="store_true", help="compare screenshot messages stored inline and moved into blobs")
+    parser.add_argument("--messages", type=int, default=50, help="thread length for --blobs (every other message has a screenshot)")
+    parser.add_argument("--suite", action="store_true", help="time every store operation at each of --scales and write a JSON report")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent tasks for the second --suite pass")
+    parser.add_argument("--output", default="bench_results.json", help="JSON report written by --suite")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare --suite results with an earlier report; exits 1 on a regression")
+    parser.add_argument("--threshold", type=float, default=0.2, help="fractional throughput drop or p99 rise counted as a regression")
+    parser.add_argument("--reps", type=int, default=50, help="page loads averaged per measurement")
+    sys.exit(asyncio.run(main(parser.parse_args())))
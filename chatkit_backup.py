@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+"""
+Online backups of the ChatKit SQLite databases
+
+StoreBackup copies a live database with SQLite's online backup API, a few
+hundred pages per step with a pause between steps, while the server keeps
+reading and writing. The copy is made inside one read transaction, so it is
+a consistent snapshot of the moment the backup started; without it every
+write to the source would restart the copy. Each backup is written under a
+temporary name and then linked into place as <name>-<timestamp>.db (with
+microseconds, and a -<n> suffix should the name still be taken, so no backup
+ever replaces another) next to a JSON manifest recording that point in time,
+the snapshot's row counts and the file's SHA-256, and verify_backup checks a
+backup against its manifest and that it opens as a working store.
+
+    python3 chatkit_backup.py backup --db ./chatkit_data/chatkit.db --dir ./chatkit_backups
+    python3 chatkit_backup.py list --dir ./chatkit_backups
+    python3 chatkit_backup.py verify ./chatkit_backups/chatkit-20250101T120000.000000.db
+    python3 chatkit_backup.py restore --dir ./chatkit_backups --at 2025-01-01T12:30 --db ./chatkit_data/chatkit.db
+
+Restore with the server stopped. Files in ./chatkit_files are not copied:
+blobs are content-addressed and never rewritten, so copy that directory with
+any file-level tool (after the database backup, so it has every blob the
+backup refers to).
+"""
+import argparse
+import asyncio
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from chatkit_store import SQLiteStore
+
+
+logger = logging.getLogger(__name__)
+
+BACKUP_FORMAT = "chatkit-sqlite-backup"
+BACKUP_VERSION = 1
+# A .partial file untouched for this long was left by a crashed backup; younger ones may still be written
+_STALE_PARTIAL_S = 3600
+
+# Row counts recorded in the manifest and checked on verify (tables a database lacks are skipped)
+_COUNTED_TABLES = ("threads", "thread_items", "attachments", "blobs")
+
+
+def _count_rows(conn: sqlite3.Connection) -> dict[str, int]:
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    return {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in _COUNTED_TABLES if table in tables}
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_path(backup_path: str) -> str:
+    """Path of the JSON manifest written next to a backup file"""
+    return os.path.splitext(backup_path)[0] + ".json"
+
+
+def list_backups(backup_dir: str, name: str | None = None) -> list[dict]:
+    """Manifests of the backups in a directory (only those of name if given), oldest first"""
+    manifests = []
+    for path in glob.glob(os.path.join(backup_dir, "*.json")):
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Skipping unreadable backup manifest %s: %s", path, e)
+            continue
+        if manifest.get("format") != BACKUP_FORMAT or (name is not None and manifest.get("name") != name):
+            continue
+        manifest["path"] = os.path.join(backup_dir, manifest["file"])
+        manifests.append(manifest)
+    return sorted(manifests, key=lambda manifest: manifest["snapshot_at"])
+
+
+def _link_unique(source: str, path: str) -> str:
+    """
+    Hard-link source to path, or to path with a -<n> suffix if that is taken, and
+    remove source; returns the name used. Linking fails rather than replacing an
+    existing file, so two backups in the same instant keep both files.
+    """
+    base, extension = os.path.splitext(path)
+    attempt = 0
+    while True:
+        candidate = path if attempt == 0 else f"{base}-{attempt}{extension}"
+        try:
+            os.link(source, candidate)
+        except FileExistsError:
+            attempt += 1
+            continue
+        os.remove(source)
+        return candidate
+
+
+def find_backup(backup_dir: str, name: str, at: datetime | None = None) -> dict | None:
+    """The newest backup of name whose snapshot was taken at or before at (the newest overall if at is None)"""
+    candidates = [
+        manifest for manifest in list_backups(backup_dir, name)
+        if at is None or manifest["snapshot_at"] <= at.isoformat()
+    ]
+    return candidates[-1] if candidates else None
+
+
+def verify_backup(backup_path: str) -> dict:
+    """
+    Check a backup against its manifest and that it restores to a working store.
+    
+    Compares the file's SHA-256 and row counts with the manifest, runs
+    PRAGMA integrity_check, then opens a scratch copy with SQLiteStore (which
+    applies any schema upgrades) and checks its full-text index. The backup
+    itself is never modified. Returns the manifest fields plus ok and errors.
+    """
+    errors = []
+    try:
+        with open(manifest_path(backup_path)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        return {"path": backup_path, "ok": False, "errors": [f"manifest: {e}"]}
+    if manifest.get("format") != BACKUP_FORMAT or manifest.get("version", 0) > BACKUP_VERSION:
+        errors.append(f"unsupported backup format {manifest.get('format')} version {manifest.get('version')}")
+    elif _file_sha256(backup_path) != manifest["sha256"]:
+        errors.append("checksum does not match the manifest")
+    else:
+        # immutable: no locks, journal or -shm file, so the checked file stays byte-identical
+        conn = sqlite3.connect(f"file:{os.path.abspath(backup_path)}?mode=ro&immutable=1", uri=True)
+        try:
+            result = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+            if result != ["ok"]:
+                errors.append("integrity_check: " + "; ".join(result[:5]))
+            counts = _count_rows(conn)
+            if counts != manifest["counts"]:
+                errors.append(f"row counts {counts} differ from the manifest {manifest['counts']}")
+        except sqlite3.DatabaseError as e:
+            errors.append(f"database: {e}")
+        finally:
+            conn.close()
+        if not errors and "threads" in manifest["counts"]:
+            errors.extend(_check_restored_store(backup_path))
+    return {**manifest, "path": backup_path, "ok": not errors, "errors": errors}
+
+
+def _check_restored_store(backup_path: str) -> list[str]:
+    """Open a scratch copy of a thread database the way the server would and check its search index"""
+    scratch_dir = tempfile.mkdtemp(prefix="chatkit_restore_check_")
+    try:
+        scratch = os.path.join(scratch_dir, "chatkit.db")
+        shutil.copyfile(backup_path, scratch)
+        store = SQLiteStore(scratch)
+        try:
+            with store.connections.write() as conn:
+                # Raises if the index and thread_items disagree
+                conn.execute("INSERT INTO thread_items_fts (thread_items_fts, rank) VALUES ('integrity-check', 1)")
+        except sqlite3.DatabaseError as e:
+            return [f"search index: {e}"]
+        finally:
+            store.close()
+        return []
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def restore_backup(backup_path: str, db_path: str) -> dict:
+    """Verify a backup and copy it into place as db_path (server stopped)"""
+    result = verify_backup(backup_path)
+    if not result["ok"]:
+        raise ValueError(f"Backup {backup_path} failed verification: {'; '.join(result['errors'])}")
+    os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    temp_path = db_path + ".restoring"
+    shutil.copyfile(backup_path, temp_path)
+    # A WAL left by the replaced database would be replayed over the restored file
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    os.replace(temp_path, db_path)
+    return result
+
+
+class StoreBackup:
+    """
+    Paced online backups of one SQLite database into backup_dir.
+    
+    Each step copies `pages` pages and then sleeps pause_ms, all in a worker
+    thread, so the event loop never waits and writers only share the disk.
+    The read transaction that pins the snapshot keeps WAL checkpoints from
+    completing until the copy is done. The newest `keep` backups are kept.
+    """
+    
+    def __init__(
+        self,
+        db_path: str,
+        backup_dir: str,
+        name: str | None = None,
+        pages: int = 256,
+        pause_ms: float = 10.0,
+        keep: int = 24,
+        interval_s: float = 3600.0,
+    ):
+        self.db_path = db_path
+        self.backup_dir = backup_dir
+        self.name = name or os.path.splitext(os.path.basename(db_path))[0]
+        self.pages = pages
+        self.pause = pause_ms / 1000
+        self.keep = keep
+        self.interval_s = interval_s
+        self._task: asyncio.Task | None = None
+        self._lock = asyncio.Lock()
+        self.stats = {
+            "backups": 0,
+            "last_backup": None,
+            "last_snapshot_at": None,
+            "last_seconds": None,
+            "last_error": None,
+        }
+    
+    def start(self) -> None:
+        """Take a backup every interval_s in the background"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run_forever())
+    
+    async def stop(self) -> None:
+        """Cancel the background task (a copy in progress finishes in its thread and is kept)"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _run_forever(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval_s)
+            try:
+                await self.backup()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["last_error"] = str(e)
+                logger.warning("Backup of %s failed: %s", self.db_path, e)
+    
+    async def backup(self) -> dict:
+        """Take one backup and return its manifest"""
+        async with self._lock:
+            manifest = await asyncio.to_thread(self._backup)
+        self.stats["backups"] += 1
+        self.stats["last_backup"] = manifest["path"]
+        self.stats["last_snapshot_at"] = manifest["snapshot_at"]
+        self.stats["last_seconds"] = manifest["seconds"]
+        return manifest
+    
+    def _backup(self) -> dict:
+        os.makedirs(self.backup_dir, exist_ok=True)
+        # Another process (the CLI next to the server) may be writing its own .partial meanwhile
+        for stale in glob.glob(os.path.join(self.backup_dir, f".{self.name}-*.partial")):
+            try:
+                if os.path.getmtime(stale) < time.time() - _STALE_PARTIAL_S:
+                    os.remove(stale)
+            except FileNotFoundError:
+                pass
+        started = time.perf_counter()
+        source = sqlite3.connect(f"file:{os.path.abspath(self.db_path)}?mode=ro", uri=True, isolation_level=None)
+        try:
+            # The snapshot is fixed by the first read of the transaction
+            source.execute("BEGIN")
+            counts = _count_rows(source)
+            snapshot_at = datetime.now()
+            fd, partial = tempfile.mkstemp(prefix=f".{self.name}-", suffix=".db.partial", dir=self.backup_dir)
+            os.close(fd)
+            target = sqlite3.connect(partial)
+            try:
+                source.backup(target, pages=self.pages, progress=lambda status, remaining, total: time.sleep(self.pause))
+                # Backups are single files, whatever journal mode the source uses
+                target.execute("PRAGMA journal_mode=DELETE")
+            finally:
+                target.close()
+            page_count = source.execute("PRAGMA page_count").fetchone()[0]
+            page_size = source.execute("PRAGMA page_size").fetchone()[0]
+            source.execute("COMMIT")
+        finally:
+            source.close()
+        
+        # The database goes into place first, so a listed manifest always has its file
+        path = _link_unique(partial, os.path.join(self.backup_dir, f"{self.name}-{snapshot_at:%Y%m%dT%H%M%S.%f}.db"))
+        manifest = {
+            "format": BACKUP_FORMAT,
+            "version": BACKUP_VERSION,
+            "name": self.name,
+            "file": os.path.basename(path),
+            "source": os.path.abspath(self.db_path),
+            "snapshot_at": snapshot_at.isoformat(),
+            "counts": counts,
+            "pages": page_count,
+            "page_size": page_size,
+            "sha256": _file_sha256(path),
+            "seconds": round(time.perf_counter() - started, 2),
+        }
+        fd, partial = tempfile.mkstemp(prefix=f".{self.name}-", suffix=".json.partial", dir=self.backup_dir)
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=2)
+        # The database name is unique, so its manifest's is too; linking still never replaces a file
+        os.link(partial, manifest_path(path))
+        os.remove(partial)
+        self._prune()
+        return {**manifest, "path": path}
+    
+    def _prune(self) -> None:
+        """Remove all but the newest keep backups of this database (keep <= 0 keeps every backup)"""
+        if self.keep <= 0:
+            return
+        for manifest in list_backups(self.backup_dir, self.name)[:-self.keep]:
+            for path in (manifest["path"], manifest_path(manifest["path"])):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["backup", "list", "verify", "restore"])
+    parser.add_argument("backup", nargs="?", help="backup file to verify or restore (default: found with --at)")
+    parser.add_argument("--db", default="./chatkit_data/chatkit.db", help="database to back up or restore into")
+    parser.add_argument("--dir", default="./chatkit_backups", help="backup directory")
+    parser.add_argument("--name", default=None, help="backup name (default: the database file name)")
+    parser.add_argument("--at", default=None, help="restore the newest backup taken at or before this ISO time")
+    parser.add_argument("--pages", type=int, default=256, help="pages copied per step")
+    parser.add_argument("--pause-ms", type=float, default=10.0, help="pause between steps")
+    parser.add_argument("--keep", type=int, default=24, help="backups of this database to keep")
+    args = parser.parse_args()
+    name = args.name or os.path.splitext(os.path.basename(args.db))[0]
+    
+    if args.command == "backup":
+        manifest = asyncio.run(StoreBackup(args.db, args.dir, name, args.pages, args.pause_ms, args.keep).backup())
+        print(f"{manifest['path']}: snapshot at {manifest['snapshot_at']}, {manifest['pages']} pages in {manifest['seconds']}s")
+    elif args.command == "list":
+        for manifest in list_backups(args.dir, args.name):
+            counts = ", ".join(f"{table} {count}" for table, count in manifest["counts"].items())
+            print(f"{manifest['snapshot_at']}  {manifest['path']}  ({counts})")
+    else:
+        backup_path = args.backup
+        if backup_path is None:
+            manifest = find_backup(args.dir, name, datetime.fromisoformat(args.at) if args.at else None)
+            if manifest is None:
+                sys.exit(f"No backup of {name} in {args.dir}" + (f" taken at or before {args.at}" if args.at else ""))
+            backup_path = manifest["path"]
+        if args.command == "verify":
+            result = verify_backup(backup_path)
+            print(f"{backup_path}: {'ok' if result['ok'] else 'FAILED'}" + "".join(f"\n  {error}" for error in result["errors"]))
+            sys.exit(0 if result["ok"] else 1)
+        try:
+            result = restore_backup(backup_path, args.db)
+        except ValueError as e:
+            sys.exit(str(e))
+        print(f"Restored {args.db} to the snapshot taken at {result['snapshot_at']}")
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Streaming NDJSON export and import for the ChatKit SQLite store
+
+The export is one JSON object per line: a header, then every thread, then
+every item. Item JSON is copied straight out of the stored codec without
+being validated (images the store moved into blobs are put back inline, so
+the file stands alone), and both directions stream in batches, so memory use
+stays flat however many items there are. Files ending in .gz are gzip-compressed;
+"-" means stdout/stdin.
+
+    python3 chatkit_export.py export threads.ndjson.gz
+    python3 chatkit_export.py import threads.ndjson.gz --db ./chatkit_data/chatkit.db
+
+Import upserts rows in large transactions and drops the secondary indexes
+while loading, rebuilding them once at the end. Large inline images are moved
+into the attachment blobs with reference counts, the same way save_item does,
+and the references of replaced rows are released by the next maintenance
+pass. Run it with the server stopped.
+"""
+import argparse
+import gzip
+import json
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import IO, Iterator
+
+from chatkit_store import SQLiteAttachmentStore, SQLiteStore, blob_ref_digests, decode_item_json, encode_item_json, externalize_blobs, project_item, rehydrate_blobs
+
+
+EXPORT_FORMAT = "chatkit-ndjson"
+# Items whose thread has not been tombstoned by delete_thread
+LIVE_ITEMS = "thread_id NOT IN (SELECT id FROM threads WHERE deleted_at IS NOT NULL)"
+EXPORT_VERSION = 1
+
+# Rebuilt by SQLiteStore._init_db() after an import, along with the search index
+_SECONDARY_INDEXES = ("idx_threads_owner_updated", "idx_thread_items_thread_created")
+# Image bytes held before their blob references are taken, so batches of screenshots stay bounded in memory
+_PENDING_BLOB_BYTES = 64 * 1024 * 1024
+
+
+def _dumps(value: dict) -> bytes:
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+@contextmanager
+def open_stream(path: str, mode: str, compress: str | None = None) -> Iterator[IO[bytes]]:
+    """Open an export file for binary reading ("r") or writing ("w"); compress is "gzip", "none" or None to go by the .gz suffix"""
+    if compress is None:
+        compress = "gzip" if path.endswith(".gz") else "none"
+    if path == "-":
+        raw = sys.stdin.buffer if mode == "r" else sys.stdout.buffer
+        stream = gzip.GzipFile(fileobj=raw, mode=mode + "b", compresslevel=1) if compress == "gzip" else raw
+        try:
+            yield stream
+        finally:
+            if stream is not raw:
+                stream.close()
+            elif mode == "w":
+                raw.flush()
+        return
+    if compress == "gzip":
+        # Level 1: the export is usually limited by compression speed, and most bytes are text
+        stream = gzip.open(path, mode + "b", compresslevel=1)
+    else:
+        stream = open(path, mode + "b", buffering=1024 * 1024)
+    with stream:
+        yield stream
+
+
+# Keys of an item line in the order export_store writes them, with the item last
+_ITEM_KEYS = ["type", "id", "thread_id", "item_type", "created_at", "item"]
+
+
+def _item_json(line: bytes, record: dict) -> bytes:
+    """The item's JSON bytes, sliced from the line when export_store wrote it, re-serialized otherwise"""
+    # Every other value is a string or null, and quotes inside strings are escaped,
+    # so the first unescaped ,"item": is the key itself
+    start = line.find(b',"item":')
+    if start != -1 and list(record) == _ITEM_KEYS:
+        return line[start + len(b',"item":'):line.rfind(b"}")].strip()
+    return _dumps(record["item"])
+
+
+def export_store(
+    store: SQLiteStore,
+    out: IO[bytes],
+    batch_size: int = 10_000,
+    progress: bool = False,
+    blob_store: SQLiteAttachmentStore | None = None,
+) -> dict:
+    """Write every thread and item of a store to out as NDJSON, reading externalized images from blob_store"""
+    def _stored_json(content: bytes | str, blob_refs: str | None) -> bytes:
+        data = decode_item_json(content)
+        if blob_refs and blob_store is not None:
+            data = rehydrate_blobs(data, {sha256: blob_store.read_blob(sha256) for sha256 in blob_ref_digests(data)})
+        return data
+    
+    counts = {"threads": 0, "items": 0}
+    started = time.perf_counter()
+    out.write(_dumps({"type": "header", "format": EXPORT_FORMAT, "version": EXPORT_VERSION, "exported_at": datetime.now().isoformat()}) + b"\n")
+    with store.connections.read() as conn:
+        # One read transaction, so threads and items come from the same snapshot
+        conn.execute("BEGIN")
+        try:
+            # Threads deleted but not yet purged are left out, with their items
+            cursor = conn.execute("SELECT id, owner, metadata, created_at, updated_at FROM threads WHERE deleted_at IS NULL ORDER BY rowid")
+            while rows := cursor.fetchmany(batch_size):
+                out.write(b"".join(
+                    _dumps({
+                        "type": "thread",
+                        "id": thread_id,
+                        "owner": owner,
+                        "metadata": json.loads(metadata) if metadata else {},
+                        "created_at": created_at,
+                        "updated_at": updated_at,
+                    }) + b"\n"
+                    for thread_id, owner, metadata, created_at, updated_at in rows
+                ))
+                counts["threads"] += len(rows)
+            
+            cursor = conn.execute(f"SELECT id, thread_id, item_type, created_at, content, blob_refs FROM thread_items WHERE {LIVE_ITEMS} ORDER BY rowid")
+            while rows := cursor.fetchmany(batch_size):
+                # The stored JSON is spliced in as-is rather than parsed and re-serialized
+                out.write(b"".join(
+                    _dumps({"type": "item", "id": item_id, "thread_id": thread_id, "item_type": item_type, "created_at": created_at})[:-1]
+                    + b',"item":' + _stored_json(content, blob_refs) + b"}\n"
+                    for item_id, thread_id, item_type, created_at, content, blob_refs in rows
+                ))
+                counts["items"] += len(rows)
+                if progress:
+                    print(f"  {counts['items']} items exported", file=sys.stderr)
+        finally:
+            conn.execute("COMMIT")
+    counts["seconds"] = round(time.perf_counter() - started, 2)
+    return counts
+
+
+def import_store(
+    store: SQLiteStore,
+    source: IO[bytes],
+    batch_size: int = 50_000,
+    defer_indexes: bool = True,
+    progress: bool = False,
+    blob_store: SQLiteAttachmentStore | None = None,
+) -> dict:
+    """
+    Load an NDJSON export into a store, replacing rows with the same ids.
+    
+    With defer_indexes the secondary indexes and the full-text search index
+    are dropped for the load and rebuilt once at the end, which is much faster
+    than maintaining them row by row. With a blob_store (the store's own by
+    default), large image data URLs are moved into blobs as save_item does.
+    """
+    blob_store = blob_store if blob_store is not None else store.blob_store
+    counts = {"threads": 0, "items": 0, "blobs": 0}
+    started = time.perf_counter()
+    threads: list[tuple] = []
+    items: list[tuple] = []
+    pending_blobs: list[bytes] = []
+    pending_bytes = 0
+    
+    def _take_blob_references() -> None:
+        nonlocal pending_bytes
+        # Taken before the rows that use them are written; if the import fails in
+        # between, a blob is kept too long rather than removed while referenced
+        if pending_blobs:
+            blob_store.add_blob_references(pending_blobs)
+            counts["blobs"] += len(pending_blobs)
+        pending_blobs.clear()
+        pending_bytes = 0
+    
+    def _write_batch() -> None:
+        _take_blob_references()
+        with store.connections.write() as conn:
+            # Upserts, like SQLiteStore, so the search index and blob triggers see replaced rows:
+            # a replaced row's old blob_refs are queued in released_blobs for the maintenance pass
+            conn.executemany("""
+                INSERT INTO threads (id, owner, metadata, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET
+                    owner = excluded.owner,
+                    metadata = excluded.metadata,
+                    created_at = excluded.created_at,
+                    updated_at = excluded.updated_at
+            """, threads)
+            conn.executemany("""
+                INSERT INTO thread_items (id, thread_id, item_type, content, content_size, role, text, created_at, blob_refs, owner)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT owner FROM threads WHERE id = ?2))
+                ON CONFLICT(id) DO UPDATE SET
+                    thread_id = excluded.thread_id,
+                    item_type = excluded.item_type,
+                    content = excluded.content,
+                    content_size = excluded.content_size,
+                    role = excluded.role,
+                    text = excluded.text,
+                    created_at = excluded.created_at,
+                    blob_refs = excluded.blob_refs,
+                    owner = excluded.owner
+            """, items)
+        counts["threads"] += len(threads)
+        counts["items"] += len(items)
+        threads.clear()
+        items.clear()
+        if progress:
+            print(f"  {counts['threads']} threads, {counts['items']} items imported", file=sys.stderr)
+    
+    if defer_indexes:
+        with store.connections.write() as conn:
+            for index in _SECONDARY_INDEXES:
+                conn.execute(f"DROP INDEX IF EXISTS {index}")
+            store._drop_search_index(conn.cursor())
+    try:
+        for line_number, line in enumerate(source, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            kind = record.get("type")
+            if kind == "item":
+                item = record["item"]
+                data = _item_json(line, record)
+                blob_refs = None
+                if blob_store is not None:
+                    data, blobs = externalize_blobs(data, store.inline_blob_min_bytes)
+                    if blobs:
+                        # Projected from the stored JSON, so the text and search index hold references, not base64
+                        item = json.loads(data)
+                        blob_refs = " ".join(blobs)
+                        pending_blobs.extend(blobs.values())
+                        pending_bytes += sum(len(payload) for payload in blobs.values())
+                content, content_size = encode_item_json(data)
+                role, text = project_item(item)
+                items.append((
+                    record["id"],
+                    record["thread_id"],
+                    record.get("item_type") or item.get("type"),
+                    content,
+                    content_size,
+                    role,
+                    text,
+                    record.get("created_at"),
+                    blob_refs,
+                ))
+            elif kind == "thread":
+                threads.append((
+                    record["id"],
+                    record.get("owner"),
+                    json.dumps(record.get("metadata") or {}),
+                    record.get("created_at"),
+                    record.get("updated_at") or record.get("created_at"),
+                ))
+            elif kind == "header":
+                if record.get("format") != EXPORT_FORMAT or record.get("version", 0) > EXPORT_VERSION:
+                    raise ValueError(f"Unsupported export format {record.get('format')} version {record.get('version')}")
+            else:
+                raise ValueError(f"Line {line_number}: unknown record type {kind!r}")
+            if len(threads) + len(items) >= batch_size:
+                _write_batch()
+            elif pending_bytes >= _PENDING_BLOB_BYTES:
+                _take_blob_references()
+        _write_batch()
+    finally:
+        if defer_indexes:
+            # _init_db creates any missing index and refills a new search index,
+            # so this also restores them after a failed load
+            store._init_db()
+    counts["seconds"] = round(time.perf_counter() - started, 2)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("path", help="NDJSON file to write or read (.gz for gzip, - for stdout/stdin)")
+    parser.add_argument("--db", default="./chatkit_data/chatkit.db", help="SQLite database to export from or import into")
+    parser.add_argument("--files", default="./chatkit_files", help="attachment directory holding the images items reference (export) or receiving them (import)")
+    parser.add_argument("--compress", choices=["gzip", "none"], default=None, help="override compression (default: by .gz suffix)")
+    parser.add_argument("--batch-size", type=int, default=None, help="rows per read batch (export) or transaction (import)")
+    parser.add_argument("--keep-indexes", action="store_true", help="maintain indexes during import instead of rebuilding them at the end")
+    parser.add_argument("--progress", action="store_true", help="report progress on stderr")
+    args = parser.parse_args()
+    
+    store = SQLiteStore(args.db)
+    try:
+        blob_store = SQLiteAttachmentStore(args.db, args.files, connections=store.connections)
+        if args.command == "export":
+            with open_stream(args.path, "w", args.compress) as out:
+                counts = export_store(store, out, args.batch_size or 10_000, args.progress, blob_store)
+        else:
+            with open_stream(args.path, "r", args.compress) as source:
+                counts = import_store(store, source, args.batch_size or 50_000, not args.keep_indexes, args.progress, blob_store)
+    finally:
+        store.close()
+    print(f"{args.command}: {counts['threads']} threads, {counts['items']} items in {counts['seconds']}s", file=sys.stderr)
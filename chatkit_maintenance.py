@@ -0,0 +1,395 @@
+"""
+Background maintenance for the ChatKit SQLite database and attachment files
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+from typing import Callable
+
+from chatkit_store import SQLiteConnectionManager, SQLiteAttachmentStore, item_attachment_ids
+
+
+logger = logging.getLogger(__name__)
+
+
+class StoreMaintenance:
+    """
+    Time-sliced background maintenance for chatkit.db and chatkit_files.
+    
+    Each pass expires threads and attachments past their TTL, sweeps blob and
+    temp files nothing references, reclaims free pages with incremental_vacuum
+    and refreshes planner statistics. Threads tombstoned by delete_thread are
+    purged, with the attachments their messages reference, every
+    purge_interval_s, and the blobs of deleted or replaced items are released
+    after each purge. All work is split into small write transactions whose
+    size adapts so each one stays under step_ms, with a pause between them, so
+    foreground writes never wait long on maintenance.
+    
+    Shard databases pass manage_attachments=False: they release the
+    attachments of the threads they delete, but expiry and file sweeps run
+    once, on the database that owns the attachments table.
+    
+    Expired threads are tombstoned like delete_thread does, and
+    on_threads_expired is called with their ids so a cache in front of the
+    store can drop them; the purge then removes their rows.
+    """
+    
+    def __init__(
+        self,
+        connections: SQLiteConnectionManager,
+        attachment_store: SQLiteAttachmentStore | None = None,
+        thread_ttl_days: float | None = None,
+        attachment_ttl_days: float | None = None,
+        interval_s: float = 300.0,
+        step_ms: float = 5.0,
+        pause_ms: float = 20.0,
+        orphan_grace_s: float = 3600.0,
+        vacuum_pages: int = 128,
+        purge_interval_s: float = 5.0,
+        manage_attachments: bool = True,
+        on_threads_expired: Callable[[list[str]], None] | None = None,
+    ):
+        self.connections = connections
+        self.attachment_store = attachment_store
+        self.thread_ttl_days = thread_ttl_days
+        self.attachment_ttl_days = attachment_ttl_days
+        self.interval_s = interval_s
+        self.step_ms = step_ms
+        self.pause = pause_ms / 1000
+        # Files younger than this may belong to an upload that is still being committed
+        self.orphan_grace_s = orphan_grace_s
+        self.vacuum_pages = vacuum_pages
+        self.purge_interval_s = purge_interval_s
+        self.manage_attachments = manage_attachments
+        self.on_threads_expired = on_threads_expired
+        self.batch_size = 100
+        self._task: asyncio.Task | None = None
+        self._purge_task: asyncio.Task | None = None
+        # The pass and the purge loop may both reach a tombstoned thread
+        self._purge_lock = asyncio.Lock()
+        self.stats = {
+            "passes": 0,
+            "threads_expired": 0,
+            "threads_purged": 0,
+            "items_deleted": 0,
+            "attachments_released": 0,
+            "blobs_released": 0,
+            "attachments_expired": 0,
+            "orphan_files_removed": 0,
+            "pages_vacuumed": 0,
+            "last_pass_at": None,
+            "last_error": None,
+        }
+    
+    def start(self) -> None:
+        """Run maintenance passes every interval_s and tombstone purges every purge_interval_s in the background"""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._run_forever(self.run_once, self.interval_s))
+        if self._purge_task is None or self._purge_task.done():
+            self._purge_task = loop.create_task(self._run_forever(self.purge_deleted_threads, self.purge_interval_s))
+    
+    async def stop(self) -> None:
+        """Cancel the background tasks"""
+        for task in (self._task, self._purge_task):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._purge_task = None
+    
+    async def _run_forever(self, step, interval_s: float) -> None:
+        while True:
+            try:
+                await step()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["last_error"] = str(e)
+                logger.warning("Store maintenance failed: %s", e)
+            await asyncio.sleep(interval_s)
+    
+    async def run_once(self) -> None:
+        """Run one full maintenance pass"""
+        await self.purge_deleted_threads()
+        if self.thread_ttl_days is not None:
+            await self.expire_threads(datetime.now() - timedelta(days=self.thread_ttl_days))
+        if self.manage_attachments and self.attachment_ttl_days is not None and self.attachment_store is not None:
+            await self.expire_attachments(datetime.now() - timedelta(days=self.attachment_ttl_days))
+        if self.manage_attachments and self.attachment_store is not None:
+            await self.sweep_orphan_files()
+        await self.incremental_vacuum()
+        await self.optimize()
+        self.stats["passes"] += 1
+        self.stats["last_pass_at"] = datetime.now().isoformat()
+    
+    async def _write_step(self, fn) -> int:
+        """
+        Run one bounded write transaction and pause.
+        
+        fn(conn, batch_size) returns how many rows it touched. The batch size is
+        halved when a step overruns step_ms and grown when it finishes well under.
+        """
+        start = time.perf_counter()
+        touched = await self.connections.run_write(lambda conn: fn(conn, self.batch_size))
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if elapsed_ms > self.step_ms:
+            self.batch_size = max(1, self.batch_size // 2)
+        elif elapsed_ms < self.step_ms / 2:
+            self.batch_size = min(10_000, self.batch_size * 2)
+        await asyncio.sleep(self.pause)
+        return touched
+    
+    async def delete_thread_chunked(self, thread_id: str) -> int:
+        """
+        Delete a thread's items in small transactions, then the thread itself.
+        
+        Attachments referenced by the deleted messages are queued in
+        released_attachments by the same transactions and released afterwards,
+        one at a time, which also removes blob files nothing else uses.
+        """
+        
+        def _delete_items(conn: sqlite3.Connection, batch: int) -> int:
+            rows = conn.execute(
+                "SELECT rowid, item_type, content FROM thread_items WHERE thread_id = ? LIMIT ?", (thread_id, batch)
+            ).fetchall()
+            attachment_ids: list[str] = []
+            for _, item_type, content in rows:
+                if item_type == "user_message":
+                    try:
+                        attachment_ids.extend(item_attachment_ids(content))
+                    except Exception as e:
+                        logger.warning("Could not read attachments of an item in thread %s: %s", thread_id, e)
+            if self.attachment_store is not None:
+                conn.executemany("INSERT INTO released_attachments (attachment_id) VALUES (?)", [(id,) for id in attachment_ids])
+            conn.executemany("DELETE FROM thread_items WHERE rowid = ?", [(row[0],) for row in rows])
+            return len(rows)
+        
+        deleted = 0
+        while touched := await self._write_step(_delete_items):
+            deleted += touched
+        # An item saved into the thread after the last batch keeps it tombstoned for the next purge
+        await self._write_step(lambda conn, batch: conn.execute("""
+            DELETE FROM threads WHERE id = ? AND NOT EXISTS (SELECT 1 FROM thread_items WHERE thread_id = ?)
+        """, (thread_id, thread_id)).rowcount)
+        self.stats["items_deleted"] += deleted
+        await self.release_attachments()
+        return deleted
+    
+    async def release_attachments(self) -> int:
+        """Release the attachments of purged messages, as queued in released_attachments"""
+        if self.attachment_store is None or not await self._has_table("released_attachments"):
+            return 0
+        released = 0
+        while True:
+            rows = await self.connections.run_read(lambda conn: conn.execute(
+                "SELECT id, attachment_id FROM released_attachments ORDER BY id LIMIT 100"
+            ).fetchall())
+            if not rows:
+                break
+            # Released before they are dequeued: deleting an attachment twice after a crash is a no-op
+            for attachment_id in dict.fromkeys(attachment_id for _, attachment_id in rows):
+                await self.attachment_store.delete_attachment(attachment_id, {})
+                released += 1
+                await asyncio.sleep(self.pause)
+            await self._write_step(lambda conn, batch: conn.executemany(
+                "DELETE FROM released_attachments WHERE id = ?", [(row[0],) for row in rows]
+            ).rowcount)
+        self.stats["attachments_released"] += released
+        return released
+    
+    async def _has_table(self, table: str) -> bool:
+        # With shards, chatkit.db only holds attachments
+        return await self.connections.run_read(lambda conn: conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone() is not None)
+    
+    async def purge_deleted_threads(self) -> int:
+        """Physically delete threads tombstoned by delete_thread, oldest first"""
+        purged = 0
+        if not await self._has_table("threads"):
+            return purged
+        async with self._purge_lock:
+            while True:
+                rows = await self.connections.run_read(lambda conn: conn.execute(
+                    "SELECT id FROM threads WHERE deleted_at IS NOT NULL ORDER BY deleted_at LIMIT 100"
+                ).fetchall())
+                for (thread_id,) in rows:
+                    await self.delete_thread_chunked(thread_id)
+                    purged += 1
+                if len(rows) < 100:
+                    break
+        self.stats["threads_purged"] += purged
+        # Also picks up what a purge interrupted before it could release
+        await self.release_attachments()
+        await self.release_item_blobs()
+        return purged
+    
+    async def release_item_blobs(self) -> int:
+        """Release the blobs of item rows that were deleted or replaced, as queued in released_blobs"""
+        if self.attachment_store is None or not await self._has_table("released_blobs"):
+            return 0
+        released = 0
+        while True:
+            digests: list[str] = []
+            
+            def _take(conn: sqlite3.Connection, batch: int) -> int:
+                rows = conn.execute("SELECT id, blob_refs FROM released_blobs ORDER BY id LIMIT ?", (batch,)).fetchall()
+                for _, blob_refs in rows:
+                    digests.extend(blob_refs.split())
+                conn.executemany("DELETE FROM released_blobs WHERE id = ?", [(row[0],) for row in rows])
+                return len(rows)
+            
+            # Dequeued before releasing: a crash in between keeps a blob too long rather
+            # than releasing it twice (the blobs may live in another database)
+            if not await self._write_step(_take):
+                break
+            await self.attachment_store.release_blobs(digests)
+            released += len(digests)
+        self.stats["blobs_released"] += released
+        return released
+    
+    async def expire_threads(self, cutoff: datetime) -> int:
+        """Tombstone threads not updated since cutoff; purge_deleted_threads removes them"""
+        expired = 0
+        if not await self._has_table("threads"):
+            return expired
+        last_rowid = 0
+        cutoff_iso = cutoff.isoformat()
+        while True:
+            # Walk the table in rowid windows so each read is bounded too
+            rows = await self.connections.run_read(lambda conn: conn.execute("""
+                SELECT rowid, id, updated_at FROM threads WHERE rowid > ? AND deleted_at IS NULL ORDER BY rowid LIMIT 1000
+            """, (last_rowid,)).fetchall())
+            if not rows:
+                break
+            last_rowid = rows[-1][0]
+            pending = [thread_id for _, thread_id, updated_at in rows if updated_at and updated_at < cutoff_iso]
+            tombstoned: list[str] = []
+            
+            def _tombstone(conn: sqlite3.Connection, batch: int) -> int:
+                chunk = pending[:batch]
+                del pending[:batch]
+                now = datetime.now().isoformat()
+                for thread_id in chunk:
+                    # Checked again under the writer lock: the thread may have been updated since it was read
+                    if conn.execute(
+                        "UPDATE threads SET deleted_at = ? WHERE id = ? AND deleted_at IS NULL AND updated_at < ?",
+                        (now, thread_id, cutoff_iso),
+                    ).rowcount:
+                        tombstoned.append(thread_id)
+                return len(chunk)
+            
+            while pending:
+                await self._write_step(_tombstone)
+            if tombstoned and self.on_threads_expired is not None:
+                self.on_threads_expired(tombstoned)
+            expired += len(tombstoned)
+            await asyncio.sleep(self.pause)
+        self.stats["threads_expired"] += expired
+        return expired
+    
+    async def expire_attachments(self, cutoff: datetime) -> int:
+        """Delete attachments created before cutoff, releasing their blobs"""
+        expired = 0
+        while True:
+            rows = await self.connections.run_read(lambda conn: conn.execute(
+                "SELECT id FROM attachments WHERE created_at < ? LIMIT ?", (cutoff.isoformat(), self.batch_size)
+            ).fetchall())
+            if not rows:
+                break
+            for (attachment_id,) in rows:
+                await self.attachment_store.delete_attachment(attachment_id, {})
+                expired += 1
+            await asyncio.sleep(self.pause)
+        self.stats["attachments_expired"] += expired
+        return expired
+    
+    async def sweep_orphan_files(self) -> int:
+        """Remove files no attachment references and temp files left by failed uploads"""
+        store = self.attachment_store
+        now = time.time()
+        removed = 0
+        
+        def _list_old_files(directory: str, recursive: bool = True) -> list[str]:
+            paths = []
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        if now - os.stat(path).st_mtime > self.orphan_grace_s:
+                            paths.append(path)
+                    except FileNotFoundError:
+                        pass
+                if not recursive:
+                    break
+            return paths
+        
+        for path in await asyncio.to_thread(_list_old_files, store.tmp_path):
+            await asyncio.to_thread(os.remove, path)
+            removed += 1
+        
+        # Blob files are keyed by digest; files saved before content addressing
+        # sit directly in base_path and are referenced by attachments.file_path
+        sweeps = [
+            (await asyncio.to_thread(_list_old_files, store.blob_path), "SELECT sha256 FROM blobs WHERE sha256 IN ({})", os.path.basename),
+            (await asyncio.to_thread(_list_old_files, store.base_path, False), "SELECT file_path FROM attachments WHERE file_path IN ({})", lambda path: path),
+        ]
+        for candidates, query, key_of in sweeps:
+            for start in range(0, len(candidates), 500):
+                removed += await self._write_step(self._remove_unreferenced(candidates[start:start + 500], query, key_of))
+        self.stats["orphan_files_removed"] += removed
+        return removed
+    
+    @staticmethod
+    def _remove_unreferenced(paths: list[str], query: str, key_of):
+        """Build a write step that deletes the paths whose key the query does not find"""
+        keys = [key_of(path) for path in paths]
+        
+        def _remove(conn: sqlite3.Connection, batch: int) -> int:
+            # Checked and removed under the writer lock, like every other blob change
+            known = {row[0] for row in conn.execute(query.format(",".join("?" * len(keys))), keys)}
+            count = 0
+            for path, key in zip(paths, keys):
+                if key not in known:
+                    try:
+                        os.remove(path)
+                        count += 1
+                    except FileNotFoundError:
+                        pass
+            return count
+        return _remove
+    
+    async def incremental_vacuum(self) -> int:
+        """Return free pages to the filesystem a few at a time"""
+        freed = 0
+        while True:
+            free_pages = await self.connections.run_read(lambda conn: conn.execute("PRAGMA freelist_count").fetchone()[0])
+            auto_vacuum = await self.connections.run_read(lambda conn: conn.execute("PRAGMA auto_vacuum").fetchone()[0])
+            if not free_pages or auto_vacuum != 2:
+                break
+            pages = min(free_pages, self.vacuum_pages)
+            
+            def _vacuum(conn: sqlite3.Connection, batch: int) -> int:
+                # incremental_vacuum frees one page per step and sqlite3 only steps a
+                # row-less pragma once, so it is issued once per page
+                for _ in range(pages):
+                    conn.execute("PRAGMA incremental_vacuum(1)")
+                return pages
+            freed += await self._write_step(_vacuum)
+        self.stats["pages_vacuumed"] += freed
+        return freed
+    
+    async def optimize(self) -> None:
+        """Refresh planner statistics with a bounded ANALYZE"""
+        def _optimize(conn: sqlite3.Connection, batch: int) -> int:
+            # analysis_limit caps the rows ANALYZE samples per index
+            conn.execute("PRAGMA analysis_limit=400")
+            conn.execute("PRAGMA optimize")
+            return 0
+        await self._write_step(_optimize)
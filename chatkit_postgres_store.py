@@ -0,0 +1,561 @@
+"""
+Postgres Store implementation for ChatKit, for running several server nodes on one database
+"""
+import asyncio
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+import asyncpg
+from chatkit.store import Store, AttachmentStore, StoreItemType
+from chatkit.types import ThreadMetadata, ThreadItem, Attachment
+
+from chatkit_store import SEARCH_CANDIDATES, _attachment_adapter, encode_item, decode_item, project_item, history_message, search_terms, stream_to_temp
+
+
+def _timestamp(value: datetime | None) -> datetime | None:
+    """Store timestamps as naive UTC-or-local values, the way SQLiteStore's ISO strings round-trip"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class PostgresConnectionManager:
+    """
+    Lazily created asyncpg connection pool shared by the Postgres stores.
+    
+    The pool needs a running event loop, so it is opened on first use rather
+    than at import time. Set statement_cache_size=0 when connecting through a
+    transaction-mode pooler such as PgBouncer or the Supabase pooler.
+    """
+    
+    def __init__(self, dsn: str, min_size: int = 2, max_size: int = 10, statement_cache_size: int = 100):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.statement_cache_size = statement_cache_size
+        self._pool: asyncpg.Pool | None = None
+        self._lock: asyncio.Lock | None = None
+    
+    async def pool(self) -> asyncpg.Pool:
+        """The shared pool, opened on first call"""
+        if self._pool is None:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                if self._pool is None:
+                    self._pool = await asyncpg.create_pool(
+                        self.dsn,
+                        min_size=self.min_size,
+                        max_size=self.max_size,
+                        statement_cache_size=self.statement_cache_size,
+                    )
+        return self._pool
+    
+    async def close(self) -> None:
+        """Close every pooled connection"""
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+
+class _PostgresSchema:
+    """Creates a store's tables once per process, on first use"""
+    
+    SCHEMA: str = ""
+    
+    def __init__(self, connections: PostgresConnectionManager):
+        self.connections = connections
+        self._schema_ready = False
+        self._schema_lock: asyncio.Lock | None = None
+    
+    async def _pool(self) -> asyncpg.Pool:
+        pool = await self.connections.pool()
+        if not self._schema_ready:
+            if self._schema_lock is None:
+                self._schema_lock = asyncio.Lock()
+            async with self._schema_lock:
+                if not self._schema_ready:
+                    async with pool.acquire() as conn:
+                        # Serialize DDL across nodes starting at the same time
+                        async with conn.transaction():
+                            await conn.execute("SELECT pg_advisory_xact_lock(hashtext('chatkit_schema'))")
+                            await conn.execute(self.SCHEMA)
+                    self._schema_ready = True
+        return pool
+
+
+class PostgresStore(_PostgresSchema, Store[dict]):
+    """
+    Postgres-based Store implementation for ChatKit
+    
+    Same semantics as SQLiteStore: threads are owned by the creating user,
+    listed newest first with a keyset cursor, and items are stored with the
+    binary item codec plus the role/text projection used for history.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chatkit_threads (
+            id TEXT PRIMARY KEY,
+            owner TEXT,
+            metadata JSONB NOT NULL DEFAULT '{}',
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP
+        );
+        -- Per-user thread listing, newest first, with a keyset cursor
+        CREATE INDEX IF NOT EXISTS idx_chatkit_threads_owner_updated
+            ON chatkit_threads (owner, updated_at DESC NULLS LAST, id DESC);
+        
+        CREATE TABLE IF NOT EXISTS chatkit_thread_items (
+            id TEXT PRIMARY KEY,
+            thread_id TEXT NOT NULL,
+            item_type TEXT,
+            content BYTEA NOT NULL,
+            content_size INTEGER,
+            role TEXT,
+            text TEXT,
+            created_at TIMESTAMP
+        );
+        -- Covers per-thread scans in created_at order and the keyset cursor
+        CREATE INDEX IF NOT EXISTS idx_chatkit_thread_items_thread_created
+            ON chatkit_thread_items (thread_id, created_at, id);
+        -- Full-text search over the text projection (search_items)
+        CREATE INDEX IF NOT EXISTS idx_chatkit_thread_items_search
+            ON chatkit_thread_items USING GIN (to_tsvector('english', COALESCE(text, '')));
+    """
+    
+    async def generate_thread_id(self, context: dict) -> str:
+        """Generate a new thread ID"""
+        import uuid
+        return f"thread_{uuid.uuid4().hex[:16]}"
+    
+    def generate_item_id(self, item_type: StoreItemType, thread: ThreadMetadata, context: dict) -> str:
+        """Generate a new item ID"""
+        import uuid
+        prefix = item_type.value if hasattr(item_type, 'value') else str(item_type)
+        return f"{prefix}_{uuid.uuid4().hex[:16]}"
+    
+    async def flush(self) -> None:
+        """Wait for pending writes to be committed (writes are synchronous here)"""
+    
+    async def aclose(self) -> None:
+        """Close the connection pool"""
+        await self.connections.close()
+    
+    @staticmethod
+    def _thread_from_row(row: asyncpg.Record) -> ThreadMetadata:
+        return ThreadMetadata(
+            id=row["id"],
+            metadata=json.loads(row["metadata"]) if row["metadata"] else {},
+            created_at=row["created_at"],
+            updated_at=row["updated_at"]
+        )
+    
+    async def save_thread(self, thread: ThreadMetadata, context: dict) -> None:
+        """Save thread metadata"""
+        created_at = _timestamp(thread.created_at) if hasattr(thread, 'created_at') else None
+        updated_at = _timestamp(thread.updated_at) if hasattr(thread, 'updated_at') else None
+        pool = await self._pool()
+        # The owner is fixed by whoever created the thread
+        await pool.execute("""
+            INSERT INTO chatkit_threads (id, owner, metadata, created_at, updated_at)
+            VALUES ($1, $2, $3::jsonb, $4, $5)
+            ON CONFLICT (id) DO UPDATE SET
+                owner = COALESCE(chatkit_threads.owner, EXCLUDED.owner),
+                metadata = EXCLUDED.metadata,
+                created_at = EXCLUDED.created_at,
+                updated_at = EXCLUDED.updated_at
+        """, thread.id, context.get("user_id"), json.dumps(thread.metadata or {}), created_at, updated_at or created_at)
+    
+    async def load_thread(self, thread_id: str, context: dict) -> ThreadMetadata:
+        """Load thread metadata"""
+        pool = await self._pool()
+        row = await pool.fetchrow("SELECT id, metadata, created_at, updated_at FROM chatkit_threads WHERE id = $1", thread_id)
+        
+        if not row:
+            raise ValueError(f"Thread {thread_id} not found")
+        
+        return self._thread_from_row(row)
+    
+    async def load_threads(self, context: dict, limit: int = 100, after: str | None = None) -> list[ThreadMetadata]:
+        """Load the current user's threads, most recently updated first"""
+        owner = context.get("user_id")
+        # IS NOT DISTINCT FROM cannot use the index, so anonymous threads get their own predicate
+        owner_filter = "owner = $1" if owner is not None else "owner IS NULL AND $1::text IS NULL"
+        pool = await self._pool()
+        if after:
+            # Keyset cursor: seek past the (updated_at, id) position of the `after` thread
+            rows = await pool.fetch(f"""
+                SELECT id, metadata, created_at, updated_at FROM chatkit_threads
+                WHERE {owner_filter}
+                  AND (updated_at, id) < (SELECT updated_at, id FROM chatkit_threads WHERE id = $2 AND {owner_filter})
+                ORDER BY updated_at DESC NULLS LAST, id DESC LIMIT $3
+            """, owner, after, limit)
+        else:
+            rows = await pool.fetch(f"""
+                SELECT id, metadata, created_at, updated_at FROM chatkit_threads
+                WHERE {owner_filter}
+                ORDER BY updated_at DESC NULLS LAST, id DESC LIMIT $2
+            """, owner, limit)
+        return [self._thread_from_row(row) for row in rows]
+    
+    async def delete_thread(self, thread_id: str, context: dict) -> None:
+        """Delete a thread"""
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("DELETE FROM chatkit_thread_items WHERE thread_id = $1", thread_id)
+                await conn.execute("DELETE FROM chatkit_threads WHERE id = $1", thread_id)
+    
+    async def save_item(self, thread_id: str, item: ThreadItem, context: dict) -> None:
+        """Save a thread item"""
+        content, content_size = encode_item(item)
+        role, text = project_item(item)
+        created_at = _timestamp(item.created_at) if hasattr(item, 'created_at') else None
+        pool = await self._pool()
+        await pool.execute("""
+            INSERT INTO chatkit_thread_items (id, thread_id, item_type, content, content_size, role, text, created_at)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+            ON CONFLICT (id) DO UPDATE SET
+                thread_id = EXCLUDED.thread_id,
+                item_type = EXCLUDED.item_type,
+                content = EXCLUDED.content,
+                content_size = EXCLUDED.content_size,
+                role = EXCLUDED.role,
+                text = EXCLUDED.text,
+                created_at = EXCLUDED.created_at
+        """, item.id, thread_id, item.type, content, content_size, role, text, created_at)
+    
+    async def add_thread_item(self, thread_id: str, item: ThreadItem, context: dict) -> None:
+        """Add a new thread item"""
+        await self.save_item(thread_id, item, context)
+    
+    async def load_item(self, thread_id: str, item_id: str, context: dict) -> ThreadItem:
+        """Load a thread item"""
+        pool = await self._pool()
+        content = await pool.fetchval("SELECT content FROM chatkit_thread_items WHERE id = $1 AND thread_id = $2", item_id, thread_id)
+        
+        if content is None:
+            raise ValueError(f"Item {item_id} not found in thread {thread_id}")
+        
+        return decode_item(content)
+    
+    async def load_thread_items(self, thread_id: str, context: dict, limit: int = 100, after: str | None = None) -> list[ThreadItem]:
+        """Load thread items"""
+        pool = await self._pool()
+        if after:
+            # Keyset cursor: seek past the (created_at, id) position of the `after` item
+            rows = await pool.fetch("""
+                SELECT content FROM chatkit_thread_items
+                WHERE thread_id = $1
+                  AND (created_at, id) > (SELECT created_at, id FROM chatkit_thread_items WHERE id = $2 AND thread_id = $1)
+                ORDER BY created_at ASC, id ASC LIMIT $3
+            """, thread_id, after, limit)
+        else:
+            rows = await pool.fetch("""
+                SELECT content FROM chatkit_thread_items
+                WHERE thread_id = $1
+                ORDER BY created_at ASC, id ASC LIMIT $2
+            """, thread_id, limit)
+        return [decode_item(row["content"]) for row in rows]
+    
+    async def _recent_rows(self, columns: str, where: str, thread_id: str, limit: int, max_bytes: int | None, size: str) -> list[asyncpg.Record]:
+        """
+        The newest rows of a thread, newest first, within limit and the byte budget.
+        
+        The running size is summed in the database so rows past the budget are
+        never sent; the newest row is always included.
+        """
+        pool = await self._pool()
+        return await pool.fetch(f"""
+            SELECT {columns} FROM (
+                SELECT {columns},
+                       SUM({size}) OVER newest AS running_size,
+                       ROW_NUMBER() OVER newest AS position
+                FROM chatkit_thread_items
+                WHERE thread_id = $1{where}
+                WINDOW newest AS (ORDER BY created_at DESC, id DESC ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW)
+                ORDER BY created_at DESC, id DESC LIMIT $2
+            ) recent
+            WHERE position = 1 OR $3::bigint IS NULL OR running_size <= $3::bigint
+            ORDER BY position
+        """, thread_id, limit, max_bytes)
+    
+    async def load_recent_thread_items(self, thread_id: str, context: dict, limit: int = 50, max_bytes: int | None = None) -> list[ThreadItem]:
+        """Load the most recent items of a thread, oldest first (see SQLiteStore.load_recent_thread_items)"""
+        rows = await self._recent_rows("content", "", thread_id, limit, max_bytes, "COALESCE(content_size, length(content))")
+        return [decode_item(row["content"]) for row in reversed(rows)]
+    
+    async def load_conversation_history(self, thread_id: str, context: dict, limit: int = 50, max_bytes: int | None = None) -> list[dict]:
+        """Load model-ready history for the most recent messages of a thread, oldest first"""
+        rows = await self._recent_rows("role, text", " AND role IS NOT NULL", thread_id, limit, max_bytes, "length(text)")
+        return [history_message(row["role"], row["text"]) for row in reversed(rows)]
+    
+    async def delete_thread_item(self, thread_id: str, item_id: str, context: dict) -> None:
+        """Delete a thread item"""
+        pool = await self._pool()
+        await pool.execute("DELETE FROM chatkit_thread_items WHERE id = $1 AND thread_id = $2", item_id, thread_id)
+    
+    async def search_items(self, context: dict, query: str, limit: int = 20, offset: int = 0) -> list[dict]:
+        """Ranked full-text search over the current user's messages (see SQLiteStore.search_items)"""
+        terms = search_terms(query)
+        if not terms:
+            return []
+        # Terms are \w+ only, so quoting them keeps to_tsquery from ever seeing operators
+        tsquery = " & ".join(f"'{term}'" for term in terms)
+        if query.rstrip().endswith("*"):
+            tsquery += ":*"
+        owner = context.get("user_id")
+        owner_filter = "threads.owner = $1" if owner is not None else "threads.owner IS NULL AND $1::text IS NULL"
+        pool = await self._pool()
+        # Rank the user's most recent matches, then build headlines for the page only
+        rows = await pool.fetch(f"""
+            SELECT id, thread_id, role, created_at, score,
+                   ts_headline('english', text, query, 'StartSel=**, StopSel=**, MaxWords=16, MinWords=8') AS snippet
+            FROM (
+                SELECT *, ts_rank(to_tsvector('english', COALESCE(text, '')), query) AS score
+                FROM (
+                    SELECT items.id, items.thread_id, items.role, items.created_at, items.text, query
+                    FROM chatkit_thread_items items
+                    JOIN chatkit_threads threads ON threads.id = items.thread_id,
+                         to_tsquery('english', $2) query
+                    WHERE {owner_filter} AND to_tsvector('english', COALESCE(items.text, '')) @@ query
+                    ORDER BY items.created_at DESC LIMIT $3
+                ) candidates
+                ORDER BY score DESC, created_at DESC LIMIT $4 OFFSET $5
+            ) page
+            ORDER BY score DESC, created_at DESC
+        """, owner, tsquery, SEARCH_CANDIDATES, limit, offset)
+        return [
+            {
+                "item_id": row["id"],
+                "thread_id": row["thread_id"],
+                "role": row["role"],
+                "created_at": row["created_at"].isoformat() if row["created_at"] else None,
+                "snippet": row["snippet"],
+                "score": row["score"],
+            }
+            for row in rows
+        ]
+    
+    # Attachment methods are not part of Store - they're in AttachmentStore
+    async def save_attachment(self, attachment: Attachment, context: dict) -> None:
+        """Not implemented - use AttachmentStore"""
+        raise NotImplementedError("Use AttachmentStore for attachments")
+    
+    async def load_attachment(self, attachment_id: str, context: dict) -> Attachment:
+        """Not implemented - use AttachmentStore"""
+        raise NotImplementedError("Use AttachmentStore for attachments")
+    
+    async def delete_attachment(self, attachment_id: str, context: dict) -> None:
+        """Not implemented - use AttachmentStore"""
+        raise NotImplementedError("Use AttachmentStore for attachments")
+
+
+class PostgresAttachmentStore(_PostgresSchema, AttachmentStore[dict]):
+    """
+    Postgres-based AttachmentStore implementation
+    
+    File contents are stored once per SHA-256 digest and reference counted,
+    like SQLiteAttachmentStore. Uploads are spooled to a temp file while they
+    are hashed and sent to chatkit_blob_chunks one CHUNK_SIZE piece at a
+    time, so memory stays bounded whatever the file size. Every node can
+    serve any attachment: load_attachment_file() streams the chunks into a
+    local, content-addressed cache on first access so it can be served as a
+    file.
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS chatkit_attachments (
+            id TEXT PRIMARY KEY,
+            metadata JSONB NOT NULL,
+            blob_sha256 TEXT,
+            created_at TIMESTAMP,
+            owner TEXT
+        );
+        ALTER TABLE chatkit_attachments ADD COLUMN IF NOT EXISTS owner TEXT;
+        CREATE TABLE IF NOT EXISTS chatkit_blobs (
+            sha256 TEXT PRIMARY KEY,
+            content BYTEA,
+            size BIGINT,
+            ref_count INTEGER NOT NULL,
+            created_at TIMESTAMP
+        );
+        -- Blobs saved before chunking keep their bytes in content; newer ones are in chatkit_blob_chunks
+        ALTER TABLE chatkit_blobs ALTER COLUMN content DROP NOT NULL;
+        CREATE TABLE IF NOT EXISTS chatkit_blob_chunks (
+            sha256 TEXT NOT NULL REFERENCES chatkit_blobs (sha256) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            data BYTEA NOT NULL,
+            PRIMARY KEY (sha256, seq)
+        );
+    """
+    
+    CHUNK_SIZE = 1024 * 1024
+    
+    def __init__(self, connections: PostgresConnectionManager, cache_path: str = "./chatkit_files/blob_cache"):
+        super().__init__(connections)
+        self.cache_path = cache_path
+        self.tmp_path = os.path.join(cache_path, "tmp")
+        os.makedirs(self.tmp_path, exist_ok=True)
+    
+    def blob_file_path(self, sha256: str) -> str:
+        """Path of the locally cached blob file for a digest"""
+        return os.path.join(self.cache_path, sha256[:2], sha256)
+    
+    async def _upload_chunks(self, conn: asyncpg.Connection, sha256: str, tmp_file: str) -> None:
+        """Send a spooled upload to chatkit_blob_chunks one chunk at a time (inside a transaction)"""
+        f = await asyncio.to_thread(open, tmp_file, 'rb')
+        try:
+            seq = 0
+            while chunk := await asyncio.to_thread(f.read, self.CHUNK_SIZE):
+                await conn.execute("INSERT INTO chatkit_blob_chunks (sha256, seq, data) VALUES ($1, $2, $3)", sha256, seq, chunk)
+                seq += 1
+        finally:
+            f.close()
+    
+    def _adopt_cache_file(self, tmp_file: str, sha256: str) -> None:
+        """Move a spooled upload into the local cache, so this node serves it without reading it back"""
+        file_path = self.blob_file_path(sha256)
+        if os.path.exists(file_path):
+            os.remove(tmp_file)
+            return
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        os.replace(tmp_file, file_path)
+    
+    async def _release_blob(self, conn: asyncpg.Connection, sha256: str) -> None:
+        """Drop one reference to a blob, removing it when nothing uses it (inside a transaction)"""
+        remaining = await conn.fetchval("UPDATE chatkit_blobs SET ref_count = ref_count - 1 WHERE sha256 = $1 RETURNING ref_count", sha256)
+        if remaining is not None and remaining <= 0:
+            await conn.execute("DELETE FROM chatkit_blobs WHERE sha256 = $1 AND ref_count <= 0", sha256)
+            try:
+                os.remove(self.blob_file_path(sha256))
+            except FileNotFoundError:
+                pass
+    
+    async def save_attachment(self, attachment: Attachment, context: dict) -> None:
+        """Save attachment metadata and content"""
+        import uuid
+        
+        if not attachment.id:
+            attachment.id = f"file_{uuid.uuid4().hex[:16]}"
+        
+        content = getattr(attachment, 'content', None)
+        upload = await stream_to_temp(content, self.tmp_path, self.CHUNK_SIZE) if content else None
+        now = datetime.now()
+        metadata = json.dumps(
+            attachment.model_dump(mode="json", exclude={"content"}) if hasattr(attachment, 'model_dump') else attachment.dict()
+        )
+        
+        pool = await self._pool()
+        try:
+            await self._save_attachment_row(pool, attachment, metadata, upload, now, context)
+            if upload:
+                await asyncio.to_thread(self._adopt_cache_file, upload[0], upload[1])
+        finally:
+            if upload and os.path.exists(upload[0]):
+                os.remove(upload[0])
+    
+    async def _save_attachment_row(self, pool: asyncpg.Pool, attachment: Attachment, metadata: str, upload: tuple[str, str, int] | None, now: datetime, context: dict) -> None:
+        """Write the attachment row and take a reference to its content in one transaction"""
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                # Row lock so concurrent saves of the same attachment release its old blob once
+                previous = await conn.fetchval("SELECT blob_sha256 FROM chatkit_attachments WHERE id = $1 FOR UPDATE", attachment.id)
+                sha256 = None
+                if upload:
+                    tmp_file, sha256, size = upload
+                    # Only the first save of this content sends the bytes; a concurrent one
+                    # waits on the primary key until it commits and then takes a reference
+                    inserted = await conn.fetchval("""
+                        INSERT INTO chatkit_blobs (sha256, size, ref_count, created_at) VALUES ($1, $2, 1, $3)
+                        ON CONFLICT (sha256) DO UPDATE SET ref_count = chatkit_blobs.ref_count + 1
+                        RETURNING xmax = 0
+                    """, sha256, size, now)
+                    if inserted:
+                        await self._upload_chunks(conn, sha256, tmp_file)
+                # The owner is fixed by whoever created the attachment
+                await conn.execute("""
+                    INSERT INTO chatkit_attachments (id, metadata, blob_sha256, created_at, owner)
+                    VALUES ($1, $2::jsonb, $3, $4, $5)
+                    ON CONFLICT (id) DO UPDATE SET
+                        metadata = EXCLUDED.metadata,
+                        blob_sha256 = EXCLUDED.blob_sha256,
+                        created_at = EXCLUDED.created_at,
+                        owner = COALESCE(chatkit_attachments.owner, EXCLUDED.owner)
+                """, attachment.id, metadata, sha256, now, context.get("user_id"))
+                if previous:
+                    await self._release_blob(conn, previous)
+    
+    async def load_attachment(self, attachment_id: str, context: dict) -> Attachment:
+        """Load attachment metadata"""
+        pool = await self._pool()
+        metadata = await pool.fetchval("SELECT metadata FROM chatkit_attachments WHERE id = $1", attachment_id)
+        
+        if metadata is None:
+            raise ValueError(f"Attachment {attachment_id} not found")
+        
+        return _attachment_adapter.validate_json(metadata)
+    
+    async def load_attachment_file(self, attachment_id: str, context: dict) -> tuple[Attachment, str | None, str | None]:
+        """Load attachment metadata with a local file path for its content and the content digest (other users' attachments are not found)"""
+        pool = await self._pool()
+        row = await pool.fetchrow(
+            "SELECT metadata, blob_sha256 FROM chatkit_attachments WHERE id = $1 AND owner IS NOT DISTINCT FROM $2",
+            attachment_id, context.get("user_id"),
+        )
+        
+        if not row:
+            raise ValueError(f"Attachment {attachment_id} not found")
+        
+        attachment = _attachment_adapter.validate_json(row["metadata"])
+        sha256 = row["blob_sha256"]
+        if not sha256:
+            return attachment, None, None
+        file_path = self.blob_file_path(sha256)
+        if not await asyncio.to_thread(os.path.exists, file_path):
+            if not await self._fill_cache(pool, sha256, file_path):
+                return attachment, None, sha256
+        return attachment, file_path, sha256
+    
+    async def _fill_cache(self, pool: asyncpg.Pool, sha256: str, file_path: str) -> bool:
+        """
+        Stream a blob into the local cache one chunk at a time; False if it is gone.
+        The file is renamed into place, and is content-addressed, so concurrent fills agree.
+        """
+        import uuid
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_file = os.path.join(self.tmp_path, f"cache_{uuid.uuid4().hex}")
+        f = await asyncio.to_thread(open, tmp_file, 'wb')
+        found = False
+        try:
+            async with pool.acquire() as conn:
+                # Cursors only stream inside a transaction
+                async with conn.transaction():
+                    async for record in conn.cursor("""
+                        SELECT data FROM (
+                            SELECT -1 AS seq, content AS data FROM chatkit_blobs WHERE sha256 = $1 AND content IS NOT NULL
+                            UNION ALL
+                            SELECT seq, data FROM chatkit_blob_chunks WHERE sha256 = $1
+                        ) parts ORDER BY seq
+                    """, sha256, prefetch=1):
+                        await asyncio.to_thread(f.write, record["data"])
+                        found = True
+            f.close()
+            if found:
+                await asyncio.to_thread(os.replace, tmp_file, file_path)
+            return found
+        finally:
+            f.close()
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    
+    async def delete_attachment(self, attachment_id: str, context: dict) -> None:
+        """Delete an attachment"""
+        pool = await self._pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                sha256 = await conn.fetchval("DELETE FROM chatkit_attachments WHERE id = $1 RETURNING blob_sha256", attachment_id)
+                if sha256:
+                    await self._release_blob(conn, sha256)
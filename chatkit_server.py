@@ -1,11 +1,17 @@
 """
 ChatKit server implementation using the actual chatkit package API
 """
+import asyncio
+import hmac
+import json
 import os
+import re
+from contextlib import aclosing
 from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
 from typing import Any, AsyncIterator
 from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse, Response
+from fastapi.responses import StreamingResponse, Response, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
@@ -16,17 +22,29 @@ from chatkit.types import (
     ThreadStreamEvent,
     UserMessageItem,
     AssistantMessageItem,
+    AssistantMessageContent,
+    AssistantMessageContentPartAdded,
     AssistantMessageContentPartTextDelta,
+    AssistantMessageContentPartDone,
     ThreadItemAddedEvent,
+    ThreadItemUpdatedEvent,
     ThreadItemDoneEvent,
     ErrorEvent,
 )
 from chatkit.store import Store, AttachmentStore
-from chatkit_store import SQLiteStore, SQLiteAttachmentStore
+from chatkit_store import SQLiteStore, SQLiteAttachmentStore, SQLiteConnectionManager, WriteBehindSQLiteStore, CachedStore, ShardedSQLiteStore, shard_paths, history_message, project_item, SEARCH_CANDIDATES
+from chatkit_maintenance import StoreMaintenance
+from chatkit_backup import StoreBackup
 
 # Agents for workflow integration
 from agents import Agent, Runner
-from workflow import run_workflow, WorkflowInput
+from workflow import run_workflow, run_workflow_streamed, workflow_stats, WorkflowInput, WORKFLOW_AGENTS
+from workflow_cache import WorkflowCache, TILE_DIFFERENCE
+
+
+# How much conversation history respond() sends to the workflow
+HISTORY_ITEM_LIMIT = int(os.getenv("CHATKIT_HISTORY_ITEM_LIMIT", "50"))
+HISTORY_MAX_BYTES = int(os.getenv("CHATKIT_HISTORY_MAX_BYTES", str(512 * 1024)))
 
 
 class MyChatKitServer(ChatKitServer[dict]):
@@ -67,6 +85,12 @@ class MyChatKitServer(ChatKitServer[dict]):
         try:
             # If we have a user message, process it
             if input_user_message:
+                # A message reloaded from the store (e.g. for a retry) has chatkit-blob:
+                # references in place of its images; the workflow needs the image data
+                message_store = getattr(self, 'store', None) or self._data_store
+                if hasattr(message_store, 'rehydrate_item'):
+                    input_user_message = await message_store.rehydrate_item(input_user_message)
+                
                 # Extract message content
                 message_text = ""
                 image_data_url = None
@@ -93,52 +117,70 @@ class MyChatKitServer(ChatKitServer[dict]):
                 # Load conversation history from thread
                 conversation_history = []
                 try:
-                    # Load previous thread items (messages) from the store
+                    # Load the most recent thread items (messages) from the store
                     # Try to use the store from parent class, fallback to our reference
                     store_to_use = getattr(self, 'store', None) or self._data_store
-                    previous_items = await store_to_use.load_thread_items(thread.id, context, limit=50)
-                    
-                    # Convert thread items to conversation history format
-                    for item in previous_items:
-                        if hasattr(item, 'type'):
-                            if item.type == 'user_message':
-                                # Extract text from user message
-                                item_text = ""
-                                if hasattr(item, 'content'):
-                                    if isinstance(item.content, str):
-                                        item_text = item.content
-                                    elif isinstance(item.content, list):
-                                        for part in item.content:
-                                            if isinstance(part, dict) and part.get("type") == "text":
-                                                item_text += part.get("text", "")
-                                            elif hasattr(part, 'text'):
-                                                item_text += part.text
+                    # ChatKit saves the input message before respond() runs, so the tail window ends
+                    # with it; one extra item is loaded and the message left out, since it is added below
+                    if hasattr(store_to_use, 'load_conversation_history'):
+                        # The store keeps a role/text projection of each message, so no items are decoded
+                        conversation_history = await store_to_use.load_conversation_history(
+                            thread.id, context, limit=HISTORY_ITEM_LIMIT + 1, max_bytes=HISTORY_MAX_BYTES
+                        )
+                        input_role, input_text = project_item(input_user_message)
+                        if input_role and conversation_history and conversation_history[-1] == history_message(input_role, input_text):
+                            conversation_history.pop()
+                        conversation_history = conversation_history[-HISTORY_ITEM_LIMIT:]
+                    else:
+                        if hasattr(store_to_use, 'load_recent_thread_items'):
+                            previous_items = await store_to_use.load_recent_thread_items(
+                                thread.id, context, limit=HISTORY_ITEM_LIMIT + 1, max_bytes=HISTORY_MAX_BYTES
+                            )
+                        else:
+                            previous_items = await store_to_use.load_thread_items(thread.id, context, limit=HISTORY_ITEM_LIMIT + 1)
+                        previous_items = [item for item in previous_items if item.id != input_user_message.id][-HISTORY_ITEM_LIMIT:]
+                        
+                        # Convert thread items to conversation history format
+                        for item in previous_items:
+                            if hasattr(item, 'type'):
+                                if item.type == 'user_message':
+                                    # Extract text from user message
+                                    item_text = ""
+                                    if hasattr(item, 'content'):
+                                        if isinstance(item.content, str):
+                                            item_text = item.content
+                                        elif isinstance(item.content, list):
+                                            for part in item.content:
+                                                if isinstance(part, dict) and part.get("type") == "text":
+                                                    item_text += part.get("text", "")
+                                                elif hasattr(part, 'text'):
+                                                    item_text += part.text
+                                    
+                                    if item_text:
+                                        conversation_history.append({
+                                            "role": "user",
+                                            "content": [{"type": "input_text", "text": item_text}]
+                                        })
                                 
-                                if item_text:
-                                    conversation_history.append({
-                                        "role": "user",
-                                        "content": [{"type": "input_text", "text": item_text}]
-                                    })
-                            
-                            elif item.type == 'assistant_message':
-                                # Extract text from assistant message
-                                item_text = ""
-                                if hasattr(item, 'content'):
-                                    if isinstance(item.content, str):
-                                        item_text = item.content
-                                    elif isinstance(item.content, list):
-                                        for part in item.content:
-                                            if isinstance(part, dict) and part.get("type") == "text":
-                                                item_text += part.get("text", "")
-                                            elif hasattr(part, 'text'):
-                                                item_text += part.text
-                                
-                                if item_text:
-                                    # Assistant messages must use "output_text" not "input_text"
-                                    conversation_history.append({
-                                        "role": "assistant",
-                                        "content": [{"type": "output_text", "text": item_text}]
-                                    })
+                                elif item.type == 'assistant_message':
+                                    # Extract text from assistant message
+                                    item_text = ""
+                                    if hasattr(item, 'content'):
+                                        if isinstance(item.content, str):
+                                            item_text = item.content
+                                        elif isinstance(item.content, list):
+                                            for part in item.content:
+                                                if isinstance(part, dict) and part.get("type") == "text":
+                                                    item_text += part.get("text", "")
+                                                elif hasattr(part, 'text'):
+                                                    item_text += part.text
+                                    
+                                    if item_text:
+                                        # Assistant messages must use "output_text" not "input_text"
+                                        conversation_history.append({
+                                            "role": "assistant",
+                                            "content": [{"type": "output_text", "text": item_text}]
+                                        })
                 except Exception as e:
                     # If loading history fails, continue without it
                     print(f"Warning: Could not load conversation history: {e}")
@@ -161,7 +203,23 @@ class MyChatKitServer(ChatKitServer[dict]):
                     "content": current_user_content
                 })
                 
-                # Run the Proofit workflow with conversation history
+                # Run the Proofit workflow with conversation history, streaming the answer
+                # into one assistant message as it is generated
+                item_id = self.store.generate_item_id("message", thread, context)
+                assistant_item = AssistantMessageItem(
+                    id=item_id,
+                    thread_id=thread.id,
+                    content=[],
+                    created_at=datetime.now(),
+                )
+                yield ThreadItemAddedEvent(item=assistant_item)
+                yield ThreadItemUpdatedEvent(
+                    item_id=item_id,
+                    update=AssistantMessageContentPartAdded(content_index=0, content=AssistantMessageContent(text="")),
+                )
+                
+                deltas: list[str] = []
+                output_text = None
                 try:
                     workflow_input = WorkflowInput(
                         input_as_text=message_text,
@@ -169,37 +227,35 @@ class MyChatKitServer(ChatKitServer[dict]):
                         image_data_url=image_data_url,
                         conversation_history=conversation_history if conversation_history else None
                     )
-                    result = await run_workflow(workflow_input)
-                    output_text = result.get("output_text", "")
+                    # aclosing: a cancelled response stops the model run right away
+                    async with aclosing(_workflow_events(workflow_input, user_id)) as events:
+                        async for event in events:
+                            if event["type"] == "delta":
+                                deltas.append(event["delta"])
+                                yield ThreadItemUpdatedEvent(
+                                    item_id=item_id,
+                                    update=AssistantMessageContentPartTextDelta(content_index=0, delta=event["delta"]),
+                                )
+                            elif event["type"] == "done":
+                                output_text = event["output_text"]
                 except Exception as workflow_error:
                     # Log workflow error for debugging
                     import traceback
                     error_trace = traceback.format_exc()
                     print(f"Workflow error: {workflow_error}")
                     print(f"Traceback: {error_trace}")
-                    # Return a user-friendly error message
+                    # Return a user-friendly error message in place of the partial answer
                     output_text = f"I encountered an error processing your message: {str(workflow_error)}. Please try again or rephrase your question."
+                if output_text is None:
+                    output_text = "".join(deltas)
                 
-                # Create assistant message item
-                import uuid
-                item_id = f"msg_{uuid.uuid4().hex[:16]}"
-                assistant_item = AssistantMessageItem(
-                    id=item_id,
-                    content=output_text,
-                    created_at=datetime.now(),
-                )
-                
-                # Yield item added event
-                yield ThreadItemAddedEvent(
-                    type="thread_item_added",
-                    item=assistant_item,
-                )
-                
-                # Yield item done event
-                yield ThreadItemDoneEvent(
-                    type="thread_item_done",
+                # The finished item replaces the streamed one on the client and is what gets stored
+                content = AssistantMessageContent(text=output_text)
+                yield ThreadItemUpdatedEvent(
                     item_id=item_id,
+                    update=AssistantMessageContentPartDone(content_index=0, content=content),
                 )
+                yield ThreadItemDoneEvent(item=assistant_item.model_copy(update={"content": [content]}))
             
         except Exception as e:
             # Log the full error for debugging
@@ -209,13 +265,7 @@ class MyChatKitServer(ChatKitServer[dict]):
             print(f"Traceback: {error_trace}")
             
             # Yield error event
-            yield ErrorEvent(
-                type="error",
-                error={
-                    "code": "internal_error",
-                    "message": f"Error processing message: {str(e)}",
-                },
-            )
+            yield ErrorEvent(message=f"Error processing message: {str(e)}", allow_retry=True)
     
     def get_stream_options(self, thread: ThreadMetadata, context: dict):
         """Return stream-level runtime options"""
@@ -239,17 +289,169 @@ app.add_middleware(
 os.makedirs("./chatkit_data", exist_ok=True)
 os.makedirs("./chatkit_files", exist_ok=True)
 
-# Create Store implementations
-data_store = SQLiteStore(db_path="./chatkit_data/chatkit.db")
-attachment_store = SQLiteAttachmentStore(
-    db_path="./chatkit_data/chatkit.db",
-    base_path="./chatkit_files"
-)
+# CHATKIT_STORE_BACKEND=postgres keeps all state in Postgres (CHATKIT_DATABASE_URL)
+# so several server nodes behind a load balancer can share it
+store_backend = os.getenv("CHATKIT_STORE_BACKEND", "sqlite")
+db_connections = None
+pg_connections = None
+sharded_store = None
+maintenance = None
+shard_maintenance = []
+backups = []
+# Set CHATKIT_WRITE_BEHIND_MS (e.g. 5) to group-commit thread writes
+write_behind_ms = os.getenv("CHATKIT_WRITE_BEHIND_MS")
+if store_backend == "postgres":
+    from chatkit_postgres_store import PostgresConnectionManager, PostgresStore, PostgresAttachmentStore
+    pg_connections = PostgresConnectionManager(
+        os.environ["CHATKIT_DATABASE_URL"],
+        max_size=int(os.getenv("CHATKIT_PG_POOL_SIZE", "10")),
+        # 0 when connecting through a transaction-mode pooler (PgBouncer, Supabase pooler)
+        statement_cache_size=int(os.getenv("CHATKIT_PG_STATEMENT_CACHE", "100"))
+    )
+    data_store = PostgresStore(pg_connections)
+    attachment_store = PostgresAttachmentStore(pg_connections, cache_path="./chatkit_files/blob_cache")
+else:
+    # Create Store implementations (sharing one pool of long-lived connections)
+    db_connections = SQLiteConnectionManager("./chatkit_data/chatkit.db")
+    attachment_store = SQLiteAttachmentStore(
+        db_path="./chatkit_data/chatkit.db",
+        base_path="./chatkit_files",
+        connections=db_connections
+    )
+    # Images pasted into messages are kept in the attachment blobs, not in the item rows
+    # Set CHATKIT_SHARDS (e.g. 8) to spread threads over that many database files
+    shard_count = int(os.getenv("CHATKIT_SHARDS", "1"))
+    if shard_count > 1:
+        sharded_store = ShardedSQLiteStore(
+            shard_paths("./chatkit_data/shards", shard_count),
+            write_behind_ms=float(write_behind_ms) if write_behind_ms else None,
+            blob_store=attachment_store
+        )
+        data_store = sharded_store
+    elif write_behind_ms:
+        data_store = WriteBehindSQLiteStore(
+            db_path="./chatkit_data/chatkit.db",
+            connections=db_connections,
+            max_delay_ms=float(write_behind_ms),
+            blob_store=attachment_store
+        )
+    else:
+        data_store = SQLiteStore(db_path="./chatkit_data/chatkit.db", connections=db_connections, blob_store=attachment_store)
+    
+    # Background retention and compaction; TTLs are unset (keep forever) by default
+    thread_ttl_days = os.getenv("CHATKIT_THREAD_TTL_DAYS")
+    thread_ttl_days = float(thread_ttl_days) if thread_ttl_days else None
+    attachment_ttl_days = os.getenv("CHATKIT_ATTACHMENT_TTL_DAYS")
+    maintenance = StoreMaintenance(
+        db_connections,
+        attachment_store=attachment_store,
+        # With shards, chatkit.db has no threads table; each shard expires its own
+        thread_ttl_days=None if sharded_store else thread_ttl_days,
+        attachment_ttl_days=float(attachment_ttl_days) if attachment_ttl_days else None,
+        interval_s=float(os.getenv("CHATKIT_MAINTENANCE_INTERVAL_S", "300")),
+        purge_interval_s=float(os.getenv("CHATKIT_PURGE_INTERVAL_S", "5"))
+    )
+    # Each shard database gets its own thread retention, purging and compaction;
+    # attachments live in chatkit.db, so shards only release those of deleted threads
+    shard_maintenance = [
+        StoreMaintenance(
+            shard.connections,
+            attachment_store=attachment_store,
+            thread_ttl_days=thread_ttl_days,
+            interval_s=maintenance.interval_s,
+            purge_interval_s=maintenance.purge_interval_s,
+            manage_attachments=False
+        )
+        for shard in (sharded_store.shards if sharded_store else [])
+    ]
+    
+    # Set CHATKIT_BACKUP_DIR to take paced online backups of every database file
+    backup_dir = os.getenv("CHATKIT_BACKUP_DIR")
+    if backup_dir:
+        backup_options = dict(
+            pages=int(os.getenv("CHATKIT_BACKUP_PAGES", "256")),
+            pause_ms=float(os.getenv("CHATKIT_BACKUP_PAUSE_MS", "10")),
+            keep=int(os.getenv("CHATKIT_BACKUP_KEEP", "24")),
+            interval_s=float(os.getenv("CHATKIT_BACKUP_INTERVAL_S", "3600")),
+        )
+        backups = [StoreBackup("./chatkit_data/chatkit.db", backup_dir, **backup_options)] + [
+            StoreBackup(shard.db_path, os.path.join(backup_dir, "shards"), **backup_options)
+            for shard in (sharded_store.shards if sharded_store else [])
+        ]
+# In-memory LRU cache for hot threads; CHATKIT_CACHE_ENTRIES=0 disables it.
+# Off by default with Postgres, where another node may change a cached thread.
+cache_entries = int(os.getenv("CHATKIT_CACHE_ENTRIES", "0" if store_backend == "postgres" else "1024"))
+if cache_entries > 0:
+    data_store = CachedStore(data_store, max_entries=cache_entries)
+    # Threads expired by maintenance must not be served from the cache
+    for maintenance_task in ([maintenance] if maintenance is not None else []) + shard_maintenance:
+        maintenance_task.on_threads_expired = data_store.invalidate_threads
+
+# Exact-match cache of workflow answers, in memory and in its own SQLite file;
+# CHATKIT_WORKFLOW_CACHE_ENTRIES=0 and CHATKIT_WORKFLOW_CACHE_DISK_TTL_S=0 turn the tiers off
+workflow_cache_entries = int(os.getenv("CHATKIT_WORKFLOW_CACHE_ENTRIES", "256"))
+workflow_cache_disk_ttl_s = float(os.getenv("CHATKIT_WORKFLOW_CACHE_DISK_TTL_S", "86400"))
+# Re-uploads of a screenshot within this many of 256 perceptual-hash bits share an answer (one user's
+# requests only); off by default, since a small edit can land within the distance too
+image_cache_distance = int(os.getenv("CHATKIT_IMAGE_CACHE_DISTANCE", "0"))
+workflow_cache = None
+if workflow_cache_entries > 0 or workflow_cache_disk_ttl_s > 0:
+    workflow_cache = WorkflowCache(
+        WORKFLOW_AGENTS,
+        db_path="./chatkit_data/workflow_cache.db",
+        max_entries=workflow_cache_entries,
+        memory_ttl_s=float(os.getenv("CHATKIT_WORKFLOW_CACHE_TTL_S", "3600")),
+        disk_ttl_s=workflow_cache_disk_ttl_s,
+        image_distance=image_cache_distance if image_cache_distance > 0 else None,
+        tile_difference=int(os.getenv("CHATKIT_IMAGE_CACHE_TILE_DIFFERENCE", TILE_DIFFERENCE))
+    )
+
+
+def _workflow_events(workflow_input: WorkflowInput, user_id: str | None) -> AsyncIterator[dict]:
+    """run_workflow_streamed, through the answer cache when it is on; cached answers are only shared by one user's requests"""
+    if workflow_cache is None:
+        return run_workflow_streamed(workflow_input)
+    return workflow_cache.run_streamed(workflow_input, run_workflow_streamed, scope=user_id)
+
 
 # Initialize ChatKit server
 server = MyChatKitServer(store=data_store, attachment_store=attachment_store)
 
 
+@app.on_event("startup")
+async def start_maintenance():
+    """Start background store maintenance and backups"""
+    if maintenance is not None:
+        maintenance.start()
+    for shard_task in shard_maintenance:
+        shard_task.start()
+    for backup in backups:
+        backup.start()
+
+
+@app.on_event("shutdown")
+async def close_data_stores():
+    """Flush queued writes and close pooled database connections on shutdown"""
+    if maintenance is not None:
+        await maintenance.stop()
+    for shard_task in shard_maintenance:
+        await shard_task.stop()
+    for backup in backups:
+        await backup.stop()
+    try:
+        # Raises if the write-behind store had to drop a queued write
+        await data_store.flush()
+    finally:
+        if sharded_store is not None:
+            sharded_store.close()
+        if db_connections is not None:
+            db_connections.close()
+        if pg_connections is not None:
+            await pg_connections.close()
+        if workflow_cache is not None:
+            workflow_cache.close()
+
+
 @app.get("/")
 async def root():
     """Root endpoint - server information"""
@@ -261,8 +463,15 @@ async def root():
             "health": "/health",
             "chatkit": "/chatkit",
             "workflow": "/workflow",
+            "workflow_stats": "/workflow/stats",
+            "workflow_cache_stats": "/workflow/cache/stats",
+            "workflow_cache_invalidate": "/workflow/cache/invalidate",
             "context_info": "/context/info",
-            "tools_status": "/tools/status"
+            "tools_status": "/tools/status",
+            "store_stats": "/store/stats",
+            "search": "/search?q={query}&limit=20&offset=0",
+            "attachments": "/attachments/{attachment_id}",
+            "blobs": "/blobs/{sha256}?thread_id={thread_id}"
         },
         "timestamp": datetime.now().isoformat()
     }
@@ -273,8 +482,8 @@ async def health_check():
     """Health check endpoint"""
     return {
         "status": "ok",
-        "data_store": "SQLiteStore",
-        "attachment_store": "SQLiteAttachmentStore",
+        "data_store": type(data_store).__name__,
+        "attachment_store": type(attachment_store).__name__,
         "timestamp": datetime.now().isoformat()
     }
 
@@ -358,13 +567,30 @@ class WorkflowRequest(BaseModel):
     conversation_history: list[dict] | None = None  # Previous conversation messages
     audience: str | None = None  # Audience/context: consumer, enterprise, developer, marketing, internal
     platform: str | None = None  # Platform/breakpoint: desktop, mobile, responsive, app
+    stream: bool = False  # Stream the answer as server-sent events instead of one JSON response
+
+
+def _sse(event: str, data: dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+async def _stream_workflow(workflow_input: WorkflowInput, user_id: str | None) -> AsyncIterator[bytes]:
+    """Server-sent events for a workflow run: classified, delta..., then done or error"""
+    async with aclosing(_workflow_events(workflow_input, user_id)) as events:
+        try:
+            async for event in events:
+                yield _sse(event.pop("type"), event)
+        except Exception as e:
+            print(f"Workflow stream error: {e}")
+            yield _sse("error", {"error": str(e)})
 
 
 @app.post("/workflow")
-async def workflow_endpoint(request: WorkflowRequest):
+async def workflow_endpoint(request: WorkflowRequest, response: Response, http_request: Request):
     """
     Run the Proofit workflow directly.
-    Supports text input and optional image attachments.
+    Supports text input and optional image attachments; with stream set the
+    answer arrives as server-sent events while it is generated.
     """
     try:
         # Convert base64 images to data URL format if provided
@@ -399,7 +625,23 @@ async def workflow_endpoint(request: WorkflowRequest):
             audience=request.audience,
             platform=request.platform
         )
-        result = await run_workflow(workflow_input)
+        # Cached answers are only served back to the user they were made for
+        user_id = http_request.headers.get("X-User-ID")
+        if request.stream:
+            return StreamingResponse(
+                _stream_workflow(workflow_input, user_id),
+                media_type="text/event-stream",
+                # Keep proxies from buffering the stream into one late response
+                headers={"cache-control": "no-cache", "x-accel-buffering": "no"},
+            )
+        if workflow_cache is None:
+            result = await run_workflow(workflow_input)
+            return {"output_text": result["output_text"]}
+        cache_key = workflow_cache.key(workflow_input, user_id)
+        result, source = await workflow_cache.run(workflow_input, run_workflow, cache_key, user_id)
+        # Where the answer came from (memory, disk, similar, inflight or miss) and the key to invalidate it by
+        response.headers["x-workflow-cache"] = source or "miss"
+        response.headers["x-workflow-cache-key"] = cache_key
         return {"output_text": result["output_text"]}
     except Exception as e:
         # Log the full error with traceback
@@ -414,6 +656,186 @@ async def workflow_endpoint(request: WorkflowRequest):
         )
 
 
+@app.get("/workflow/stats")
+async def workflow_stats_endpoint():
+    """Classification fast-path and speculative routing counters"""
+    return {**workflow_stats(), "timestamp": datetime.now().isoformat()}
+
+
+@app.get("/workflow/cache/stats")
+async def workflow_cache_stats():
+    """Workflow answer cache counters"""
+    return {
+        "cache": await workflow_cache.stats() if workflow_cache is not None else None,
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+class CacheInvalidationRequest(BaseModel):
+    key: str | None = None  # x-workflow-cache-key of one answer; omit to drop every cached answer
+
+
+# Bearer token for administrative endpoints; they refuse every request while it is unset
+ADMIN_TOKEN = os.getenv("CHATKIT_ADMIN_TOKEN", "")
+
+
+def _admin_denied(http_request: Request) -> Response | None:
+    """401 without the admin bearer token, 403 when no admin token is configured, None when allowed"""
+    if not ADMIN_TOKEN:
+        return Response(status_code=403)
+    scheme, _, token = http_request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+        return Response(status_code=401, headers={"www-authenticate": "Bearer"})
+    return None
+
+
+@app.post("/workflow/cache/invalidate")
+async def invalidate_workflow_cache(http_request: Request, request: CacheInvalidationRequest | None = None):
+    """Drop cached workflow answers, e.g. after a bad answer or a change to the tools' data (admin token required)"""
+    denied = _admin_denied(http_request)
+    if denied is not None:
+        return denied
+    if workflow_cache is None:
+        return {"invalidated": 0}
+    return {"invalidated": await workflow_cache.invalidate(request.key if request else None)}
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison of an If-None-Match header against an ETag"""
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+@app.api_route("/attachments/{attachment_id}", methods=["GET", "HEAD"])
+async def download_attachment(attachment_id: str, request: Request):
+    """
+    Serve an attachment's file to the user (X-User-ID) who uploaded it; anyone else gets 404.
+    Supports Range/If-Range, and answers If-None-Match / If-Modified-Since
+    with 304 so frontend re-renders revalidate without re-downloading.
+    The file is streamed in fixed-size chunks (or handed to the server via
+    the ASGI pathsend extension where supported), never read into memory.
+    """
+    try:
+        attachment, file_path, sha256 = await attachment_store.load_attachment_file(attachment_id, {"user_id": request.headers.get("X-User-ID")})
+    except ValueError:
+        return Response(status_code=404)
+    try:
+        stat_result = await asyncio.to_thread(os.stat, file_path) if file_path else None
+    except FileNotFoundError:
+        stat_result = None
+    if stat_result is None:
+        return Response(status_code=404)
+    
+    # Content-addressed files have a natural strong ETag; older files fall back to mtime/size
+    etag = f'"{sha256}"' if sha256 else f'"{int(stat_result.st_mtime)}-{stat_result.st_size}"'
+    headers = {
+        "etag": etag,
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        # Attachment ids can be re-saved with new content, so always revalidate
+        "cache-control": "private, no-cache",
+        "vary": "X-User-ID",
+    }
+    
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    not_modified = False
+    if if_none_match is not None:
+        not_modified = _etag_matches(if_none_match, etag)
+    elif if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+            not_modified = int(stat_result.st_mtime) <= since.timestamp()
+        except (TypeError, ValueError):
+            pass
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    
+    return FileResponse(
+        file_path,
+        media_type=attachment.mime_type,
+        filename=attachment.name,
+        content_disposition_type="inline",
+        headers=headers,
+        stat_result=stat_result,
+    )
+
+
+_BLOB_MEDIA_TYPES = {"image/png", "image/jpeg", "image/gif", "image/webp"}
+
+
+@app.get("/blobs/{sha256}")
+async def download_blob(sha256: str, request: Request, thread_id: str = "", type: str = "application/octet-stream"):
+    """
+    Serve an image a stored message refers to as chatkit-blob:<type>;<sha256>.
+    Only to the user (X-User-ID) who owns thread_id, and only if one of its
+    items refers to the blob; anyone else gets 404. Blobs are content-addressed,
+    so responses can be cached forever.
+    """
+    if not re.fullmatch(r"[0-9a-f]{64}", sha256) or not hasattr(attachment_store, "blob_file_path"):
+        return Response(status_code=404)
+    if not thread_id or not hasattr(data_store, "thread_has_blob"):
+        return Response(status_code=404)
+    if not await data_store.thread_has_blob(thread_id, sha256, {"user_id": request.headers.get("X-User-ID")}):
+        return Response(status_code=404)
+    file_path = attachment_store.blob_file_path(sha256)
+    if not await asyncio.to_thread(os.path.exists, file_path):
+        return Response(status_code=404)
+    return FileResponse(
+        file_path,
+        # Only raster image types, so a blob is never rendered as a page or an SVG with scripts
+        media_type=type if type in _BLOB_MEDIA_TYPES else "application/octet-stream",
+        headers={
+            "etag": f'"{sha256}"',
+            "cache-control": "private, max-age=31536000, immutable",
+            "vary": "X-User-ID",
+            "x-content-type-options": "nosniff",
+        },
+    )
+
+
+@app.get("/search")
+async def search(request: Request, q: str = "", limit: int = 20, offset: int = 0):
+    """
+    Full-text search over the calling user's (X-User-ID) messages and critiques.
+    Results are ranked best first and paginated with limit/offset; a trailing *
+    matches the last word as a prefix.
+    """
+    if not hasattr(data_store, "search_items"):
+        return Response(
+            content=json.dumps({"error": f"{type(data_store).__name__} does not support search"}),
+            media_type="application/json",
+            status_code=501
+        )
+    limit = min(max(limit, 1), 100)
+    # Only the most recent SEARCH_CANDIDATES matches are ranked
+    offset = min(max(offset, 0), SEARCH_CANDIDATES)
+    context = {"user_id": request.headers.get("X-User-ID")}
+    results = await data_store.search_items(context, q, limit=limit, offset=offset)
+    return {
+        "query": q,
+        "results": results,
+        "limit": limit,
+        "offset": offset,
+        # A full page means there may be more
+        "next_offset": offset + limit if len(results) == limit and offset + limit < SEARCH_CANDIDATES else None,
+    }
+
+
+@app.get("/store/stats")
+async def store_stats():
+    """Data store cache, maintenance and backup counters"""
+    return {
+        "cache": data_store.stats() if isinstance(data_store, CachedStore) else None,
+        # Queued writes the write-behind store could not commit (other stores raise to the caller instead)
+        "dropped_writes": getattr(data_store, "dropped_writes", 0),
+        "maintenance": maintenance.stats if maintenance is not None else None,
+        "shard_maintenance": [shard_task.stats for shard_task in shard_maintenance],
+        "backups": {backup.name: backup.stats for backup in backups},
+        "timestamp": datetime.now().isoformat()
+    }
+
+
 @app.get("/tools/status")
 async def get_tool_status():
     """Get information about available tools"""
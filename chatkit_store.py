@@ -1,60 +1,639 @@
 """
 Simple Store implementation for ChatKit using SQLite
 """
+import asyncio
+import base64
+import hashlib
+import heapq
+import itertools
+import logging
 import sqlite3
 import json
 import os
-from typing import Any
+import queue
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, TypeVar
+from pydantic import TypeAdapter
 from chatkit.store import Store, AttachmentStore, StoreItemType
 from chatkit.types import ThreadMetadata, ThreadItem, Attachment
 
 
+logger = logging.getLogger(__name__)
+
+# ThreadItem and Attachment are discriminated unions, so they have to be validated through adapters
+_thread_item_adapter = TypeAdapter(ThreadItem)
+_attachment_adapter = TypeAdapter(Attachment)
+
+# Stored item encodings. Binary rows start with a codec byte; older rows are JSON text.
+ITEM_CODEC_JSON = 0x01  # raw JSON bytes
+ITEM_CODEC_ZLIB_JSON = 0x02  # zlib-compressed JSON bytes
+# Compression only pays for large rows that shrink a lot (long text); small rows and
+# already-compressed payloads such as base64 screenshots load faster as raw JSON
+_COMPRESS_MIN_BYTES = 16 * 1024
+_COMPRESS_MAX_RATIO = 0.5
+
+
+def encode_item(item: ThreadItem) -> tuple[bytes, int]:
+    """Encode a thread item for storage, returning (encoded bytes, uncompressed JSON size)"""
+    return encode_item_json(_thread_item_adapter.dump_json(item))
+
+
+def encode_item_json(data: bytes) -> tuple[bytes, int]:
+    """Encode an item that is already serialized as JSON (see encode_item)"""
+    if len(data) >= _COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(data, 1)
+        if len(compressed) <= len(data) * _COMPRESS_MAX_RATIO:
+            return bytes([ITEM_CODEC_ZLIB_JSON]) + compressed, len(data)
+    return bytes([ITEM_CODEC_JSON]) + data, len(data)
+
+
+def decode_item_json(data: bytes | str) -> bytes:
+    """The JSON bytes of a stored item, without validating it"""
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    codec = data[0]
+    if codec == ITEM_CODEC_ZLIB_JSON:
+        return zlib.decompress(memoryview(data)[1:])
+    if codec == ITEM_CODEC_JSON:
+        return data[1:]
+    raise ValueError(f"Unknown stored item codec {codec:#x}")
+
+
+def decode_item(data: bytes | str) -> ThreadItem:
+    """Decode a stored thread item, including legacy JSON text rows"""
+    return _thread_item_adapter.validate_json(decode_item_json(data))
+
+
+def item_attachment_ids(data: bytes | str) -> list[str]:
+    """Ids of the attachments a stored item references, without validating it"""
+    attachments = json.loads(decode_item_json(data)).get("attachments") or []
+    return [attachment["id"] for attachment in attachments if isinstance(attachment, dict) and attachment.get("id")]
+
+
+# Base64 image data URLs (pasted screenshots, image previews) at least this long are moved
+# into the attachment blob store when an item is saved, leaving a chatkit-blob: reference
+INLINE_BLOB_MIN_BYTES = 4 * 1024
+BLOB_REF_PREFIX = "chatkit-blob:"
+_DATA_URL = re.compile(rb"data:(image/[\w.+-]+);base64,([A-Za-z0-9+/]+={0,2})")
+_BLOB_REF = re.compile(rb"chatkit-blob:(image/[\w.+-]+);([0-9a-f]{64})")
+
+
+def externalize_blobs(data: bytes, min_bytes: int = INLINE_BLOB_MIN_BYTES) -> tuple[bytes, dict[str, bytes]]:
+    """Replace large image data URLs in item JSON with chatkit-blob: references, returning (JSON, {sha256: image bytes})"""
+    blobs: dict[str, bytes] = {}
+    if b"data:image/" not in data:
+        return data, blobs
+    
+    def _replace(match: re.Match) -> bytes:
+        encoded = match.group(2)
+        if len(encoded) < min_bytes:
+            return match.group(0)
+        try:
+            payload = base64.b64decode(encoded)
+        except ValueError:
+            return match.group(0)
+        # Only payloads that re-encode to the same text, so rehydrating gives back the exact item
+        if base64.b64encode(payload) != encoded:
+            return match.group(0)
+        sha256 = hashlib.sha256(payload).hexdigest()
+        blobs[sha256] = payload
+        return b"chatkit-blob:" + match.group(1) + b";" + sha256.encode()
+    
+    return _DATA_URL.sub(_replace, data), blobs
+
+
+def blob_ref_digests(data: bytes) -> list[str]:
+    """Distinct digests of the chatkit-blob: references in item JSON"""
+    if b"chatkit-blob:" not in data:
+        return []
+    return list(dict.fromkeys(match.group(2).decode() for match in _BLOB_REF.finditer(data)))
+
+
+def rehydrate_blobs(data: bytes, blobs: dict[str, bytes]) -> bytes:
+    """Put the original data URLs back in place of chatkit-blob: references (references to missing blobs are kept)"""
+    def _replace(match: re.Match) -> bytes:
+        payload = blobs.get(match.group(2).decode())
+        if payload is None:
+            return match.group(0)
+        return b"data:" + match.group(1) + b";base64," + base64.b64encode(payload)
+    return _BLOB_REF.sub(_replace, data)
+
+
+# Model-history roles for message items
+_PROJECTED_ROLES = {"user_message": "user", "assistant_message": "assistant"}
+
+
+def project_item(item: ThreadItem | dict) -> tuple[str | None, str | None]:
+    """Role/text projection of a message item (or its JSON dict) for building model history, or (None, None)"""
+    if isinstance(item, dict):
+        role, content = _PROJECTED_ROLES.get(item.get("type")), item.get("content")
+    else:
+        role, content = _PROJECTED_ROLES.get(getattr(item, "type", None)), getattr(item, "content", None)
+    if role is None:
+        return None, None
+    if isinstance(content, str):
+        text = content
+    else:
+        text = "".join(
+            (part.get("text") if isinstance(part, dict) else getattr(part, "text", None)) or ""
+            for part in content or []
+        )
+    return (role, text) if text else (None, None)
+
+
+def history_message(role: str, text: str) -> dict:
+    """Build a model-ready history message from a projected row"""
+    content_type = "output_text" if role == "assistant" else "input_text"
+    return {"role": role, "content": [{"type": content_type, "text": text}]}
+
+
+# Item reads stop at a tombstone: the thread's id is bound to the ?, and the subquery
+# does not depend on the item row, so SQLite evaluates it once per statement
+_LIVE_THREAD = "EXISTS (SELECT 1 FROM threads WHERE id = ? AND deleted_at IS NULL)"
+
+# Search terms kept from a user query; everything else (FTS5 operators, quotes) is dropped
+_SEARCH_TERM = re.compile(r"\w+", re.UNICODE)
+_MAX_SEARCH_TERMS = 16
+# Most recent matches ranked per search; offsets past this return nothing
+SEARCH_CANDIDATES = 250
+
+
+def search_terms(query: str) -> list[str]:
+    """The words of a user search query"""
+    return _SEARCH_TERM.findall(query)[:_MAX_SEARCH_TERMS]
+
+
+def fts_match_query(query: str) -> str | None:
+    """
+    Turn free text into a safe FTS5 query matching all of its words.
+    
+    Every word is quoted, so user input can never be a syntax error. Words
+    match exactly after stemming; a trailing * makes the last one a prefix,
+    which costs a merge of every matching term's doclist, so it is opt-in.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    if query.rstrip().endswith("*"):
+        quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+# Wrap each matched token in highlight() output for score_search_hits and search_snippet
+_HIT_MARK = "\x02"
+_HIT_END = "\x03"
+
+
+def score_search_hits(highlighted: list[str], k1: float = 1.2, b: float = 0.75) -> list[float]:
+    """
+    BM25-style scores (higher is better) from highlight() output.
+    
+    FTS5's bm25() needs the document frequency of every query term, which
+    means walking the term's whole doclist on each query. Every candidate here
+    already matches every term, so only term frequency and length matter.
+    """
+    if not highlighted:
+        return []
+    average_length = sum(len(text) for text in highlighted) / len(highlighted) or 1.0
+    scores = []
+    for text in highlighted:
+        hits = text.count(_HIT_MARK)
+        scores.append(hits * (k1 + 1) / (hits + k1 * (1 - b + b * len(text) / average_length)))
+    return scores
+
+
+def search_snippet(highlighted: str, words: int = 16) -> str:
+    """A window of words around the first match in highlight() output, matches wrapped in **"""
+    tokens = highlighted.split()
+    first = next((i for i, token in enumerate(tokens) if _HIT_MARK in token), 0)
+    start = max(0, min(first - words // 4, len(tokens) - words))
+    snippet = " ".join(tokens[start:start + words]).replace(_HIT_MARK, "**").replace(_HIT_END, "**")
+    return ("…" if start > 0 else "") + snippet + ("…" if start + words < len(tokens) else "")
+
+
+def _add_column_if_missing(cursor: sqlite3.Cursor, table: str, column: str, declaration: str) -> bool:
+    """Add a column to an existing table; returns True if it was missing"""
+    # table_xinfo, unlike table_info, also lists generated columns
+    columns = {row[1] for row in cursor.execute(f"PRAGMA table_xinfo({table})")}
+    if column in columns:
+        return False
+    cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+    return True
+
+
+def shard_index(key: str, shard_count: int) -> int:
+    """Stable shard number for a thread or attachment id (crc32, so it never changes between processes)"""
+    return zlib.crc32(key.encode("utf-8")) % shard_count
+
+
+def shard_paths(directory: str, shard_count: int) -> list[str]:
+    """Database file paths for a set of shard_count shards"""
+    # The count is part of the name so files from different shard sets never mix
+    return [os.path.join(directory, f"chatkit-{index:03d}-of-{shard_count:03d}.db") for index in range(shard_count)]
+
+
+T = TypeVar("T")
+
+# A write as (sql, params); SQLiteStore methods build lists of these and run them in one transaction
+Statement = tuple[str, tuple]
+
+
+class SQLiteConnectionManager:
+    """
+    Long-lived SQLite connections shared by the stores.
+    
+    A single writer connection is guarded by a lock, and readers check out their
+    own connections from a pool so that, in WAL mode, they never wait on writers.
+    The async helpers run queries on a bounded thread pool so blocking sqlite3
+    calls never stall the event loop.
+    """
+    
+    def __init__(
+        self,
+        db_path: str,
+        max_readers: int = 4,
+        journal_mode: str = "WAL",
+        synchronous: str = "NORMAL",
+        cache_size_kb: int = 64 * 1024,
+        mmap_size: int = 256 * 1024 * 1024,
+        busy_timeout_ms: int = 5000,
+        pooled: bool = True,
+    ):
+        self.db_path = db_path
+        self.max_readers = max_readers
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.busy_timeout_ms = busy_timeout_ms
+        # pooled=False opens a fresh connection per operation (the old behaviour)
+        self.pooled = pooled
+        
+        self._write_lock = threading.Lock()
+        self._writer: sqlite3.Connection | None = None
+        self._readers: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+        self._closed = False
+        # One thread per reader plus the writer is enough to keep every connection busy
+        self._executor = ThreadPoolExecutor(max_workers=max_readers + 1, thread_name_prefix="chatkit-sqlite")
+        
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        
+        # journal_mode is persistent, so it only needs to be set once per file.
+        # auto_vacuum only takes effect on a new database (see enable_incremental_vacuum)
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute(f"PRAGMA journal_mode={self.journal_mode}")
+        conn.close()
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Open a connection with the per-connection pragmas applied"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None,  # transactions are managed explicitly in write()
+            check_same_thread=False,
+        )
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA cache_size=-{self.cache_size_kb}")
+        conn.execute(f"PRAGMA mmap_size={self.mmap_size}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+    
+    @contextmanager
+    def write(self) -> Iterator[sqlite3.Connection]:
+        """Run a write transaction on the shared writer connection"""
+        with self._write_lock:
+            if self._closed:
+                raise RuntimeError("Connection manager is closed")
+            if self.pooled:
+                if self._writer is None:
+                    self._writer = self._connect()
+                conn = self._writer
+            else:
+                conn = self._connect()
+            try:
+                # BEGIN IMMEDIATE takes the write lock up front instead of failing mid-transaction
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    yield conn
+                except BaseException:
+                    conn.rollback()
+                    raise
+                conn.commit()
+            finally:
+                if not self.pooled:
+                    conn.close()
+    
+    @contextmanager
+    def read(self) -> Iterator[sqlite3.Connection]:
+        """Check out a reader connection"""
+        if self._closed:
+            raise RuntimeError("Connection manager is closed")
+        if not self.pooled:
+            conn = self._connect()
+            try:
+                yield conn
+            finally:
+                conn.close()
+            return
+        
+        conn = self._acquire_reader()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            if self._closed:
+                conn.close()
+            else:
+                self._readers.put(conn)
+    
+    def _acquire_reader(self) -> sqlite3.Connection:
+        """Reuse an idle reader, open a new one below the limit, or wait for one"""
+        try:
+            return self._readers.get_nowait()
+        except queue.Empty:
+            pass
+        with self._reader_lock:
+            if self._reader_count < self.max_readers:
+                self._reader_count += 1
+                return self._connect()
+        return self._readers.get()
+    
+    async def run_write(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """Run fn(conn) in a write transaction on the executor"""
+        def _work() -> T:
+            with self.write() as conn:
+                return fn(conn)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, _work)
+    
+    async def run_read(self, fn: Callable[[sqlite3.Connection], T]) -> T:
+        """Run fn(conn) on a reader connection on the executor"""
+        def _work() -> T:
+            with self.read() as conn:
+                return fn(conn)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, _work)
+    
+    def enable_incremental_vacuum(self) -> bool:
+        """
+        Switch an existing database to auto_vacuum=INCREMENTAL.
+        
+        This rewrites the whole file with VACUUM and blocks writers while it runs,
+        so it is meant for a maintenance window. Returns True if a rebuild ran.
+        """
+        with self._write_lock:
+            conn = self._connect()
+            try:
+                if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                    return False
+                conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                conn.execute("VACUUM")
+                return True
+            finally:
+                conn.close()
+    
+    def close(self) -> None:
+        """Close all pooled connections"""
+        if self._closed:
+            return
+        # Let queued queries finish before their connections go away
+        self._executor.shutdown(wait=True)
+        self._closed = True
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+
+
 class SQLiteStore(Store[dict]):
-    """SQLite-based Store implementation for ChatKit"""
+    """
+    SQLite-based Store implementation for ChatKit
+    
+    With a blob_store, image data URLs inside saved items are kept in its
+    content-addressed blobs and the item rows only hold chatkit-blob:
+    references, so model history, search and row copies never drag
+    screenshots through json.loads. Items loaded for clients (load_item,
+    load_thread_items, load_recent_thread_items) get their data URLs back;
+    chatkit-blob: references never leave the store.
+    """
     
-    def __init__(self, db_path: str = "./chatkit_data/chatkit.db"):
+    def __init__(
+        self,
+        db_path: str = "./chatkit_data/chatkit.db",
+        connections: SQLiteConnectionManager | None = None,
+        blob_store: "SQLiteAttachmentStore | None" = None,
+        inline_blob_min_bytes: int = INLINE_BLOB_MIN_BYTES,
+    ):
         self.db_path = db_path
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self.connections = connections or SQLiteConnectionManager(db_path)
+        self.blob_store = blob_store
+        self.inline_blob_min_bytes = inline_blob_min_bytes
         self._init_db()
     
     def _init_db(self):
         """Initialize the database schema"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Threads table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS threads (
-                id TEXT PRIMARY KEY,
-                metadata TEXT,
-                created_at TEXT,
-                updated_at TEXT
-            )
-        """)
-        
-        # Thread items table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS thread_items (
-                id TEXT PRIMARY KEY,
-                thread_id TEXT,
-                item_type TEXT,
-                content TEXT,
-                created_at TEXT,
-                FOREIGN KEY (thread_id) REFERENCES threads(id)
-            )
-        """)
+        with self.connections.write() as conn:
+            cursor = conn.cursor()
+            
+            # Threads table
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS threads (
+                    id TEXT PRIMARY KEY,
+                    owner TEXT,
+                    metadata TEXT,
+                    created_at TEXT,
+                    updated_at TEXT
+                )
+            """)
+            
+            # Databases created before threads recorded their owner
+            if _add_column_if_missing(cursor, "threads", "owner", "TEXT"):
+                cursor.execute("UPDATE threads SET updated_at = created_at WHERE updated_at IS NULL")
+            
+            # Per-user thread listing, newest first, with a keyset cursor
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_threads_owner_updated
+                ON threads (owner, updated_at DESC, id DESC)
+            """)
+            
+            # delete_thread only sets deleted_at; StoreMaintenance removes the rows later,
+            # finding them through this index of the (few) tombstoned threads
+            _add_column_if_missing(cursor, "threads", "deleted_at", "TEXT")
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_threads_deleted
+                ON threads (deleted_at) WHERE deleted_at IS NOT NULL
+            """)
+            
+            # Thread items table
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS thread_items (
+                    id TEXT PRIMARY KEY,
+                    thread_id TEXT,
+                    item_type TEXT,
+                    content BLOB,
+                    content_size INTEGER,
+                    created_at TEXT,
+                    FOREIGN KEY (thread_id) REFERENCES threads(id)
+                )
+            """)
+            
+            # content holds encode_item() bytes (or JSON text in older rows);
+            # content_size is the uncompressed JSON size used for history budgets
+            _add_column_if_missing(cursor, "thread_items", "content_size", "INTEGER")
+            
+            # role/text hold project_item() so history can be built without decoding items
+            _add_column_if_missing(cursor, "thread_items", "role", "TEXT")
+            if _add_column_if_missing(cursor, "thread_items", "text", "TEXT"):
+                self._backfill_projection(cursor)
+            
+            # Covers per-thread scans in created_at order and the keyset cursor below
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_thread_items_thread_created
+                ON thread_items (thread_id, created_at, id)
+            """)
+            
+            # Copy of threads.owner so search can be scoped per user inside the full-text index
+            if _add_column_if_missing(cursor, "thread_items", "owner", "TEXT"):
+                cursor.execute("UPDATE thread_items SET owner = (SELECT owner FROM threads WHERE threads.id = thread_items.thread_id)")
+            # hex(owner) is a single token however the owner id is spelled
+            _add_column_if_missing(cursor, "thread_items", "owner_key", "TEXT GENERATED ALWAYS AS (hex(owner)) VIRTUAL")
+            self._create_search_index(cursor)
+            
+            # Space-separated digests of the blobs an item references. Rows hold one
+            # reference to each; when a row is deleted or replaced its digests are
+            # queued here for StoreMaintenance to release in the blob store
+            _add_column_if_missing(cursor, "thread_items", "blob_refs", "TEXT")
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS released_blobs (
+                    id INTEGER PRIMARY KEY,
+                    blob_refs TEXT NOT NULL
+                )
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS thread_items_blobs_delete AFTER DELETE ON thread_items
+                WHEN OLD.blob_refs IS NOT NULL BEGIN
+                    INSERT INTO released_blobs (blob_refs) VALUES (OLD.blob_refs);
+                END
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS thread_items_blobs_update AFTER UPDATE OF blob_refs ON thread_items
+                WHEN OLD.blob_refs IS NOT NULL BEGIN
+                    INSERT INTO released_blobs (blob_refs) VALUES (OLD.blob_refs);
+                END
+            """)
+            # Attachments of purged messages, queued in the transaction that deletes the
+            # messages and released by StoreMaintenance, so a crash in between leaks none
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS released_attachments (
+                    id INTEGER PRIMARY KEY,
+                    attachment_id TEXT NOT NULL
+                )
+            """)
+            
+            # Attachments table
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS attachments (
+                    id TEXT PRIMARY KEY,
+                    metadata TEXT,
+                    file_path TEXT,
+                    created_at TEXT
+                )
+            """)
+    
+    def _create_search_index(self, cursor: sqlite3.Cursor) -> None:
+        """
+        Create the FTS5 index over message text and the triggers that keep it in sync.
         
-        # Attachments table
+        It indexes the role/text projection straight from thread_items, so
+        nothing is decoded to search and the text is not stored twice. The
+        owner_key column is one token per user, so a user's matches are found
+        by intersecting two doclists instead of matching a phrase.
+        """
+        exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'thread_items_fts'").fetchone()
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS attachments (
-                id TEXT PRIMARY KEY,
-                metadata TEXT,
-                created_at TEXT
+            CREATE VIRTUAL TABLE IF NOT EXISTS thread_items_fts USING fts5(
+                text, owner_key,
+                content='thread_items', content_rowid='rowid',
+                tokenize='porter unicode61 remove_diacritics 2'
             )
         """)
-        
-        conn.commit()
-        conn.close()
+        if not exists:
+            cursor.execute("""
+                INSERT INTO thread_items_fts (rowid, text, owner_key)
+                SELECT rowid, text, owner_key FROM thread_items WHERE text IS NOT NULL
+            """)
+        # An external-content index has to be told the old values to remove, so
+        # rows are only ever changed through upserts (REPLACE skips delete triggers)
+        triggers = [
+            """
+            CREATE TRIGGER IF NOT EXISTS thread_items_fts_insert AFTER INSERT ON thread_items
+            WHEN NEW.text IS NOT NULL BEGIN
+                INSERT INTO thread_items_fts (rowid, text, owner_key) VALUES (NEW.rowid, NEW.text, NEW.owner_key);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS thread_items_fts_delete AFTER DELETE ON thread_items
+            WHEN OLD.text IS NOT NULL BEGIN
+                INSERT INTO thread_items_fts (thread_items_fts, rowid, text, owner_key) VALUES ('delete', OLD.rowid, OLD.text, OLD.owner_key);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS thread_items_fts_update AFTER UPDATE OF text, owner ON thread_items BEGIN
+                INSERT INTO thread_items_fts (thread_items_fts, rowid, text, owner_key)
+                SELECT 'delete', OLD.rowid, OLD.text, OLD.owner_key WHERE OLD.text IS NOT NULL;
+                INSERT INTO thread_items_fts (rowid, text, owner_key)
+                SELECT NEW.rowid, NEW.text, NEW.owner_key WHERE NEW.text IS NOT NULL;
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS threads_owner_update AFTER UPDATE OF owner ON threads
+            WHEN OLD.owner IS NOT NEW.owner BEGIN
+                UPDATE thread_items SET owner = NEW.owner WHERE thread_id = NEW.id;
+            END
+            """,
+        ]
+        for trigger in triggers:
+            cursor.execute(trigger)
+    
+    @staticmethod
+    def _drop_search_index(cursor: sqlite3.Cursor) -> None:
+        """Drop the FTS5 index and its triggers (bulk loads recreate them with _init_db)"""
+        for trigger in ("thread_items_fts_insert", "thread_items_fts_delete", "thread_items_fts_update", "threads_owner_update"):
+            cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        cursor.execute("DROP TABLE IF EXISTS thread_items_fts")
+    
+    def _backfill_projection(self, cursor: sqlite3.Cursor) -> None:
+        """Project message rows written before the role/text columns existed"""
+        rows = cursor.execute(
+            "SELECT id, content FROM thread_items WHERE item_type IN ('user_message', 'assistant_message')"
+        ).fetchall()
+        for item_id, content in rows:
+            try:
+                role, text = project_item(decode_item(content))
+            except Exception as e:
+                logger.warning("Could not project stored item %s: %s", item_id, e)
+                continue
+            cursor.execute("UPDATE thread_items SET role = ?, text = ? WHERE id = ?", (role, text, item_id))
+    
+    def close(self) -> None:
+        """Close the pooled database connections"""
+        self.connections.close()
     
     async def generate_thread_id(self, context: dict) -> str:
         """Generate a new thread ID"""
@@ -67,29 +646,86 @@ class SQLiteStore(Store[dict]):
         prefix = item_type.value if hasattr(item_type, 'value') else str(item_type)
         return f"{prefix}_{uuid.uuid4().hex[:16]}"
     
-    async def save_thread(self, thread: ThreadMetadata, context: dict) -> None:
-        """Save thread metadata"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT OR REPLACE INTO threads (id, metadata, created_at, updated_at)
-            VALUES (?, ?, ?, ?)
-        """, (
+    async def _write(self, thread_id: str, statements: list[Statement]) -> None:
+        """Run the write statements for one thread in a single transaction"""
+        def _execute(conn: sqlite3.Connection) -> None:
+            for sql, params in statements:
+                conn.execute(sql, params)
+        await self.connections.run_write(_execute)
+    
+    async def flush(self) -> None:
+        """Wait for pending writes to be committed (writes are synchronous here)"""
+    
+    def _save_thread_statements(self, thread: ThreadMetadata, context: dict) -> list[Statement]:
+        created_at = thread.created_at.isoformat() if hasattr(thread, 'created_at') and thread.created_at else None
+        updated_at = thread.updated_at.isoformat() if hasattr(thread, 'updated_at') and thread.updated_at else None
+        params = (
             thread.id,
+            context.get("user_id"),
             json.dumps(thread.metadata or {}),
-            thread.created_at.isoformat() if hasattr(thread, 'created_at') and thread.created_at else None,
-            thread.updated_at.isoformat() if hasattr(thread, 'updated_at') and thread.updated_at else None
-        ))
-        conn.commit()
-        conn.close()
+            created_at,
+            # Never leave the listing sort key empty
+            updated_at or created_at
+        )
+        # The owner is fixed by whoever created the thread
+        return [("""
+            INSERT INTO threads (id, owner, metadata, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                owner = COALESCE(threads.owner, excluded.owner),
+                metadata = excluded.metadata,
+                created_at = excluded.created_at,
+                updated_at = excluded.updated_at
+        """, params)]
+    
+    def _save_item_statements(self, thread_id: str, item: ThreadItem, data: bytes, blob_refs: str | None = None) -> list[Statement]:
+        content, content_size = encode_item_json(data)
+        # Projected from the stored JSON when images were moved out, so no base64 reaches the search index
+        role, text = project_item(json.loads(data) if blob_refs else item)
+        params = (
+            item.id,
+            thread_id,
+            item.type,
+            content,
+            content_size,
+            role,
+            text,
+            item.created_at.isoformat() if hasattr(item, 'created_at') and item.created_at else None,
+            blob_refs
+        )
+        # An upsert rather than INSERT OR REPLACE, so the search index and blob triggers see the update
+        return [("""
+            INSERT INTO thread_items (id, thread_id, item_type, content, content_size, role, text, created_at, blob_refs, owner)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, (SELECT owner FROM threads WHERE id = ?2))
+            ON CONFLICT(id) DO UPDATE SET
+                thread_id = excluded.thread_id,
+                item_type = excluded.item_type,
+                content = excluded.content,
+                content_size = excluded.content_size,
+                role = excluded.role,
+                text = excluded.text,
+                created_at = excluded.created_at,
+                blob_refs = excluded.blob_refs,
+                owner = excluded.owner
+        """, params)]
+    
+    def _delete_thread_statements(self, thread_id: str) -> list[Statement]:
+        from datetime import datetime
+        # A tombstone: one row update however long the thread is
+        return [("UPDATE threads SET deleted_at = ? WHERE id = ? AND deleted_at IS NULL", (datetime.now().isoformat(), thread_id))]
+    
+    def _delete_thread_item_statements(self, thread_id: str, item_id: str) -> list[Statement]:
+        return [("DELETE FROM thread_items WHERE id = ? AND thread_id = ?", (item_id, thread_id))]
+    
+    async def save_thread(self, thread: ThreadMetadata, context: dict) -> None:
+        """Save thread metadata"""
+        await self._write(thread.id, self._save_thread_statements(thread, context))
     
     async def load_thread(self, thread_id: str, context: dict) -> ThreadMetadata:
         """Load thread metadata"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, metadata, created_at, updated_at FROM threads WHERE id = ?", (thread_id,))
-        row = cursor.fetchone()
-        conn.close()
+        row = await self.connections.run_read(
+            lambda conn: conn.execute("SELECT id, metadata, created_at, updated_at FROM threads WHERE id = ? AND deleted_at IS NULL", (thread_id,)).fetchone()
+        )
         
         if not row:
             raise ValueError(f"Thread {thread_id} not found")
@@ -103,102 +739,244 @@ class SQLiteStore(Store[dict]):
         )
     
     async def load_threads(self, context: dict, limit: int = 100, after: str | None = None) -> list[ThreadMetadata]:
-        """Load threads"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        query = "SELECT id, metadata, created_at, updated_at FROM threads ORDER BY updated_at DESC LIMIT ?"
-        params = [limit]
-        if after:
-            query = "SELECT id, metadata, created_at, updated_at FROM threads WHERE id > ? ORDER BY updated_at DESC LIMIT ?"
-            params = [after, limit]
-        
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
+        """Load the current user's threads, most recently updated first"""
+        rows = await self._load_thread_rows(context.get("user_id"), limit, after=after)
+        return [self._thread_from_row(row) for row in rows]
+    
+    async def _load_thread_rows(
+        self,
+        owner: str | None,
+        limit: int,
+        after: str | None = None,
+        before: tuple[str, str] | None = None,
+    ) -> list[tuple]:
+        """
+        Select (id, metadata, created_at, updated_at) rows of owner's threads, newest first.
         
+        after is a thread id in this database; before is an (updated_at, id)
+        position, which may come from another database.
+        """
+        query = "SELECT id, metadata, created_at, updated_at FROM threads WHERE owner IS ? AND deleted_at IS NULL"
+        params = [owner]
+        if after:
+            # Keyset cursor: seek past the (updated_at, id) position of the `after` thread
+            query += " AND (updated_at, id) < (SELECT updated_at, id FROM threads WHERE id = ? AND owner IS ?)"
+            params += [after, owner]
+        elif before:
+            query += " AND (updated_at, id) < (?, ?)"
+            params += list(before)
+        query += " ORDER BY updated_at DESC, id DESC LIMIT ?"
+        params.append(limit)
+        return await self.connections.run_read(lambda conn: conn.execute(query, params).fetchall())
+    
+    async def _thread_position(self, thread_id: str, owner: str | None) -> tuple[str, str] | None:
+        """The (updated_at, id) listing position of one of owner's threads"""
+        return await self.connections.run_read(
+            lambda conn: conn.execute("SELECT updated_at, id FROM threads WHERE id = ? AND owner IS ? AND deleted_at IS NULL", (thread_id, owner)).fetchone()
+        )
+    
+    @staticmethod
+    def _thread_from_row(row: tuple) -> ThreadMetadata:
         from datetime import datetime
-        return [
-            ThreadMetadata(
-                id=row[0],
-                metadata=json.loads(row[1]) if row[1] else {},
-                created_at=datetime.fromisoformat(row[2]) if row[2] else None,
-                updated_at=datetime.fromisoformat(row[3]) if row[3] else None
-            )
-            for row in rows
-        ]
+        return ThreadMetadata(
+            id=row[0],
+            metadata=json.loads(row[1]) if row[1] else {},
+            created_at=datetime.fromisoformat(row[2]) if row[2] else None,
+            updated_at=datetime.fromisoformat(row[3]) if row[3] else None
+        )
     
     async def delete_thread(self, thread_id: str, context: dict) -> None:
-        """Delete a thread"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM thread_items WHERE thread_id = ?", (thread_id,))
-        cursor.execute("DELETE FROM threads WHERE id = ?", (thread_id,))
-        conn.commit()
-        conn.close()
+        """
+        Delete a thread.
+        
+        The thread is tombstoned and disappears from every read at once; its
+        items and their attachments are removed in small background batches by
+        StoreMaintenance.purge_deleted_threads.
+        """
+        await self._write(thread_id, self._delete_thread_statements(thread_id))
     
     async def save_item(self, thread_id: str, item: ThreadItem, context: dict) -> None:
-        """Save a thread item"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT OR REPLACE INTO thread_items (id, thread_id, item_type, content, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (
-            item.id,
-            thread_id,
-            item.type,
-            json.dumps(item.model_dump() if hasattr(item, 'model_dump') else item.dict()),
-            item.created_at.isoformat() if hasattr(item, 'created_at') and item.created_at else None
-        ))
-        conn.commit()
-        conn.close()
+        """Save a thread item, moving large inline images into the blob store"""
+        data = _thread_item_adapter.dump_json(item)
+        blob_refs = None
+        if self.blob_store is not None:
+            data, blobs = externalize_blobs(data, self.inline_blob_min_bytes)
+            # The row's references are taken before it is written; if the write is lost
+            # the blob is kept too long, never removed while still referenced
+            for payload in blobs.values():
+                await self.blob_store.save_blob(payload)
+            blob_refs = " ".join(blobs) or None
+        await self._write(thread_id, self._save_item_statements(thread_id, item, data, blob_refs))
+    
+    async def rehydrate_item(self, item: ThreadItem) -> ThreadItem:
+        """The item with its chatkit-blob: references replaced by the original image data URLs"""
+        data = _thread_item_adapter.dump_json(item)
+        digests = blob_ref_digests(data)
+        if not digests or self.blob_store is None:
+            return item
+        return _thread_item_adapter.validate_json(rehydrate_blobs(data, await self._load_blobs(digests)))
+    
+    async def _load_blobs(self, digests: list[str]) -> dict[str, bytes]:
+        """The contents of the given blobs, read in one trip off the event loop, skipping any whose file is gone"""
+        def _read_all() -> dict[str, bytes]:
+            blobs = {}
+            for sha256 in digests:
+                try:
+                    blobs[sha256] = self.blob_store.read_blob(sha256)
+                except FileNotFoundError:
+                    logger.warning("Blob %s referenced by a stored item is missing", sha256)
+            return blobs
+        return await asyncio.to_thread(_read_all)
+    
+    async def _decode_for_client(self, rows: list[tuple[bytes | str, str | None]]) -> list[ThreadItem]:
+        """Decode (content, blob_refs) rows with their images back as data URLs, reading each blob once"""
+        digests = list(dict.fromkeys(sha256 for _, blob_refs in rows if blob_refs for sha256 in blob_refs.split()))
+        if not digests or self.blob_store is None:
+            return [decode_item(content) for content, _ in rows]
+        blobs = await self._load_blobs(digests)
+        return [
+            _thread_item_adapter.validate_json(rehydrate_blobs(decode_item_json(content), blobs)) if blob_refs else decode_item(content)
+            for content, blob_refs in rows
+        ]
+    
+    async def thread_has_blob(self, thread_id: str, sha256: str, context: dict) -> bool:
+        """Whether a live thread of the calling user has an item that refers to a blob"""
+        row = await self.connections.run_read(
+            lambda conn: conn.execute("""
+                SELECT 1 FROM thread_items JOIN threads ON threads.id = thread_items.thread_id
+                WHERE thread_items.thread_id = ? AND threads.owner IS ? AND threads.deleted_at IS NULL
+                  AND instr(' ' || thread_items.blob_refs || ' ', ' ' || ? || ' ') > 0
+                LIMIT 1
+            """, (thread_id, context.get("user_id"), sha256)).fetchone()
+        )
+        return row is not None
     
     async def load_item(self, thread_id: str, item_id: str, context: dict) -> ThreadItem:
         """Load a thread item"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, item_type, content FROM thread_items WHERE id = ? AND thread_id = ?", (item_id, thread_id))
-        row = cursor.fetchone()
-        conn.close()
+        row = await self.connections.run_read(lambda conn: conn.execute(
+            f"SELECT content, blob_refs FROM thread_items WHERE id = ? AND thread_id = ? AND {_LIVE_THREAD}", (item_id, thread_id, thread_id)
+        ).fetchone())
         
         if not row:
             raise ValueError(f"Item {item_id} not found in thread {thread_id}")
         
         # Reconstruct ThreadItem from JSON
-        item_data = json.loads(row[2])
-        # This is a simplified version - you may need to reconstruct based on item_type
-        from chatkit.types import ThreadItem
-        return ThreadItem(**item_data)
+        return (await self._decode_for_client([row]))[0]
     
     async def load_thread_items(self, thread_id: str, context: dict, limit: int = 100, after: str | None = None) -> list[ThreadItem]:
         """Load thread items"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        query = "SELECT id, item_type, content FROM thread_items WHERE thread_id = ? ORDER BY created_at ASC LIMIT ?"
-        params = [thread_id, limit]
+        query = f"SELECT content, blob_refs FROM thread_items WHERE thread_id = ? AND {_LIVE_THREAD} ORDER BY created_at ASC, id ASC LIMIT ?"
+        params = [thread_id, thread_id, limit]
         if after:
-            query = "SELECT id, item_type, content FROM thread_items WHERE thread_id = ? AND id > ? ORDER BY created_at ASC LIMIT ?"
-            params = [thread_id, after, limit]
+            # Keyset cursor: seek past the (created_at, id) position of the `after` item
+            query = f"""
+                SELECT content, blob_refs FROM thread_items
+                WHERE thread_id = ? AND {_LIVE_THREAD}
+                  AND (created_at, id) > (SELECT created_at, id FROM thread_items WHERE id = ? AND thread_id = ?)
+                ORDER BY created_at ASC, id ASC LIMIT ?
+            """
+            params = [thread_id, thread_id, after, thread_id, limit]
         
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        conn.close()
+        rows = await self.connections.run_read(lambda conn: conn.execute(query, params).fetchall())
+        
+        return await self._decode_for_client(rows)
+    
+    async def load_recent_thread_items(self, thread_id: str, context: dict, limit: int = 50, max_bytes: int | None = None) -> list[ThreadItem]:
+        """
+        Load the most recent items of a thread, oldest first.
         
-        items = []
-        for row in rows:
-            item_data = json.loads(row[2])
-            from chatkit.types import ThreadItem
-            items.append(ThreadItem(**item_data))
+        Walks the thread index backwards, so the cost depends on the window size
+        rather than the thread length. With max_bytes, stops once the items' JSON
+        size would exceed the budget (the newest item is always included).
+        """
+        def _select(conn: sqlite3.Connection) -> list[tuple[bytes | str, str | None]]:
+            cursor = conn.execute(f"""
+                SELECT content, blob_refs, COALESCE(content_size, length(content)) FROM thread_items
+                WHERE thread_id = ? AND {_LIVE_THREAD}
+                ORDER BY created_at DESC, id DESC LIMIT ?
+            """, (thread_id, thread_id, limit))
+            rows = []
+            total = 0
+            for content, blob_refs, size in cursor:
+                total += size or 0
+                if max_bytes is not None and rows and total > max_bytes:
+                    break
+                rows.append((content, blob_refs))
+            return rows
         
-        return items
+        rows = await self.connections.run_read(_select)
+        return await self._decode_for_client(rows[::-1])
+    
+    async def load_conversation_history(self, thread_id: str, context: dict, limit: int = 50, max_bytes: int | None = None) -> list[dict]:
+        """
+        Load model-ready history for the most recent messages of a thread, oldest first.
+        
+        Reads the role/text projection saved with each message, so no items are
+        decoded. Same window and byte budget rules as load_recent_thread_items.
+        """
+        def _select(conn: sqlite3.Connection) -> list[tuple[str, str]]:
+            cursor = conn.execute(f"""
+                SELECT role, text FROM thread_items
+                WHERE thread_id = ? AND role IS NOT NULL AND {_LIVE_THREAD}
+                ORDER BY created_at DESC, id DESC LIMIT ?
+            """, (thread_id, thread_id, limit))
+            messages = []
+            total = 0
+            for role, text in cursor:
+                total += len(text)
+                if max_bytes is not None and messages and total > max_bytes:
+                    break
+                messages.append((role, text))
+            return messages
+        
+        messages = await self.connections.run_read(_select)
+        return [history_message(role, text) for role, text in reversed(messages)]
     
     async def delete_thread_item(self, thread_id: str, item_id: str, context: dict) -> None:
         """Delete a thread item"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM thread_items WHERE id = ? AND thread_id = ?", (item_id, thread_id))
-        conn.commit()
-        conn.close()
+        await self._write(thread_id, self._delete_thread_item_statements(thread_id, item_id))
+    
+    async def search_items(self, context: dict, query: str, limit: int = 20, offset: int = 0) -> list[dict]:
+        """
+        Ranked full-text search over the current user's messages and critiques.
+        
+        Returns dicts with item_id, thread_id, role, created_at, a snippet with
+        matches wrapped in ** and score (higher is better), best first. The
+        user's SEARCH_CANDIDATES most recent matches are ranked, so the cost
+        does not grow with the table or with how common a word is.
+        """
+        match = fts_match_query(query)
+        if match is None:
+            return []
+        owner = context.get("user_id")
+        if owner is not None:
+            # Narrow to the owner's token inside the index (owner_key is SQLite's
+            # hex(owner)); the join below checks the exact owner
+            match = f'owner_key : {owner.encode("utf-8").hex().upper()} AND text : ({match})'
+        else:
+            match = f"text : ({match})"
+        
+        def _select(conn: sqlite3.Connection) -> list[tuple]:
+            candidates = conn.execute("""
+                SELECT thread_items.rowid, thread_items.id, thread_items.thread_id, thread_items.role, thread_items.created_at,
+                       highlight(thread_items_fts, 0, char(2), char(3))
+                FROM thread_items_fts
+                JOIN thread_items ON thread_items.rowid = thread_items_fts.rowid
+                WHERE thread_items_fts MATCH ? AND thread_items.owner IS ?
+                  AND NOT EXISTS (SELECT 1 FROM threads WHERE threads.id = thread_items.thread_id AND threads.deleted_at IS NOT NULL)
+                ORDER BY thread_items_fts.rowid DESC LIMIT ?
+            """, (match, owner, SEARCH_CANDIDATES)).fetchall()
+            scores = score_search_hits([row[5] for row in candidates])
+            # Stable, so equal scores stay newest first
+            ranked = sorted(zip(scores, candidates), key=lambda pair: pair[0], reverse=True)[offset:offset + limit]
+            # Built here rather than with snippet(), which would run the MATCH again per row
+            return [(*row[1:5], search_snippet(row[5]), score) for score, row in ranked]
+        
+        rows = await self.connections.run_read(_select)
+        return [
+            {"item_id": item_id, "thread_id": thread_id, "role": role, "created_at": created_at, "snippet": snippet, "score": score}
+            for item_id, thread_id, role, created_at, snippet, score in rows
+        ]
     
     async def add_thread_item(self, thread_id: str, item: ThreadItem, context: dict) -> None:
         """Add a new thread item"""
@@ -219,89 +997,789 @@ class SQLiteStore(Store[dict]):
         raise NotImplementedError("Use AttachmentStore for attachments")
 
 
+class WriteBehindSQLiteStore(SQLiteStore):
+    """
+    SQLiteStore that queues thread writes and group-commits them.
+    
+    Writes return as soon as they are queued. A background task commits everything
+    queued within max_delay_ms in one transaction, so concurrent requests share a
+    single fsync. Reads of a thread with queued writes wait for them to commit
+    (read-your-writes), and flush() drains the queue on shutdown.
+    """
+    
+    def __init__(
+        self,
+        db_path: str = "./chatkit_data/chatkit.db",
+        connections: SQLiteConnectionManager | None = None,
+        max_delay_ms: float = 5.0,
+        max_batch: int = 1000,
+        blob_store: "SQLiteAttachmentStore | None" = None,
+    ):
+        super().__init__(db_path, connections, blob_store)
+        self.max_delay = max_delay_ms / 1000
+        self.max_batch = max_batch
+        self._batch: list[list[Statement]] = []
+        self._batch_threads: set[str] = set()
+        self._batch_done: asyncio.Future | None = None
+        self._inflight_threads: set[str] = set()
+        self._inflight_done: asyncio.Future | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._urgent: asyncio.Event | None = None
+        self._flusher: asyncio.Task | None = None
+        # Writes that failed even on their own; flush() raises the first one not yet reported
+        self.dropped_writes = 0
+        self._write_error: Exception | None = None
+    
+    def _ensure_flusher(self) -> None:
+        """Start the background commit task on first use (it needs a running loop)"""
+        if self._flusher is None or self._flusher.done():
+            self._wakeup = asyncio.Event()
+            self._urgent = asyncio.Event()
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_loop())
+        if self._batch_done is None:
+            self._batch_done = asyncio.get_running_loop().create_future()
+    
+    async def _write(self, thread_id: str, statements: list[Statement]) -> None:
+        """Queue the statements for the next group commit"""
+        self._ensure_flusher()
+        if len(self._batch) >= self.max_batch:
+            # Backpressure: a full batch is committed before more writes are accepted
+            await self._commit_now(self._batch_done)
+            self._ensure_flusher()
+        self._batch.append(statements)
+        self._batch_threads.add(thread_id)
+        self._wakeup.set()
+    
+    async def _flush_loop(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            # Give concurrent requests a short window to join this batch
+            if not self._urgent.is_set():
+                try:
+                    await asyncio.wait_for(self._urgent.wait(), self.max_delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+            self._urgent.clear()
+            await self._commit_batch()
+    
+    async def _commit_batch(self) -> None:
+        """Commit the current batch in one transaction"""
+        if not self._batch:
+            return
+        batch, done = self._batch, self._batch_done
+        self._inflight_threads, self._inflight_done = self._batch_threads, done
+        self._batch, self._batch_threads = [], set()
+        self._batch_done = asyncio.get_running_loop().create_future()
+        
+        def _execute(conn: sqlite3.Connection) -> None:
+            for statements in batch:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+        
+        try:
+            await self.connections.run_write(_execute)
+        except Exception as e:
+            # One bad write must not take the rest of the batch down with it
+            logger.warning("Group commit failed, retrying writes one by one: %s", e)
+            for statements in batch:
+                try:
+                    await super()._write("", statements)
+                except Exception as write_error:
+                    logger.error("Dropped a queued write: %s", write_error)
+                    self.dropped_writes += 1
+                    if self._write_error is None:
+                        self._write_error = write_error
+        finally:
+            self._inflight_threads, self._inflight_done = set(), None
+            done.set_result(None)
+    
+    async def _commit_now(self, done: asyncio.Future | None) -> None:
+        """Ask the flusher to commit immediately and wait for the given batch"""
+        if done is None or done.done():
+            return
+        self._urgent.set()
+        self._wakeup.set()
+        await asyncio.shield(done)
+    
+    async def _wait_for_thread(self, thread_id: str) -> None:
+        """Read barrier: wait until queued writes for the thread are committed"""
+        if thread_id in self._inflight_threads:
+            await asyncio.shield(self._inflight_done)
+        if thread_id in self._batch_threads:
+            await self._commit_now(self._batch_done)
+    
+    def _raise_write_error(self) -> None:
+        """Raise the first dropped write since the last flush, if any"""
+        if self._write_error is not None:
+            error, self._write_error = self._write_error, None
+            raise RuntimeError(f"Queued writes were dropped ({self.dropped_writes} so far): {error}") from error
+    
+    async def flush(self) -> None:
+        """Commit everything queued so far, raising if any queued write was dropped"""
+        if self._inflight_done is not None:
+            await asyncio.shield(self._inflight_done)
+        if self._batch:
+            await self._commit_now(self._batch_done)
+        self._raise_write_error()
+    
+    async def aclose(self) -> None:
+        """Flush queued writes, stop the flusher and close the connections"""
+        try:
+            await self.flush()
+        finally:
+            if self._flusher is not None:
+                self._flusher.cancel()
+                try:
+                    await self._flusher
+                except asyncio.CancelledError:
+                    pass
+            self.close()
+    
+    def close(self) -> None:
+        """Close the connections, raising if a dropped write was never reported"""
+        super().close()
+        self._raise_write_error()
+    
+    async def load_thread(self, thread_id: str, context: dict) -> ThreadMetadata:
+        await self._wait_for_thread(thread_id)
+        return await super().load_thread(thread_id, context)
+    
+    async def _load_thread_rows(
+        self,
+        owner: str | None,
+        limit: int,
+        after: str | None = None,
+        before: tuple[str, str] | None = None,
+    ) -> list[tuple]:
+        # Listings span every thread, so everything queued has to be committed first
+        await self.flush()
+        return await super()._load_thread_rows(owner, limit, after, before)
+    
+    async def _thread_position(self, thread_id: str, owner: str | None) -> tuple[str, str] | None:
+        await self._wait_for_thread(thread_id)
+        return await super()._thread_position(thread_id, owner)
+    
+    async def search_items(self, context: dict, query: str, limit: int = 20, offset: int = 0) -> list[dict]:
+        await self.flush()
+        return await super().search_items(context, query, limit, offset)
+    
+    async def load_item(self, thread_id: str, item_id: str, context: dict) -> ThreadItem:
+        await self._wait_for_thread(thread_id)
+        return await super().load_item(thread_id, item_id, context)
+    
+    async def thread_has_blob(self, thread_id: str, sha256: str, context: dict) -> bool:
+        await self._wait_for_thread(thread_id)
+        return await super().thread_has_blob(thread_id, sha256, context)
+    
+    async def load_thread_items(self, thread_id: str, context: dict, limit: int = 100, after: str | None = None) -> list[ThreadItem]:
+        await self._wait_for_thread(thread_id)
+        return await super().load_thread_items(thread_id, context, limit, after)
+    
+    async def load_recent_thread_items(self, thread_id: str, context: dict, limit: int = 50, max_bytes: int | None = None) -> list[ThreadItem]:
+        await self._wait_for_thread(thread_id)
+        return await super().load_recent_thread_items(thread_id, context, limit, max_bytes)
+    
+    async def load_conversation_history(self, thread_id: str, context: dict, limit: int = 50, max_bytes: int | None = None) -> list[dict]:
+        await self._wait_for_thread(thread_id)
+        return await super().load_conversation_history(thread_id, context, limit, max_bytes)
+
+
+class ShardedSQLiteStore(Store[dict]):
+    """
+    Store that spreads threads across several SQLite files by hashed thread id.
+    
+    Every shard is a SQLiteStore (or WriteBehindSQLiteStore) with its own
+    connection pool and writer, so writes to different shards never wait on
+    each other. A thread and all its items live in one shard; listing a user's
+    threads queries every shard and k-way merges the results. Use
+    reshard_chatkit_store.py to move data to a different shard count.
+    """
+    
+    def __init__(self, db_paths: list[str], write_behind_ms: float | None = None, blob_store: "SQLiteAttachmentStore | None" = None):
+        if not db_paths:
+            raise ValueError("ShardedSQLiteStore needs at least one shard")
+        if write_behind_ms:
+            self.shards: list[SQLiteStore] = [
+                WriteBehindSQLiteStore(path, max_delay_ms=write_behind_ms, blob_store=blob_store) for path in db_paths
+            ]
+        else:
+            self.shards = [SQLiteStore(path, blob_store=blob_store) for path in db_paths]
+    
+    def shard_for(self, key: str) -> SQLiteStore:
+        """The shard that owns a thread (or attachment) id"""
+        return self.shards[shard_index(key, len(self.shards))]
+    
+    def close(self) -> None:
+        """Close every shard's connections"""
+        errors = []
+        for shard in self.shards:
+            try:
+                shard.close()
+            except RuntimeError as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+    
+    async def flush(self) -> None:
+        """Wait for pending writes on every shard"""
+        await asyncio.gather(*(shard.flush() for shard in self.shards))
+    
+    @property
+    def dropped_writes(self) -> int:
+        return sum(getattr(shard, "dropped_writes", 0) for shard in self.shards)
+    
+    async def generate_thread_id(self, context: dict) -> str:
+        return await self.shards[0].generate_thread_id(context)
+    
+    def generate_item_id(self, item_type: StoreItemType, thread: ThreadMetadata, context: dict) -> str:
+        return self.shards[0].generate_item_id(item_type, thread, context)
+    
+    async def save_thread(self, thread: ThreadMetadata, context: dict) -> None:
+        await self.shard_for(thread.id).save_thread(thread, context)
+    
+    async def load_thread(self, thread_id: str, context: dict) -> ThreadMetadata:
+        return await self.shard_for(thread_id).load_thread(thread_id, context)
+    
+    async def load_threads(self, context: dict, limit: int = 100, after: str | None = None) -> list[ThreadMetadata]:
+        """Load the current user's threads from every shard, most recently updated first"""
+        owner = context.get("user_id")
+        before = None
+        if after:
+            # The cursor thread lives in one shard; its position applies to all of them
+            before = await self.shard_for(after)._thread_position(after, owner)
+            if before is None:
+                return []
+        # Each shard returns up to limit rows in listing order; merging them and
+        # keeping the first limit gives the same page a single database would
+        shard_rows = await asyncio.gather(*(shard._load_thread_rows(owner, limit, before=before) for shard in self.shards))
+        merged = heapq.merge(*shard_rows, key=lambda row: (row[3] or "", row[0]), reverse=True)
+        return [SQLiteStore._thread_from_row(row) for row in itertools.islice(merged, limit)]
+    
+    async def delete_thread(self, thread_id: str, context: dict) -> None:
+        await self.shard_for(thread_id).delete_thread(thread_id, context)
+    
+    async def save_item(self, thread_id: str, item: ThreadItem, context: dict) -> None:
+        await self.shard_for(thread_id).save_item(thread_id, item, context)
+    
+    async def add_thread_item(self, thread_id: str, item: ThreadItem, context: dict) -> None:
+        await self.shard_for(thread_id).add_thread_item(thread_id, item, context)
+    
+    async def load_item(self, thread_id: str, item_id: str, context: dict) -> ThreadItem:
+        return await self.shard_for(thread_id).load_item(thread_id, item_id, context)
+    
+    async def thread_has_blob(self, thread_id: str, sha256: str, context: dict) -> bool:
+        return await self.shard_for(thread_id).thread_has_blob(thread_id, sha256, context)
+    
+    async def load_thread_items(self, thread_id: str, context: dict, limit: int = 100, after: str | None = None) -> list[ThreadItem]:
+        return await self.shard_for(thread_id).load_thread_items(thread_id, context, limit, after)
+    
+    async def load_recent_thread_items(self, thread_id: str, context: dict, limit: int = 50, max_bytes: int | None = None) -> list[ThreadItem]:
+        return await self.shard_for(thread_id).load_recent_thread_items(thread_id, context, limit, max_bytes)
+    
+    async def load_conversation_history(self, thread_id: str, context: dict, limit: int = 50, max_bytes: int | None = None) -> list[dict]:
+        return await self.shard_for(thread_id).load_conversation_history(thread_id, context, limit, max_bytes)
+    
+    async def delete_thread_item(self, thread_id: str, item_id: str, context: dict) -> None:
+        await self.shard_for(thread_id).delete_thread_item(thread_id, item_id, context)
+    
+    async def rehydrate_item(self, item: ThreadItem) -> ThreadItem:
+        """The item with its image data URLs put back (every shard shares one blob store)"""
+        return await self.shards[0].rehydrate_item(item)
+    
+    async def search_items(self, context: dict, query: str, limit: int = 20, offset: int = 0) -> list[dict]:
+        """Search every shard and merge by score (average lengths are per shard, so scores are close, not exact)"""
+        shard_results = await asyncio.gather(*(shard.search_items(context, query, limit + offset) for shard in self.shards))
+        merged = heapq.merge(*shard_results, key=lambda result: result["score"], reverse=True)
+        return list(itertools.islice(merged, offset, offset + limit))
+    
+    async def save_attachment(self, attachment: Attachment, context: dict) -> None:
+        await self.shard_for(attachment.id).save_attachment(attachment, context)
+    
+    async def load_attachment(self, attachment_id: str, context: dict) -> Attachment:
+        return await self.shard_for(attachment_id).load_attachment(attachment_id, context)
+    
+    async def delete_attachment(self, attachment_id: str, context: dict) -> None:
+        await self.shard_for(attachment_id).delete_attachment(attachment_id, context)
+
+
+class CachedStore(Store[dict]):
+    """
+    Size-bounded LRU cache in front of any Store.
+    
+    Caches thread metadata, single items, item windows (pages and recent-history
+    windows) and projected conversation history per thread. Writes go through to the wrapped store and then invalidate
+    that thread's cached windows, so reads never see data older than the last write.
+    """
+    
+    def __init__(self, inner: Store[dict], max_entries: int = 1024):
+        self.inner = inner
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, Any] = OrderedDict()
+        self._keys_by_thread: dict[str, set[tuple]] = {}
+        # Bumped on every write so a load that raced with a write is not cached
+        self._versions: dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def __getattr__(self, name: str) -> Any:
+        # Anything the cache does not wrap (flush, close, connections, ...) goes to the inner store
+        if name == "inner":
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+    
+    def stats(self) -> dict:
+        """Hit/miss/eviction counters for sizing the cache"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+    
+    def _get(self, key: tuple) -> Any:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return None
+    
+    def _put(self, thread_id: str, key: tuple, value: Any, version: int) -> None:
+        if self.max_entries <= 0 or self._versions.get(thread_id, 0) != version:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        self._keys_by_thread.setdefault(thread_id, set()).add(key)
+        while len(self._entries) > self.max_entries:
+            old_key, _ = self._entries.popitem(last=False)
+            self._discard_key(old_key)
+            self.evictions += 1
+    
+    def _discard_key(self, key: tuple) -> None:
+        keys = self._keys_by_thread.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_thread[key[1]]
+    
+    def _invalidate(self, thread_id: str, kinds: tuple[str, ...] | None = None) -> None:
+        """Drop cached entries for a thread (all of them, or only the given kinds)"""
+        self._versions[thread_id] = self._versions.get(thread_id, 0) + 1
+        for key in list(self._keys_by_thread.get(thread_id, ())):
+            if kinds is None or key[0] in kinds:
+                del self._entries[key]
+                self._discard_key(key)
+                self.invalidations += 1
+    
+    def invalidate_threads(self, thread_ids: list[str]) -> None:
+        """Drop everything cached for threads changed behind the store's back (e.g. expired by maintenance)"""
+        for thread_id in thread_ids:
+            self._invalidate(thread_id)
+    
+    def generate_thread_id(self, context: dict):
+        return self.inner.generate_thread_id(context)
+    
+    def generate_item_id(self, item_type: StoreItemType, thread: ThreadMetadata, context: dict) -> str:
+        return self.inner.generate_item_id(item_type, thread, context)
+    
+    async def load_thread(self, thread_id: str, context: dict) -> ThreadMetadata:
+        """Load thread metadata"""
+        key = ("thread", thread_id)
+        cached = self._get(key)
+        if cached is None:
+            version = self._versions.get(thread_id, 0)
+            cached = await self.inner.load_thread(thread_id, context)
+            self._put(thread_id, key, cached, version)
+        # Callers edit thread metadata in place before saving it, so hand out copies
+        return cached.model_copy(deep=True)
+    
+    async def save_thread(self, thread: ThreadMetadata, context: dict) -> None:
+        """Save thread metadata"""
+        await self.inner.save_thread(thread, context)
+        self._invalidate(thread.id, ("thread",))
+    
+    async def load_threads(self, context: dict, limit: int = 100, after: str | None = None) -> list[ThreadMetadata]:
+        """Load threads (not cached; listings are per user and change on every save)"""
+        return await self.inner.load_threads(context, limit, after)
+    
+    async def load_item(self, thread_id: str, item_id: str, context: dict) -> ThreadItem:
+        """Load a thread item"""
+        key = ("item", thread_id, item_id)
+        cached = self._get(key)
+        if cached is None:
+            version = self._versions.get(thread_id, 0)
+            cached = await self.inner.load_item(thread_id, item_id, context)
+            self._put(thread_id, key, cached, version)
+        # Items are pydantic models a caller may edit; the cached one is shared by every later reader
+        return cached.model_copy(deep=True)
+    
+    async def load_thread_items(self, thread_id: str, context: dict, limit: int = 100, after: str | None = None) -> list[ThreadItem]:
+        """Load thread items"""
+        key = ("items", thread_id, limit, after)
+        cached = self._get(key)
+        if cached is None:
+            version = self._versions.get(thread_id, 0)
+            cached = await self.inner.load_thread_items(thread_id, context, limit, after)
+            self._put(thread_id, key, cached, version)
+        return [item.model_copy(deep=True) for item in cached]
+    
+    async def load_recent_thread_items(self, thread_id: str, context: dict, limit: int = 50, max_bytes: int | None = None) -> list[ThreadItem]:
+        """Load the most recent items of a thread, oldest first"""
+        key = ("recent", thread_id, limit, max_bytes)
+        cached = self._get(key)
+        if cached is None:
+            version = self._versions.get(thread_id, 0)
+            cached = await self.inner.load_recent_thread_items(thread_id, context, limit, max_bytes)
+            self._put(thread_id, key, cached, version)
+        return [item.model_copy(deep=True) for item in cached]
+    
+    async def load_conversation_history(self, thread_id: str, context: dict, limit: int = 50, max_bytes: int | None = None) -> list[dict]:
+        """Load model-ready history for the most recent messages of a thread"""
+        key = ("history", thread_id, limit, max_bytes)
+        cached = self._get(key)
+        if cached is None:
+            version = self._versions.get(thread_id, 0)
+            cached = await self.inner.load_conversation_history(thread_id, context, limit, max_bytes)
+            self._put(thread_id, key, cached, version)
+        # The workflow appends to history messages, so hand out copies
+        return [{"role": m["role"], "content": [dict(c) for c in m["content"]]} for m in cached]
+    
+    async def save_item(self, thread_id: str, item: ThreadItem, context: dict) -> None:
+        """Save a thread item"""
+        await self.inner.save_item(thread_id, item, context)
+        self._invalidate(thread_id, ("item", "items", "recent", "history"))
+    
+    async def add_thread_item(self, thread_id: str, item: ThreadItem, context: dict) -> None:
+        """Add a new thread item"""
+        await self.inner.add_thread_item(thread_id, item, context)
+        self._invalidate(thread_id, ("item", "items", "recent", "history"))
+    
+    async def delete_thread_item(self, thread_id: str, item_id: str, context: dict) -> None:
+        """Delete a thread item"""
+        await self.inner.delete_thread_item(thread_id, item_id, context)
+        self._invalidate(thread_id, ("item", "items", "recent", "history"))
+    
+    async def delete_thread(self, thread_id: str, context: dict) -> None:
+        """Delete a thread"""
+        await self.inner.delete_thread(thread_id, context)
+        self._invalidate(thread_id)
+    
+    async def save_attachment(self, attachment: Attachment, context: dict) -> None:
+        await self.inner.save_attachment(attachment, context)
+    
+    async def load_attachment(self, attachment_id: str, context: dict) -> Attachment:
+        return await self.inner.load_attachment(attachment_id, context)
+    
+    async def delete_attachment(self, attachment_id: str, context: dict) -> None:
+        await self.inner.delete_attachment(attachment_id, context)
+
+
+async def stream_to_temp(content: Any, tmp_path: str, chunk_size: int) -> tuple[str, str, int]:
+    """
+    Write content to a temp file in chunks, hashing as it goes.
+    
+    Accepts bytes, str, a binary file-like object or an (async) iterable of
+    byte chunks. Returns (temp path, sha256 hex digest, size).
+    """
+    import uuid
+    
+    tmp_file = os.path.join(tmp_path, f"upload_{uuid.uuid4().hex}")
+    digest = hashlib.sha256()
+    size = 0
+    f = await asyncio.to_thread(open, tmp_file, 'wb')
+    try:
+        if isinstance(content, str):
+            content = content.encode()
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            view = memoryview(content)
+            
+            def _write_all() -> None:
+                for offset in range(0, len(view), chunk_size):
+                    chunk = view[offset:offset + chunk_size]
+                    digest.update(chunk)
+                    f.write(chunk)
+            await asyncio.to_thread(_write_all)
+            size = len(view)
+        elif hasattr(content, 'read'):
+            def _copy_file() -> int:
+                copied = 0
+                while chunk := content.read(chunk_size):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    copied += len(chunk)
+                return copied
+            size = await asyncio.to_thread(_copy_file)
+        elif hasattr(content, '__aiter__'):
+            async for chunk in content:
+                digest.update(chunk)
+                await asyncio.to_thread(f.write, chunk)
+                size += len(chunk)
+        else:
+            for chunk in content:
+                digest.update(chunk)
+                await asyncio.to_thread(f.write, chunk)
+                size += len(chunk)
+        await asyncio.to_thread(f.flush)
+        await asyncio.to_thread(os.fsync, f.fileno())
+    except BaseException:
+        f.close()
+        os.remove(tmp_file)
+        raise
+    f.close()
+    return tmp_file, digest.hexdigest(), size
+
+
 class SQLiteAttachmentStore(AttachmentStore[dict]):
-    """SQLite-based AttachmentStore implementation"""
+    """
+    SQLite-based AttachmentStore implementation
+    
+    File contents are stored once per SHA-256 digest under base_path/blobs and
+    reference counted, so the same screenshot uploaded to many critiques takes
+    disk space once. Uploads are streamed in chunks through a temp file and
+    atomically renamed into place.
+    """
     
-    def __init__(self, db_path: str = "./chatkit_data/chatkit.db", base_path: str = "./chatkit_files"):
+    CHUNK_SIZE = 1024 * 1024
+    
+    def __init__(self, db_path: str = "./chatkit_data/chatkit.db", base_path: str = "./chatkit_files", connections: SQLiteConnectionManager | None = None):
         self.db_path = db_path
         self.base_path = base_path
-        os.makedirs(base_path, exist_ok=True)
+        self.blob_path = os.path.join(base_path, "blobs")
+        self.tmp_path = os.path.join(base_path, "tmp")
+        os.makedirs(self.blob_path, exist_ok=True)
+        os.makedirs(self.tmp_path, exist_ok=True)
+        self.connections = connections or SQLiteConnectionManager(db_path)
         self._init_db()
     
     def _init_db(self):
-        """Initialize attachments table"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS attachments (
-                id TEXT PRIMARY KEY,
-                metadata TEXT,
-                file_path TEXT,
-                created_at TEXT
-            )
-        """)
-        conn.commit()
-        conn.close()
+        """Initialize attachments and blobs tables"""
+        with self.connections.write() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS attachments (
+                    id TEXT PRIMARY KEY,
+                    metadata TEXT,
+                    file_path TEXT,
+                    blob_sha256 TEXT,
+                    created_at TEXT
+                )
+            """)
+            _add_column_if_missing(conn.cursor(), "attachments", "blob_sha256", "TEXT")
+            # The user who uploaded the file; only they can download it
+            _add_column_if_missing(conn.cursor(), "attachments", "owner", "TEXT")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    size INTEGER,
+                    ref_count INTEGER NOT NULL,
+                    created_at TEXT
+                )
+            """)
+    
+    def close(self) -> None:
+        """Close the pooled database connections"""
+        self.connections.close()
+    
+    def blob_file_path(self, sha256: str) -> str:
+        """Path of the blob file for a digest"""
+        return os.path.join(self.blob_path, sha256[:2], sha256)
+    
+    async def _stream_to_temp(self, content: Any) -> tuple[str, str, int]:
+        """Write content to a temp file in chunks, returning (temp path, sha256 hex digest, size)"""
+        return await stream_to_temp(content, self.tmp_path, self.CHUNK_SIZE)
+    
+    def _adopt_upload(self, conn: sqlite3.Connection, upload: tuple[str, str, int], now: str) -> str:
+        """Move an uploaded temp file into its blob and take one reference to it (inside a write transaction)"""
+        tmp_file, sha256, size = upload
+        file_path = self.blob_file_path(sha256)
+        if conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sha256,)).fetchone() and os.path.exists(file_path):
+            os.remove(tmp_file)
+        else:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            os.replace(tmp_file, file_path)
+        conn.execute("""
+            INSERT INTO blobs (sha256, size, ref_count, created_at) VALUES (?, ?, 1, ?)
+            ON CONFLICT(sha256) DO UPDATE SET ref_count = ref_count + 1
+        """, (sha256, size, now))
+        return sha256
+    
+    def _release_blob(self, conn: sqlite3.Connection, sha256: str) -> None:
+        """Drop one reference to a blob, removing it when nothing uses it (inside a write transaction)"""
+        conn.execute("UPDATE blobs SET ref_count = ref_count - 1 WHERE sha256 = ?", (sha256,))
+        deleted = conn.execute("DELETE FROM blobs WHERE sha256 = ? AND ref_count <= 0", (sha256,)).rowcount
+        if deleted:
+            try:
+                os.remove(self.blob_file_path(sha256))
+            except FileNotFoundError:
+                pass
     
     async def save_attachment(self, attachment: Attachment, context: dict) -> None:
-        """Save attachment metadata"""
+        """Save attachment metadata and content"""
         import uuid
         from datetime import datetime
         
         if not attachment.id:
             attachment.id = f"file_{uuid.uuid4().hex[:16]}"
         
-        # Save file to disk if content provided
-        file_path = None
-        if hasattr(attachment, 'content') and attachment.content:
-            file_path = os.path.join(self.base_path, attachment.id)
-            with open(file_path, 'wb') as f:
-                if isinstance(attachment.content, bytes):
-                    f.write(attachment.content)
-                else:
-                    f.write(attachment.content.encode())
-        
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT OR REPLACE INTO attachments (id, metadata, file_path, created_at)
-            VALUES (?, ?, ?, ?)
-        """, (
-            attachment.id,
-            json.dumps(attachment.model_dump() if hasattr(attachment, 'model_dump') else attachment.dict()),
-            file_path,
-            datetime.now().isoformat()
-        ))
-        conn.commit()
-        conn.close()
+        content = getattr(attachment, 'content', None)
+        upload = await self._stream_to_temp(content) if content else None
+        now = datetime.now().isoformat()
+        metadata = json.dumps(
+            attachment.model_dump(mode="json", exclude={"content"}) if hasattr(attachment, 'model_dump') else attachment.dict()
+        )
+        
+        def _save(conn: sqlite3.Connection) -> None:
+            # Blob files are only added or removed under the writer lock, so a concurrent
+            # delete can never remove a blob that this save is about to reference
+            previous = conn.execute("SELECT blob_sha256, owner FROM attachments WHERE id = ?", (attachment.id,)).fetchone()
+            sha256 = file_path = None
+            if upload:
+                sha256 = self._adopt_upload(conn, upload, now)
+                file_path = self.blob_file_path(sha256)
+            # The owner is fixed by whoever created the attachment
+            owner = previous[1] if previous and previous[1] is not None else context.get("user_id")
+            conn.execute("""
+                INSERT OR REPLACE INTO attachments (id, metadata, file_path, blob_sha256, created_at, owner)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (attachment.id, metadata, file_path, sha256, now, owner))
+            if previous and previous[0]:
+                self._release_blob(conn, previous[0])
+        
+        try:
+            await self.connections.run_write(_save)
+        except BaseException:
+            if upload and os.path.exists(upload[0]):
+                os.remove(upload[0])
+            raise
     
     async def load_attachment(self, attachment_id: str, context: dict) -> Attachment:
         """Load attachment metadata"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, metadata, file_path FROM attachments WHERE id = ?", (attachment_id,))
-        row = cursor.fetchone()
-        conn.close()
+        row = await self.connections.run_read(
+            lambda conn: conn.execute("SELECT id, metadata, file_path FROM attachments WHERE id = ?", (attachment_id,)).fetchone()
+        )
         
         if not row:
             raise ValueError(f"Attachment {attachment_id} not found")
         
-        attachment_data = json.loads(row[1])
-        from chatkit.types import Attachment
-        return Attachment(**attachment_data)
+        return _attachment_adapter.validate_json(row[1])
+    
+    async def load_attachment_file(self, attachment_id: str, context: dict) -> tuple[Attachment, str | None, str | None]:
+        """
+        Load attachment metadata with its file path and content digest (None for files saved before content addressing).
+        Attachments of other users are not found.
+        """
+        row = await self.connections.run_read(
+            lambda conn: conn.execute(
+                "SELECT metadata, file_path, blob_sha256 FROM attachments WHERE id = ? AND owner IS ?",
+                (attachment_id, context.get("user_id")),
+            ).fetchone()
+        )
+        
+        if not row:
+            raise ValueError(f"Attachment {attachment_id} not found")
+        
+        return _attachment_adapter.validate_json(row[0]), row[1], row[2]
     
     async def delete_attachment(self, attachment_id: str, context: dict) -> None:
         """Delete an attachment"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        cursor.execute("SELECT file_path FROM attachments WHERE id = ?", (attachment_id,))
-        row = cursor.fetchone()
-        if row and row[0]:
-            try:
-                os.remove(row[0])
-            except:
-                pass
-        cursor.execute("DELETE FROM attachments WHERE id = ?", (attachment_id,))
-        conn.commit()
-        conn.close()
-
+        def _delete(conn: sqlite3.Connection) -> None:
+            row = conn.execute("SELECT file_path, blob_sha256 FROM attachments WHERE id = ?", (attachment_id,)).fetchone()
+            conn.execute("DELETE FROM attachments WHERE id = ?", (attachment_id,))
+            if row and row[1]:
+                self._release_blob(conn, row[1])
+            elif row and row[0]:
+                # Files saved before content addressing are named by attachment id
+                try:
+                    os.remove(row[0])
+                except:
+                    pass
+        await self.connections.run_write(_delete)
+    
+    async def save_blob(self, data: bytes) -> str:
+        """Store bytes as a blob and take one reference to it, returning its digest"""
+        from datetime import datetime
+        
+        sha256 = hashlib.sha256(data).hexdigest()
+        file_path = self.blob_file_path(sha256)
+        
+        def _reference(conn: sqlite3.Connection) -> bool:
+            # Known content only gains a reference, without writing the file again
+            if not os.path.exists(file_path):
+                return False
+            return conn.execute("UPDATE blobs SET ref_count = ref_count + 1 WHERE sha256 = ?", (sha256,)).rowcount > 0
+        
+        if await self.connections.run_write(_reference):
+            return sha256
+        upload = await self._stream_to_temp(data)
+        try:
+            return await self.connections.run_write(lambda conn: self._adopt_upload(conn, upload, datetime.now().isoformat()))
+        except BaseException:
+            if os.path.exists(upload[0]):
+                os.remove(upload[0])
+            raise
+    
+    def add_blob_references(self, payloads: list[bytes]) -> list[str]:
+        """
+        Store bytes as blobs and take one reference per payload, in one write transaction.
+        Synchronous, for offline tools such as the importer; returns the digests.
+        """
+        import uuid
+        from datetime import datetime
+        
+        uploads: list[tuple[str | None, str, bytes]] = []
+        written: set[str] = set()
+        try:
+            for data in payloads:
+                sha256 = hashlib.sha256(data).hexdigest()
+                tmp_file = None
+                # Known content only gains a reference, without writing the file again
+                if sha256 not in written and not os.path.exists(self.blob_file_path(sha256)):
+                    tmp_file = os.path.join(self.tmp_path, f"upload_{uuid.uuid4().hex}")
+                    with open(tmp_file, "wb") as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    written.add(sha256)
+                uploads.append((tmp_file, sha256, data))
+            now = datetime.now().isoformat()
+            with self.connections.write() as conn:
+                for tmp_file, sha256, data in uploads:
+                    if tmp_file is None and not os.path.exists(self.blob_file_path(sha256)):
+                        # Released since it was checked: write it under the writer lock
+                        tmp_file = os.path.join(self.tmp_path, f"upload_{uuid.uuid4().hex}")
+                        with open(tmp_file, "wb") as f:
+                            f.write(data)
+                    if tmp_file is not None:
+                        self._adopt_upload(conn, (tmp_file, sha256, len(data)), now)
+                    else:
+                        conn.execute("""
+                            INSERT INTO blobs (sha256, size, ref_count, created_at) VALUES (?, ?, 1, ?)
+                            ON CONFLICT(sha256) DO UPDATE SET ref_count = ref_count + 1
+                        """, (sha256, len(data), now))
+        finally:
+            for tmp_file, _, _ in uploads:
+                if tmp_file is not None and os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+        return [sha256 for _, sha256, _ in uploads]
+    
+    def read_blob(self, sha256: str) -> bytes:
+        """The contents of a blob"""
+        with open(self.blob_file_path(sha256), "rb") as f:
+            return f.read()
+    
+    async def load_blob(self, sha256: str) -> bytes:
+        """The contents of a blob, read off the event loop"""
+        return await asyncio.to_thread(self.read_blob, sha256)
+    
+    async def release_blobs(self, digests: list[str]) -> None:
+        """Drop one reference to each blob, removing those nothing uses any more"""
+        def _release(conn: sqlite3.Connection) -> None:
+            for sha256 in digests:
+                self._release_blob(conn, sha256)
+        await self.connections.run_write(_release)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""
+Rule-based fast path for the Classify agent
+
+Many messages can be classified without a model: a bare URL, a snippet of
+HTML or Tailwind classes, a screenshot with no text, or a request that names
+its category outright ("make this engineer-ready", "is this SEO optimized?").
+classify_message() applies deterministic rules and returns a category from
+ClassifySchema with a confidence; run_workflow uses the category only when
+the confidence reaches PROOFIT_CLASSIFY_MIN_CONFIDENCE (default 0.9, above 1
+turns the fast path off) and asks the gpt-4o classify agent otherwise. A
+keyword the message sets aside ("ignore SEO for now") does not count.
+
+The rules are checked against a labelled corpus of messages:
+
+    python3 classify_rules.py classify_corpus.jsonl
+    python3 classify_rules.py classify_corpus.jsonl --threshold 0.85
+    python3 classify_rules.py classify_corpus.jsonl --live
+
+which reports the share of classify calls the rules remove and how often
+their category (and the agent the category routes to) agrees with the label.
+--live labels the corpus with the classify agent itself instead of the
+labels in the file (needs OPENAI_API_KEY).
+
+The corpus was written alongside the rules, so it catches regressions but
+says little about accuracy on real traffic; label a sample of production
+messages with --live for that. The rule confidences are hand-picked, not
+calibrated.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+
+
+MIN_CONFIDENCE = float(os.getenv("PROOFIT_CLASSIFY_MIN_CONFIDENCE", "0.9"))
+
+# Categories run_workflow routes to their own agent; everything else gets the design evaluation
+ROUTED_CATEGORIES = ("seo_question", "translation_request", "ai_readiness")
+
+# run_workflow prepends this when audience or platform is set
+_CONTEXT_PREFIX = re.compile(r"^Context: [^\n]*\n\n")
+# Goal: / Audience: lines add context to a URL without changing what was sent
+_LABEL_LINE = re.compile(r"^\s*(goal|audience|platform|persona|target|context)\s*:.*$", re.IGNORECASE | re.MULTILINE)
+_URL = re.compile(
+    r"https?://\S+|\b(?:[a-z0-9-]+\.)+(?:com|io|app|co|net|org|dev|ai|so|xyz|design|site|me|us|uk|de)(?:/\S*)?",
+    re.IGNORECASE,
+)
+_FENCE = re.compile(r"```.*?(?:```|\Z)", re.DOTALL)
+_TAG = re.compile(r"<\s*/?[a-zA-Z][\w.-]*(?:\s[^<>]*)?/?\s*>")
+_JSON = re.compile(r"\{\s*\"[^\"]+\"\s*:.*\}", re.DOTALL)
+_UTILITY_CLASS = re.compile(r"^-?[a-z]+(?:-[\w\[\]#./%:]+)+$")
+_WORD = re.compile(r"[\w'’]+")
+
+# Whole messages the classify examples treat as unknown
+_UNKNOWN_MESSAGES = {"help", "idk", "hi", "hello", "hey", "test", "?", "??", "thanks", "thank you", "ok", "okay", "yo", "asdf"}
+
+# Who a critique is handed off to; "design" and "product" are left out, since "is this design/product
+# ready to ship?" asks for validation, not a translation
+_AUDIENCE = r"(engineers?|engineering|eng|devs?|developers?|pms?|product managers?|execs?|executives?|leadership|stakeholders?)"
+
+# (category, confidence, patterns) in priority order; the first rule with a matching pattern wins.
+# Categories that pick a different agent come first, since that is the decision that matters most.
+# The confidences are hand-picked, not calibrated.
+_KEYWORD_RULES = [
+    ("translation_request", 0.95, [
+        r"\b(engineer|engineering|eng|pm|exec|executive|stakeholder)[- ]ready\b",
+        # "dev ready" is also a checklist name, so it only counts when asked for
+        r"\bmake (this|it|that) (\w+ )?(dev|developer)[- ]ready\b",
+        r"\btranslate (this |it |that )?(for|into|to)\b",
+        rf"\baction items for (the )?{_AUDIENCE}\b",
+        rf"\bwhat does (this|it|that) mean for (the )?{_AUDIENCE}\b",
+    ]),
+    ("ai_readiness", 0.95, [
+        r"\bai[- ]readiness\b",
+        r"\bai (feature|interface|assistant|chatbot|product|experience|ux|agent|copilot)s?\b.*\b(ready|ship|shipping|launch|risks?|responsible)\b",
+        r"\b(ready|ship|shipping|launch|risks?|responsible)\b.*\bai (feature|interface|assistant|chatbot|product|experience|ux|agent|copilot)s?\b",
+    ]),
+    ("seo_question", 0.94, [
+        r"\bseo\b",
+        r"\bsearch engines?\b",
+        r"\bmeta (descriptions?|tags?|titles?)\b",
+    ]),
+    ("accessibility_check", 0.92, [
+        r"\bwcag\b",
+        r"\ba11y\b",
+        r"\btouch targets?\b",
+        r"\bcontrast ratios?\b",
+        r"\bscreen readers?\b",
+    ]),
+    ("design_system_question", 0.92, [
+        r"\b\d+\s?(pt|px)[- ]grid\b",
+        r"\bdesign system\b",
+        r"\bdesign tokens?\b",
+        r"\b(typography|type|spacing|color|colour) system\b",
+    ]),
+    ("comparison_request", 0.92, [
+        r"\bbefore (vs\.?|versus|and) after\b",
+        r"\ba/b\b",
+        r"\bwhich (one|one's|of (these|the two)|design|version|layout|variant|option|is)\b.*\b(better|use|prefer|pick|win)",
+        r"\bmake b match a\b",
+        r"\bdid (this|it) (actually )?improve\b",
+    ]),
+    ("score_only", 0.92, [
+        r"\bout of (10|ten|100)\b",
+        r"\b(rate|score|grade) (this|it)\b",
+        r"\b(quick|visual|design|overall) (score|rating)\b",
+        r"^(score|rating)\??$",
+    ]),
+    ("validation_check", 0.9, [
+        r"\bproduction[- ]ready\b",
+        r"\bshippable\b",
+        r"\b(would|can|could|should|will) (this|it|we) (ship|go live|launch)\b",
+        r"\b(acceptable|ready|ok|okay|safe) to (ship|launch|go live)\b",
+        r"\bready for (launch|release|production)\b",
+        r"\bblocking (the )?(launch|release)\b",
+        r"^is (this|it) (good|acceptable|ok|okay|accessible)( enough)?\??$",
+        r"^does (this|it) pass\??$",
+        r"\bdoes (this|it) follow (good )?(ux|usability) (best )?practices\b",
+    ]),
+]
+_COMPILED_RULES = [
+    (category, confidence, [re.compile(pattern, re.IGNORECASE) for pattern in patterns])
+    for category, confidence, patterns in _KEYWORD_RULES
+]
+
+# A keyword the message sets aside ("ignore SEO for now", "search engines matter less than conversion")
+# does not name its category: up to two words may sit between the negation and the keyword
+_NEGATION_BEFORE = re.compile(
+    r"\b(ignore|ignoring|skip|skipping|forget|not|no|never|without|except|don['’]?t|doesn['’]?t|do not|does not|aside from)\W+(\w+\W+){0,2}$",
+    re.IGNORECASE,
+)
+_NEGATION_AFTER = re.compile(
+    r"^\W*(\w+\W+)?(less than|aside|can wait|for later|doesn['’]?t matter|does not matter|isn['’]?t (important|a priority)|is not (important|a priority))\b",
+    re.IGNORECASE,
+)
+
+
+def _has_utility_classes(text: str) -> bool:
+    """A line of Tailwind-style classes such as p-[13px] gap-[7px] text-slate-400"""
+    tokens = text.split()
+    return (
+        len(tokens) >= 3
+        and all(_UTILITY_CLASS.match(token) for token in tokens)
+        and any(char.isdigit() for token in tokens for char in token)
+    )
+
+
+def _mentions(pattern: re.Pattern, prose: str) -> bool:
+    """Whether the pattern matches somewhere the message does not negate it"""
+    return any(
+        not _NEGATION_BEFORE.search(prose, 0, match.start()) and not _NEGATION_AFTER.search(prose[match.end():])
+        for match in pattern.finditer(prose)
+    )
+
+
+def classify_message(text: str, image_count: int = 0) -> tuple[str, float] | None:
+    """Category and confidence for a message by rule, or None when no rule applies"""
+    text = _CONTEXT_PREFIX.sub("", text or "").strip()
+    has_code = bool(_FENCE.search(text) or _TAG.search(text) or _JSON.search(text) or _has_utility_classes(text))
+    # What is left once code, URLs and Goal:/Audience: lines are taken out
+    prose = _JSON.sub(" ", _TAG.sub(" ", _FENCE.sub(" ", text)))
+    urls = _URL.findall(prose)
+    prose = _LABEL_LINE.sub(" ", _URL.sub(" ", prose))
+    if _has_utility_classes(prose):
+        prose = ""
+    prose = " ".join(prose.split())
+    words = _WORD.findall(prose)
+    
+    for category, confidence, patterns in _COMPILED_RULES:
+        if any(_mentions(pattern, prose) for pattern in patterns):
+            return category, confidence
+    
+    if has_code:
+        if urls or image_count:
+            return "mixed_input", 0.92
+        # A short intro ("Here's the CTA:") still makes it a code review; a longer question may not be
+        return "html_or_code", 0.93 if len(words) <= 12 else 0.6
+    if urls:
+        if image_count:
+            return "mixed_input", 0.9
+        if not words:
+            return ("mixed_input", 0.9) if len(urls) > 1 else ("url_only", 0.97)
+        # A URL with a remark is usually url_only, but the remark can change the category
+        return "url_only", 0.8
+    if image_count:
+        return "image_only", 0.97 if not words else 0.6
+    if prose.lower().strip(" .!") in _UNKNOWN_MESSAGES or not words:
+        return "unknown", 0.9
+    return None
+
+
+def preclassify(classify_content: list[dict], min_confidence: float = MIN_CONFIDENCE) -> str | None:
+    """The category for classify agent input (input_text and input_image parts) when the rules are sure of it"""
+    text = "\n".join(part.get("text", "") for part in classify_content if part.get("type") == "input_text")
+    image_count = sum(1 for part in classify_content if part.get("type") == "input_image")
+    result = classify_message(text, image_count)
+    if result is not None and result[1] >= min_confidence:
+        return result[0]
+    return None
+
+
+def route(category: str) -> str:
+    return category if category in ROUTED_CATEGORIES else "design_evaluation"
+
+
+def evaluate(corpus: list[dict], min_confidence: float) -> dict:
+    """How many corpus messages the rules classify, and how many of those agree with the label"""
+    decided = agreed = route_agreed = 0
+    misses = []
+    for entry in corpus:
+        result = classify_message(entry["text"], entry.get("images", 0))
+        if result is None or result[1] < min_confidence:
+            continue
+        decided += 1
+        if result[0] == entry["category"]:
+            agreed += 1
+        else:
+            misses.append({"text": entry["text"], "label": entry["category"], "rules": result[0]})
+        if route(result[0]) == route(entry["category"]):
+            route_agreed += 1
+    return {
+        "messages": len(corpus),
+        "fast_path": decided,
+        "fast_path_share": round(decided / len(corpus), 3) if corpus else 0.0,
+        "agreement": round(agreed / decided, 3) if decided else None,
+        "route_agreement": round(route_agreed / decided, 3) if decided else None,
+        "misses": misses,
+    }
+
+
+async def _label_live(corpus: list[dict]) -> None:
+    """Replace the corpus labels with the classify agent's answers"""
+    from agents import Runner
+    from workflow import classify
+    for entry in corpus:
+        content = [{"type": "input_text", "text": entry["text"]}]
+        # The agent only needs to know an image is there, not what it shows
+        content += [{"type": "input_image", "image_url": _PLACEHOLDER_IMAGE}] * entry.get("images", 0)
+        result = await Runner.run(classify, input=[{"role": "user", "content": content}])
+        entry["category"] = result.final_output.category
+
+
+# A 1x1 PNG
+_PLACEHOLDER_IMAGE = (
+    "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("corpus", help="JSONL file of {text, images, category} messages")
+    parser.add_argument("--threshold", type=float, default=MIN_CONFIDENCE, help="minimum confidence for the fast path")
+    parser.add_argument("--live", action="store_true", help="label the corpus with the classify agent instead of the file's labels")
+    args = parser.parse_args()
+    
+    with open(args.corpus) as f:
+        corpus = [json.loads(line) for line in f if line.strip()]
+    if args.live:
+        import asyncio
+        asyncio.run(_label_live(corpus))
+    report = evaluate(corpus, args.threshold)
+    for miss in report["misses"]:
+        print(f"  label {miss['label']:<22} rules {miss['rules']:<22} {miss['text'][:60]!r}")
+    print(
+        f"{report['fast_path']}/{report['messages']} messages classified by rules ({report['fast_path_share']:.0%} of classify calls removed), "
+        f"agreement {report['agreement']}, route agreement {report['route_agreement']}"
+    )
+    # Exit non-zero when a rule change makes the fast path disagree with the labels
+    sys.exit(1 if report["misses"] else 0)
@@ -0,0 +1,88 @@
+"""
+Perceptual hashes of screenshots
+
+A DCT hash (pHash) summarizes an image's low-frequency structure: the image
+is reduced to a small grayscale square, transformed with a 2-D DCT, and each
+of the lowest-frequency coefficients becomes one bit (above or below their
+median). Re-compression, a cursor or a one-pixel crop flip only a few bits,
+so near-identical uploads land within a small Hamming distance of each other.
+A coarse grid of mean tile colours goes with each hash to catch recolouring,
+which a luminance hash barely sees. A batch of images is reduced and
+transformed with stacked array operations.
+"""
+import io
+
+import numpy as np
+from PIL import Image
+
+
+# 16x16 coefficients (256 bits) from a 64x64 reduction: screenshots are mostly flat
+# regions, and the 64-bit hash of 8x8 coefficients cannot tell similar layouts apart
+HASH_SIZE = 16
+SAMPLE_SIZE = 64
+HASH_BYTES = HASH_SIZE * HASH_SIZE // 8
+TILE_GRID = 16
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Orthonormal DCT-II matrix, so D @ X @ D.T is the 2-D DCT of X"""
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_DCT = _dct_matrix(SAMPLE_SIZE)[:HASH_SIZE]
+
+
+def _pixels(data: bytes) -> np.ndarray | None:
+    """An image reduced to SAMPLE_SIZE x SAMPLE_SIZE RGB, or None if it cannot be decoded"""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # JPEG decoders can scale down while decoding, which is much cheaper than a full decode
+            image.draft("RGB", (SAMPLE_SIZE * 4, SAMPLE_SIZE * 4))
+            if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+                # Transparent areas count as white, the way the image is usually shown
+                background = Image.new("RGBA", image.size, (255, 255, 255, 255))
+                image = Image.alpha_composite(background, image.convert("RGBA"))
+            reduced = image.convert("RGB").resize((SAMPLE_SIZE, SAMPLE_SIZE), Image.Resampling.BOX)
+            return np.asarray(reduced, dtype=np.float32)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+def image_signatures(images: list[bytes]) -> tuple[np.ndarray, np.ndarray] | None:
+    """
+    Perceptual hashes and colour tiles of a batch of images, or None if any cannot be decoded.
+    
+    The hashes are (n, HASH_BYTES) packed bits. The tiles are each image's mean
+    colour over a TILE_GRID x TILE_GRID grid, (n, TILE_GRID, TILE_GRID, 3) uint8:
+    the hash only sees luminance structure, so a button recoloured to a similar
+    grey can hash as close as a cursor does, while its tiles change far more.
+    """
+    pixels = [_pixels(data) for data in images]
+    if not pixels or any(p is None for p in pixels):
+        return None
+    rgb = np.stack(pixels)
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    # Low-frequency DCT coefficients of every image at once: (n, HASH_SIZE, HASH_SIZE)
+    coefficients = _DCT @ gray @ _DCT.T
+    flat = coefficients.reshape(len(pixels), -1)
+    # The DC term only measures overall brightness, so it is left out of the median
+    medians = np.median(flat[:, 1:], axis=1, keepdims=True)
+    hashes = np.packbits(flat > medians, axis=1)
+    block = SAMPLE_SIZE // TILE_GRID
+    tiles = rgb.reshape(len(pixels), TILE_GRID, block, TILE_GRID, block, 3).mean(axis=(2, 4))
+    return hashes, np.rint(tiles).astype(np.uint8)
+
+
+def hamming_distances(candidates: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Bit differences between each candidate's hashes and the query's, shaped like candidates without the byte axis"""
+    return np.unpackbits(np.bitwise_xor(candidates, query), axis=-1).sum(axis=-1)
+
+
+def tile_differences(candidates: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Largest colour difference in any tile between each candidate image and the query's"""
+    difference = np.abs(candidates.astype(np.int16) - query.astype(np.int16))
+    return difference.reshape(*difference.shape[:-3], -1).max(axis=-1)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Offline resharding for the ChatKit SQLite store
+
+Copies every thread and its items from one or more source databases (the
+single chatkit.db, or an existing shard set) into a new set of shard files
+for ShardedSQLiteStore, routing each thread by its hashed id. Stop the server
+first; the new files are written under temporary names and only renamed into
+place once every row has been copied and the row counts check out.
+
+    python3 reshard_chatkit_store.py ./chatkit_data/chatkit.db --shards 8
+    python3 reshard_chatkit_store.py ./chatkit_data/shards/chatkit-*-of-004.db --shards 8
+
+Attachments stay where they are: SQLiteAttachmentStore keeps using chatkit.db,
+and items keep their references to the images moved into its blobs.
+Start the server with CHATKIT_SHARDS set to the new count afterwards.
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+from chatkit_export import LIVE_ITEMS
+from chatkit_store import SQLiteStore, shard_index, shard_paths
+
+
+THREAD_COLUMNS = ("id", "owner", "metadata", "created_at", "updated_at")
+ITEM_COLUMNS = ("id", "thread_id", "item_type", "content", "content_size", "role", "text", "created_at", "owner", "blob_refs")
+LIVE_THREADS = "deleted_at IS NULL"
+
+
+def copy_table(source: sqlite3.Connection, targets: list[sqlite3.Connection], table: str, columns: tuple[str, ...], key_index: int, batch_size: int, where: str) -> int:
+    """Stream the rows of a table matching where in rowid order, routing each row to the shard of its key column"""
+    column_list = ", ".join(columns)
+    insert = f"INSERT INTO {table} ({column_list}) VALUES ({', '.join('?' * len(columns))})"
+    copied = 0
+    last_rowid = 0
+    while True:
+        rows = source.execute(
+            f"SELECT rowid, {column_list} FROM {table} WHERE rowid > ? AND {where} ORDER BY rowid LIMIT ?", (last_rowid, batch_size)
+        ).fetchall()
+        if not rows:
+            return copied
+        last_rowid = rows[-1][0]
+        by_shard: dict[int, list[tuple]] = {}
+        for row in rows:
+            values = row[1:]
+            by_shard.setdefault(shard_index(values[key_index] or "", len(targets)), []).append(values)
+        for index, values in by_shard.items():
+            target = targets[index]
+            target.execute("BEGIN")
+            target.executemany(insert, values)
+            target.execute("COMMIT")
+        copied += len(rows)
+
+
+def count_rows(connections: list[sqlite3.Connection], table: str, where: str = "1") -> int:
+    return sum(conn.execute(f"SELECT COUNT(*) FROM {table} WHERE {where}").fetchone()[0] for conn in connections)
+
+
+def reshard(sources: list[str], target_dir: str, shard_count: int, batch_size: int) -> None:
+    targets = shard_paths(target_dir, shard_count)
+    resolved_sources = {os.path.abspath(path) for path in sources}
+    for path in targets:
+        if os.path.abspath(path) in resolved_sources:
+            sys.exit(f"Target {path} is also a source; reshard to a different shard count or directory")
+        if os.path.exists(path):
+            sys.exit(f"Target {path} already exists; move it aside first")
+    for path in sources:
+        if not os.path.exists(path):
+            sys.exit(f"Source {path} does not exist")
+    
+    # Opening a store brings its schema up to date (owner, content_size, role/text columns, search index)
+    for path in sources:
+        SQLiteStore(path).close()
+    temp_paths = [path + ".resharding" for path in targets]
+    for path in temp_paths:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        SQLiteStore(path).close()
+    
+    start = time.perf_counter()
+    target_conns = [sqlite3.connect(path, isolation_level=None) for path in temp_paths]
+    try:
+        for conn in target_conns:
+            # Nothing reads the new files until they are renamed into place
+            conn.execute("PRAGMA synchronous=OFF")
+            # The search index is filled in one pass at the end instead of row by row
+            SQLiteStore._drop_search_index(conn.cursor())
+        threads = items = 0
+        source_threads = source_items = 0
+        for path in sources:
+            source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                # Threads deleted but not yet purged are dropped rather than copied
+                source_threads += count_rows([source], "threads", LIVE_THREADS)
+                source_items += count_rows([source], "thread_items", LIVE_ITEMS)
+                threads += copy_table(source, target_conns, "threads", THREAD_COLUMNS, 0, batch_size, LIVE_THREADS)
+                items += copy_table(source, target_conns, "thread_items", ITEM_COLUMNS, 1, batch_size, LIVE_ITEMS)
+            finally:
+                source.close()
+            print(f"  {path}: {threads} threads, {items} items copied so far")
+        
+        target_threads = count_rows(target_conns, "threads")
+        target_items = count_rows(target_conns, "thread_items")
+        if (target_threads, target_items) != (source_threads, source_items):
+            sys.exit(
+                f"Row counts differ (threads {source_threads} -> {target_threads}, "
+                f"items {source_items} -> {target_items}); leaving *.resharding files for inspection"
+            )
+    finally:
+        for conn in target_conns:
+            conn.close()
+    
+    for path in temp_paths:
+        store = SQLiteStore(path)
+        with store.connections.write() as conn:
+            conn.execute("PRAGMA optimize")
+        store.close()
+    
+    for temp_path, path in zip(temp_paths, targets):
+        os.replace(temp_path, path)
+    elapsed = time.perf_counter() - start
+    print(f"Copied {threads} threads and {items} items into {shard_count} shards in {elapsed:.1f}s:")
+    for path in targets:
+        print(f"  {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sources", nargs="+", help="source database files")
+    parser.add_argument("--shards", type=int, required=True, help="number of shards to write")
+    parser.add_argument("--target-dir", default="./chatkit_data/shards", help="directory for the new shard files")
+    parser.add_argument("--batch-size", type=int, default=5000, help="rows copied per transaction")
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+    reshard(args.sources, args.target_dir, args.shards, args.batch_size)
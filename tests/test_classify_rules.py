@@ -0,0 +1,63 @@
+"""
+The classification rules against the labelled corpus
+
+The corpus was written alongside the rules, so this pins their behaviour
+rather than measuring accuracy: a rule change that makes the fast path
+disagree with a label, or classify more or fewer messages, fails here and
+the corpus (or PRECLASSIFIED) has to be updated with it.
+"""
+import json
+import os
+
+import pytest
+
+from classify_rules import classify_message, evaluate
+
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "classify_corpus.jsonl")
+THRESHOLD = 0.9
+# Corpus messages the rules classify at THRESHOLD
+PRECLASSIFIED = 103
+
+
+def _corpus() -> list[dict]:
+    with open(CORPUS_PATH) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def test_rules_agree_with_every_corpus_label():
+    report = evaluate(_corpus(), THRESHOLD)
+    assert report["misses"] == []
+    assert report["agreement"] == 1.0
+    assert report["route_agreement"] == 1.0
+    assert report["fast_path"] == PRECLASSIFIED
+
+
+@pytest.mark.parametrize("text", [
+    "Is this design ready to ship?",
+    "Is the product ready for launch?",
+    "Our dev ready checklist — critique this signup form",
+])
+def test_readiness_wording_is_not_a_translation_request(text):
+    result = classify_message(text)
+    assert result is None or result[0] != "translation_request"
+
+
+@pytest.mark.parametrize("text", [
+    "Review this screen, ignore SEO for now",
+    "I care about search engines less than conversion",
+    "Don’t worry about SEO, is the hierarchy clear?",
+])
+def test_negated_keywords_do_not_pick_their_category(text):
+    result = classify_message(text)
+    assert result is None or result[0] != "seo_question"
+
+
+@pytest.mark.parametrize("text, category", [
+    ("Make this engineer-ready", "translation_request"),
+    ("Make this dev-ready", "translation_request"),
+    ("Translate for engineers", "translation_request"),
+    ("Is this SEO optimized?", "seo_question"),
+])
+def test_explicit_requests_still_match(text, category):
+    assert classify_message(text)[0] == category
@@ -0,0 +1,93 @@
+"""
+Event-loop lag while the store takes a burst of concurrent writes
+
+SQLiteStore runs its queries on the connection manager's executor, so the
+loop keeps serving other requests (SSE streams above all) while writes wait
+on fsync. The burst here fails the test if a blocking call creeps back onto
+the loop. CHATKIT_TEST_MAX_LOOP_LAG_MS raises the limit on slow machines.
+"""
+import asyncio
+import gc
+import os
+import time
+from datetime import datetime
+
+from chatkit.types import ThreadMetadata
+
+from bench_chatkit_store import make_item, percentile, sample_loop_lag
+from chatkit_store import SQLiteStore, WriteBehindSQLiteStore
+
+
+MAX_LAG_MS = float(os.getenv("CHATKIT_TEST_MAX_LOOP_LAG_MS", "50"))
+WRITERS = 32
+WRITES_PER_WRITER = 25
+
+
+async def _lag_during(burst) -> list[float]:
+    """Loop lag samples taken while burst() runs"""
+    # Modules imported by other tests (agents, psycopg) make a full collection
+    # take over 100ms; freeze them so the samples measure the store alone
+    gc.collect()
+    gc.freeze()
+    stop = asyncio.Event()
+    sampler = asyncio.create_task(sample_loop_lag(stop))
+    # Let the sampler take its first sample before the burst starts
+    await asyncio.sleep(0.01)
+    try:
+        await burst()
+    finally:
+        stop.set()
+    try:
+        return await sampler
+    finally:
+        gc.unfreeze()
+
+
+async def _write_burst(store) -> list[float]:
+    context = {"user_id": "lag"}
+    base = datetime(2025, 1, 1)
+    threads = [ThreadMetadata(id=f"thread_lag_{w}", created_at=base) for w in range(WRITERS)]
+    for thread in threads:
+        await store.save_thread(thread, context)
+    
+    async def writer(thread: ThreadMetadata) -> None:
+        for i in range(WRITES_PER_WRITER):
+            await store.save_item(thread.id, make_item(thread.id, i, base), context)
+            await store.save_thread(thread, context)
+        await store.load_thread_items(thread.id, context, limit=20)
+    
+    async def burst() -> None:
+        await asyncio.gather(*(writer(thread) for thread in threads))
+        await store.flush()
+    
+    try:
+        return await _lag_during(burst)
+    finally:
+        store.close()
+
+
+def _assert_flat(lags: list[float]) -> None:
+    assert lags, "the sampler never ran during the burst"
+    p99 = percentile(lags, 0.99)
+    assert p99 < MAX_LAG_MS, f"p99 loop lag {p99:.1f}ms over {MAX_LAG_MS}ms during concurrent writes (max {max(lags):.1f}ms)"
+
+
+def test_sampler_sees_a_blocked_loop():
+    """The measurement itself catches a call that blocks the loop"""
+    async def burst() -> None:
+        await asyncio.sleep(0.02)
+        time.sleep(0.2)
+        await asyncio.sleep(0.02)
+    
+    lags = asyncio.run(_lag_during(burst))
+    assert max(lags) >= 150
+
+
+def test_loop_lag_stays_flat_under_concurrent_writes(tmp_path):
+    store = SQLiteStore(db_path=str(tmp_path / "chatkit.db"))
+    _assert_flat(asyncio.run(_write_burst(store)))
+
+
+def test_loop_lag_stays_flat_under_write_behind(tmp_path):
+    store = WriteBehindSQLiteStore(db_path=str(tmp_path / "chatkit.db"), max_delay_ms=5)
+    _assert_flat(asyncio.run(_write_burst(store)))
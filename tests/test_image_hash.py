@@ -0,0 +1,89 @@
+"""
+Perceptual-hash distances behind the look-alike image thresholds
+
+WorkflowCache recommends RECOMMENDED_IMAGE_DISTANCE and defaults to
+TILE_DIFFERENCE from these measurements on synthetic 1440x900 screenshots: a
+re-upload that was re-encoded, cropped or has the cursor in it must stay below
+both with some margin, and a layout shift or a recoloured button must not.
+The screenshots are the worst of 40 layouts, so the bounds are the measured
+maxima rather than typical values.
+"""
+import io
+import random
+
+import pytest
+from PIL import Image, ImageDraw
+
+from image_hash import hamming_distances, image_signatures, tile_differences
+from workflow_cache import RECOMMENDED_IMAGE_DISTANCE, TILE_DIFFERENCE
+
+
+WIDTH, HEIGHT = 1440, 900
+# Layouts with the largest distances for the benign edits below
+LAYOUTS = [1, 2, 19, 31]
+
+
+def _screenshot(layout: int, shift: int = 0, button=(37, 99, 235)) -> Image.Image:
+    """A dashboard-like screen: top bar, sidebar, cards with a text line, a primary button"""
+    rng = random.Random(layout)
+    image = Image.new("RGB", (WIDTH, HEIGHT), (248, 249, 251))
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([0, 0, WIDTH, 64], fill=(rng.randrange(20, 60),) * 3)
+    draw.rectangle([0, 64, 240, HEIGHT], fill=(236, 238, 242))
+    for i in range(rng.randrange(4, 9)):
+        y = 90 + i * 90 + shift
+        draw.rectangle([280, y, 280 + rng.randrange(500, 1100), y + 60], fill=tuple(rng.randrange(180, 240) for _ in range(3)), outline=(200, 200, 205))
+        draw.rectangle([300, y + 15, 300 + rng.randrange(100, 400), y + 25], fill=(60, 60, 70))
+    draw.rectangle([1200, 800 + shift, 1400, 850 + shift], fill=button)
+    for i in range(8):
+        draw.rectangle([20, 100 + i * 40, 200, 115 + i * 40], fill=(120, 120, 130))
+    return image
+
+
+def _with_cursor(image: Image.Image) -> Image.Image:
+    image = image.copy()
+    ImageDraw.Draw(image).polygon([(700, 400), (700, 420), (705, 415), (712, 422)], fill=(0, 0, 0))
+    return image
+
+
+def _encode(image: Image.Image, format: str = "PNG", **options) -> bytes:
+    buffer = io.BytesIO()
+    image.save(buffer, format, **options)
+    return buffer.getvalue()
+
+
+def _distances(original: Image.Image, upload: bytes) -> tuple[int, int]:
+    """Hash bits and largest tile difference between a screenshot and a re-upload of it"""
+    hashes, tiles = image_signatures([_encode(original), upload])
+    return int(hamming_distances(hashes[1:], hashes[0])[0]), int(tile_differences(tiles[1:], tiles[0])[0])
+
+
+# (edit, most hash bits, largest tile difference) measured over 40 layouts
+BENIGN = [
+    ("jpeg q70", lambda image: _encode(image, "JPEG", quality=70), 6, 5),
+    ("1px crop + jpeg q70", lambda image: _encode(image.crop((1, 1, WIDTH, HEIGHT)), "JPEG", quality=70), 8, 5),
+    ("cursor + 2px crop + jpeg q70", lambda image: _encode(_with_cursor(image).crop((2, 2, WIDTH, HEIGHT)), "JPEG", quality=70), 8, 9),
+]
+
+
+def test_recommended_thresholds_leave_margin_above_benign_edits():
+    assert max(bits for _, _, bits, _ in BENIGN) + 4 <= RECOMMENDED_IMAGE_DISTANCE
+    assert max(tiles for _, _, _, tiles in BENIGN) + 3 <= TILE_DIFFERENCE
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+@pytest.mark.parametrize("name, edit, max_bits, max_tiles", BENIGN, ids=[name for name, *_ in BENIGN])
+def test_reuploads_stay_within_measured_distances(layout, name, edit, max_bits, max_tiles):
+    original = _screenshot(layout)
+    bits, tiles = _distances(original, edit(original))
+    assert bits <= max_bits, f"{name}: {bits} bits"
+    assert tiles <= max_tiles, f"{name}: tile difference {tiles}"
+
+
+@pytest.mark.parametrize("layout", LAYOUTS)
+def test_layout_shift_and_recolour_stay_out_of_reach(layout):
+    original = _screenshot(layout)
+    shifted_bits, _ = _distances(original, _encode(_screenshot(layout, shift=20)))
+    assert shifted_bits >= 22 > RECOMMENDED_IMAGE_DISTANCE
+    _, recoloured_tiles = _distances(original, _encode(_screenshot(layout, button=(235, 99, 37))))
+    assert recoloured_tiles >= 150 > TILE_DIFFERENCE
@@ -0,0 +1,196 @@
+"""
+PostgresStore and PostgresAttachmentStore against a throwaway database
+
+Skipped unless CHATKIT_TEST_DATABASE_URL points at a Postgres database, e.g.
+
+    CHATKIT_TEST_DATABASE_URL=postgresql://postgres@localhost:5432/chatkit_test python3 -m pytest tests
+
+Every test creates its own schema and drops it afterwards, so nothing else in
+the database is touched.
+"""
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import pytest
+
+DATABASE_URL = os.getenv("CHATKIT_TEST_DATABASE_URL")
+pytestmark = pytest.mark.skipif(not DATABASE_URL, reason="CHATKIT_TEST_DATABASE_URL is not set")
+asyncpg = pytest.importorskip("asyncpg")
+
+from chatkit.types import FileAttachment, InferenceOptions, ThreadMetadata, UserMessageItem, UserMessageTextContent
+
+from bench_chatkit_store import make_item
+from chatkit_postgres_store import PostgresAttachmentStore, PostgresConnectionManager, PostgresStore
+
+
+ALICE = {"user_id": "alice"}
+BOB = {"user_id": "bob"}
+BASE = datetime(2025, 1, 1)
+
+
+def _with_search_path(dsn: str, schema: str) -> str:
+    """The DSN with search_path set (asyncpg passes unknown query parameters on as server settings)"""
+    parts = urlsplit(dsn)
+    query = parse_qsl(parts.query) + [("search_path", schema)]
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def _run(test, tmp_path) -> None:
+    """Run test(store, attachment_store) against fresh tables in a schema of its own"""
+    async def main() -> None:
+        schema = f"chatkit_test_{uuid.uuid4().hex[:12]}"
+        admin = await asyncpg.connect(DATABASE_URL)
+        await admin.execute(f"CREATE SCHEMA {schema}")
+        connections = PostgresConnectionManager(_with_search_path(DATABASE_URL, schema), min_size=1, max_size=4)
+        try:
+            await test(PostgresStore(connections), PostgresAttachmentStore(connections, cache_path=str(tmp_path / "blob_cache")))
+        finally:
+            await connections.close()
+            await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+            await admin.close()
+    
+    asyncio.run(main())
+
+
+def _user_message(thread_id: str, item_id: str, text: str) -> UserMessageItem:
+    return UserMessageItem(
+        id=item_id,
+        thread_id=thread_id,
+        created_at=BASE,
+        content=[UserMessageTextContent(text=text)],
+        attachments=[],
+        inference_options=InferenceOptions(),
+    )
+
+
+def test_threads_page_newest_first_per_user(tmp_path):
+    async def test(store: PostgresStore, _) -> None:
+        # Pairs of threads share an updated_at, so pages have to break ties by id
+        for n in range(25):
+            updated = BASE + timedelta(minutes=n // 2)
+            await store.save_thread(ThreadMetadata(id=f"thread_a{n:02d}", created_at=BASE, updated_at=updated), ALICE)
+        for n in range(5):
+            await store.save_thread(ThreadMetadata(id=f"thread_b{n:02d}", created_at=BASE, updated_at=BASE), BOB)
+        
+        pages, after = [], None
+        while page := await store.load_threads(ALICE, limit=10, after=after):
+            pages.append([thread.id for thread in page])
+            after = page[-1].id
+        
+        expected = sorted((f"thread_a{n:02d}" for n in range(25)), key=lambda id: (int(id[-2:]) // 2, id), reverse=True)
+        assert [len(page) for page in pages] == [10, 10, 5]
+        assert sum(pages, []) == expected
+        assert {thread.id for thread in await store.load_threads(BOB, limit=100)} == {f"thread_b{n:02d}" for n in range(5)}
+        # A cursor from another user's listing does not leak into this one
+        assert await store.load_threads(BOB, limit=10, after="thread_a24") == []
+    
+    _run(test, tmp_path)
+
+
+def test_thread_items_keyset_pages_and_recent_window(tmp_path):
+    async def test(store: PostgresStore, _) -> None:
+        thread = ThreadMetadata(id="thread_items", created_at=BASE)
+        await store.save_thread(thread, ALICE)
+        # make_item spaces items 1ms apart, so this is also their created_at order
+        for n in range(35):
+            await store.save_item(thread.id, make_item(thread.id, n, BASE), ALICE)
+        
+        ids, after = [], None
+        while page := await store.load_thread_items(thread.id, ALICE, limit=10, after=after):
+            ids += [item.id for item in page]
+            after = page[-1].id
+        assert ids == [f"msg_{thread.id}_{n:08d}" for n in range(35)]
+        
+        recent = await store.load_recent_thread_items(thread.id, ALICE, limit=5)
+        assert [item.id for item in recent] == ids[-5:]
+        # The newest item is always returned, however small the byte budget
+        assert [item.id for item in await store.load_recent_thread_items(thread.id, ALICE, limit=5, max_bytes=1)] == ids[-1:]
+    
+    _run(test, tmp_path)
+
+
+def test_deleted_thread_disappears_from_every_read(tmp_path):
+    async def test(store: PostgresStore, _) -> None:
+        for thread_id in ("thread_kept", "thread_gone"):
+            await store.save_thread(ThreadMetadata(id=thread_id, created_at=BASE), ALICE)
+            await store.save_item(thread_id, _user_message(thread_id, f"msg_{thread_id}", "critique the pricing page"), ALICE)
+        
+        await store.delete_thread("thread_gone", ALICE)
+        
+        with pytest.raises(ValueError):
+            await store.load_thread("thread_gone", ALICE)
+        with pytest.raises(ValueError):
+            await store.load_item("thread_gone", "msg_thread_gone", ALICE)
+        assert await store.load_thread_items("thread_gone", ALICE) == []
+        assert await store.load_conversation_history("thread_gone", ALICE) == []
+        assert [thread.id for thread in await store.load_threads(ALICE)] == ["thread_kept"]
+        assert [result["thread_id"] for result in await store.search_items(ALICE, "pricing")] == ["thread_kept"]
+        
+        await store.delete_thread_item("thread_kept", "msg_thread_kept", ALICE)
+        assert await store.load_thread_items("thread_kept", ALICE) == []
+    
+    _run(test, tmp_path)
+
+
+def test_attachments_are_deduplicated_chunked_and_owned(tmp_path):
+    async def test(_, attachments: PostgresAttachmentStore) -> None:
+        # Small chunks, so a few KB exercise the multi-chunk upload and cache fill
+        attachments.CHUNK_SIZE = 1024
+        payload = os.urandom(5000)
+        
+        async def chunks():
+            for offset in range(0, len(payload), 700):
+                yield payload[offset:offset + 700]
+        
+        for attachment_id, content in (("file_one", chunks()), ("file_two", payload)):
+            attachment = FileAttachment(id=attachment_id, name="screenshot.png", mime_type="image/png")
+            object.__setattr__(attachment, "content", content)
+            await attachments.save_attachment(attachment, ALICE)
+        
+        pool = await attachments._pool()
+        sha256 = await pool.fetchval("SELECT blob_sha256 FROM chatkit_attachments WHERE id = 'file_one'")
+        assert await pool.fetchval("SELECT ref_count FROM chatkit_blobs WHERE sha256 = $1", sha256) == 2
+        assert await pool.fetchval("SELECT count(*) FROM chatkit_blob_chunks WHERE sha256 = $1", sha256) == 5
+        
+        attachment, file_path, digest = await attachments.load_attachment_file("file_one", ALICE)
+        assert (attachment.name, digest) == ("screenshot.png", sha256)
+        with open(file_path, "rb") as f:
+            assert f.read() == payload
+        with pytest.raises(ValueError):
+            await attachments.load_attachment_file("file_one", BOB)
+        
+        # Another node has no cached copy and streams the chunks back
+        os.remove(file_path)
+        _, file_path, _ = await attachments.load_attachment_file("file_two", ALICE)
+        with open(file_path, "rb") as f:
+            assert f.read() == payload
+        
+        await attachments.delete_attachment("file_one", ALICE)
+        assert await pool.fetchval("SELECT ref_count FROM chatkit_blobs WHERE sha256 = $1", sha256) == 1
+        await attachments.delete_attachment("file_two", ALICE)
+        assert await pool.fetchval("SELECT count(*) FROM chatkit_blobs") == 0
+        assert await pool.fetchval("SELECT count(*) FROM chatkit_blob_chunks") == 0
+        assert not os.path.exists(file_path)
+    
+    _run(test, tmp_path)
+
+
+def test_blobs_stored_before_chunking_are_still_served(tmp_path):
+    async def test(_, attachments: PostgresAttachmentStore) -> None:
+        pool = await attachments._pool()
+        await pool.execute(
+            "INSERT INTO chatkit_blobs (sha256, content, size, ref_count, created_at) VALUES ('legacy', $1, 6, 1, now())", b"legacy"
+        )
+        await pool.execute("""
+            INSERT INTO chatkit_attachments (id, metadata, blob_sha256, created_at, owner)
+            VALUES ('file_legacy', '{"type": "file", "id": "file_legacy", "name": "old.txt", "mime_type": "text/plain"}', 'legacy', now(), 'alice')
+        """)
+        
+        _, file_path, _ = await attachments.load_attachment_file("file_legacy", ALICE)
+        with open(file_path, "rb") as f:
+            assert f.read() == b"legacy"
+    
+    _run(test, tmp_path)
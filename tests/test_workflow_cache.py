@@ -0,0 +1,177 @@
+"""
+WorkflowCache with stubbed workflow runs
+
+run_workflow and run_workflow_streamed are replaced by functions that count
+their calls, so these tests need no model and cover keying, expiry, in-flight
+joining and the admin check on invalidation.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import workflow_cache
+from workflow import WORKFLOW_AGENTS
+from workflow_cache import WorkflowCache
+
+
+def _input(text: str = "critique this pricing page") -> SimpleNamespace:
+    return SimpleNamespace(
+        input_as_text=text,
+        image_data_url=None,
+        image_data_urls=None,
+        mode="critique",
+        audience=None,
+        platform=None,
+        conversation_history=None,
+    )
+
+
+class StubWorkflow:
+    """Counts runs; each answer can be held back until release() so requests overlap"""
+    
+    def __init__(self, hold: bool = False):
+        self.runs = 0
+        self.release_event = asyncio.Event()
+        if not hold:
+            self.release_event.set()
+    
+    def release(self) -> None:
+        self.release_event.set()
+    
+    async def run(self, workflow_input) -> dict:
+        self.runs += 1
+        await self.release_event.wait()
+        return {"output_text": f"answer {self.runs}", "category": "design_question"}
+    
+    async def run_streamed(self, workflow_input):
+        self.runs += 1
+        run = self.runs
+        yield {"type": "classified", "category": "design_question"}
+        await self.release_event.wait()
+        yield {"type": "delta", "delta": f"answer {run}"}
+        yield {"type": "done", "output_text": f"answer {run}"}
+
+
+async def _collect(events) -> list[dict]:
+    return [event async for event in events]
+
+
+def test_answers_are_cached_per_user():
+    async def main() -> None:
+        cache = WorkflowCache(WORKFLOW_AGENTS, db_path=None)
+        stub = StubWorkflow()
+        
+        assert await cache.run(_input(), stub.run, scope="alice") == ({"output_text": "answer 1", "category": "design_question"}, None)
+        assert (await cache.run(_input(), stub.run, scope="alice"))[1] == "memory"
+        # The same request from another user is a miss, never alice's answer
+        result, source = await cache.run(_input(), stub.run, scope="bob")
+        assert (result["output_text"], source) == ("answer 2", None)
+        assert cache.key(_input(), "alice") != cache.key(_input(), "bob")
+        assert stub.runs == 2
+    
+    asyncio.run(main())
+
+
+def test_answers_expire_from_each_tier(tmp_path, monkeypatch):
+    now = [1_000_000.0]
+    monkeypatch.setattr(workflow_cache.time, "time", lambda: now[0])
+    
+    async def main() -> None:
+        cache = WorkflowCache(WORKFLOW_AGENTS, db_path=str(tmp_path / "cache.db"), memory_ttl_s=10, disk_ttl_s=100)
+        stub = StubWorkflow()
+        try:
+            await cache.run(_input(), stub.run)
+            now[0] += 5
+            assert (await cache.run(_input(), stub.run))[1] == "memory"
+            now[0] += 10
+            assert (await cache.run(_input(), stub.run))[1] == "disk"
+            now[0] += 200
+            assert (await cache.run(_input(), stub.run))[1] is None
+            assert stub.runs == 2
+        finally:
+            cache.close()
+    
+    asyncio.run(main())
+
+
+def test_identical_requests_join_the_run_in_flight():
+    async def main() -> None:
+        cache = WorkflowCache(WORKFLOW_AGENTS, db_path=None)
+        stub = StubWorkflow(hold=True)
+        
+        runs = [asyncio.create_task(cache.run(_input(), stub.run)) for _ in range(3)]
+        streams = [asyncio.create_task(_collect(cache.run_streamed(_input(), stub.run_streamed))) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        stub.release()
+        
+        results = await asyncio.gather(*runs)
+        assert stub.runs == 1
+        assert [source for _, source in results] == [None, "inflight", "inflight"]
+        for events in await asyncio.gather(*streams):
+            assert events[-1] == {"type": "done", "output_text": "answer 1"}
+        assert cache.joined == 4
+    
+    asyncio.run(main())
+
+
+def test_streamed_run_in_flight_is_shared_and_handed_off_on_disconnect():
+    async def main() -> None:
+        cache = WorkflowCache(WORKFLOW_AGENTS, db_path=None)
+        stub = StubWorkflow(hold=True)
+        
+        first = cache.run_streamed(_input(), stub.run_streamed)
+        assert await first.__anext__() == {"type": "classified", "category": "design_question"}
+        waiting = asyncio.create_task(_collect(cache.run_streamed(_input(), stub.run_streamed)))
+        await asyncio.sleep(0.01)
+        # The first client goes away before the answer is done; the waiting request runs it itself
+        await first.aclose()
+        await asyncio.sleep(0.01)
+        stub.release()
+        
+        events = await waiting
+        assert events[-1] == {"type": "done", "output_text": "answer 2"}
+        assert stub.runs == 2
+        assert (await cache.get(cache.key(_input())))[0]["output_text"] == "answer 2"
+    
+    asyncio.run(main())
+
+
+def test_cancelled_run_hands_off_to_a_waiting_request():
+    async def main() -> None:
+        cache = WorkflowCache(WORKFLOW_AGENTS, db_path=None)
+        stub = StubWorkflow(hold=True)
+        
+        first = asyncio.create_task(cache.run(_input(), stub.run))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(cache.run(_input(), stub.run))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0.01)
+        stub.release()
+        
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        result, source = await second
+        assert (result["output_text"], source) == ("answer 2", None)
+    
+    asyncio.run(main())
+
+
+def test_invalidate_requires_the_admin_token(tmp_path, monkeypatch):
+    # The server creates its databases in the working directory when imported
+    monkeypatch.chdir(tmp_path)
+    testclient = pytest.importorskip("fastapi.testclient")
+    import chatkit_server
+    
+    client = testclient.TestClient(chatkit_server.app)
+    monkeypatch.setattr(chatkit_server, "ADMIN_TOKEN", "")
+    assert client.post("/workflow/cache/invalidate", headers={"Authorization": "Bearer anything"}).status_code == 403
+    
+    monkeypatch.setattr(chatkit_server, "ADMIN_TOKEN", "s3cret")
+    assert client.post("/workflow/cache/invalidate").status_code == 401
+    assert client.post("/workflow/cache/invalidate", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.post("/workflow/cache/invalidate", headers={"Authorization": "Basic s3cret"}).status_code == 401
+    response = client.post("/workflow/cache/invalidate", headers={"Authorization": "Bearer s3cret"})
+    assert response.status_code == 200
+    assert "invalidated" in response.json()
@@ -1,10 +1,14 @@
 from pydantic import BaseModel
 from agents import Agent, ModelSettings, TResponseInputItem, Runner, RunConfig, trace, function_tool
-from typing import Optional
+from typing import AsyncIterator, Optional
+import asyncio
 import os
 import requests
+import time
 import urllib.parse
 
+from classify_rules import preclassify
+
 # Classify definitions
 class ClassifySchema(BaseModel):
   category: str
@@ -1677,250 +1681,313 @@ class WorkflowInput(BaseModel):
 
 
 # Main code entrypoint
-async def run_workflow(workflow_input: WorkflowInput):
-  try:
-    with trace("Proofit"):
-      # Convert input to dict first
-      workflow = workflow_input.model_dump()
-      
-      # Use provided context or defaults
-      audience_value = workflow.get("audience") or "general_saas"
-      platform_value = workflow.get("platform") or "web"
-      
-      state = {
-      "mode": "balanced",
-      "audience": audience_value,
-      "platform": platform_value,
-      "goal": "improve_clarity_and_conversion",
-      "constraints": [],
-      "tone": "sharp_but_fair",
-      "focus_areas": [],
-      "evaluation_depth": "standard",
-      "confidence_floor": "medium",
-      "design_maturity": "early",
-      "primary_metric": "conversion",
-      "allowed_suggestions": [],
-      "brand_personality": "neutral",
-      "comparison_mode": False,
-      "breakpoint": {
-        "breakpoint": {}
-      },
-      "taste_profile": "product_first"
-      }
-      
-      # Build context string from audience and platform if provided
-      context_parts = []
-      if workflow.get("audience"):
-        audience_map = {
-          "consumer": "Consumer SaaS",
-          "enterprise": "Enterprise / Admin",
-          "developer": "Developer Tool",
-          "marketing": "Marketing / Landing Page",
-          "internal": "Internal Tool"
-        }
-        context_parts.append(f"Audience: {audience_map.get(workflow['audience'], workflow['audience'])}")
-      
-      if workflow.get("platform"):
-        platform_map = {
-          "desktop": "Desktop-first",
-          "mobile": "Mobile-first",
-          "responsive": "Responsive",
-          "app": "App-like UI"
-        }
-        context_parts.append(f"Platform: {platform_map.get(workflow['platform'], workflow['platform'])}")
-      
-      # Prepend context to input text if provided
-      if context_parts:
-        context_string = "Context: " + ", ".join(context_parts) + "\n\n"
-        workflow["input_as_text"] = context_string + workflow["input_as_text"]
-      
-      # Build content array for multimodal input (text + image)
-      # Note: For user messages, we use "input_text" but for assistant messages in history, we need "output_text"
-      classify_content = [{"type": "input_text", "text": workflow["input_as_text"]}]
-      conversation_content = [{"type": "input_text", "text": workflow["input_as_text"]}]
-      
-      # Add images if provided (up to 3)
-      image_data_urls = workflow.get("image_data_urls") or []
-      # Backward compatibility: if single image_data_url is provided, add it to the list
-      if workflow.get("image_data_url") and len(image_data_urls) == 0:
-        image_data_urls = [workflow["image_data_url"]]
+def _build_inputs(workflow_input: WorkflowInput) -> tuple[list[dict], list[TResponseInputItem]]:
+  """Classifier content and the model conversation (history plus the current message) for a run"""
+  # Convert input to dict first
+  workflow = workflow_input.model_dump()
+  
+  # Use provided context or defaults
+  audience_value = workflow.get("audience") or "general_saas"
+  platform_value = workflow.get("platform") or "web"
+  
+  state = {
+  "mode": "balanced",
+  "audience": audience_value,
+  "platform": platform_value,
+  "goal": "improve_clarity_and_conversion",
+  "constraints": [],
+  "tone": "sharp_but_fair",
+  "focus_areas": [],
+  "evaluation_depth": "standard",
+  "confidence_floor": "medium",
+  "design_maturity": "early",
+  "primary_metric": "conversion",
+  "allowed_suggestions": [],
+  "brand_personality": "neutral",
+  "comparison_mode": False,
+  "breakpoint": {
+    "breakpoint": {}
+  },
+  "taste_profile": "product_first"
+  }
+  
+  # Build context string from audience and platform if provided
+  context_parts = []
+  if workflow.get("audience"):
+    audience_map = {
+      "consumer": "Consumer SaaS",
+      "enterprise": "Enterprise / Admin",
+      "developer": "Developer Tool",
+      "marketing": "Marketing / Landing Page",
+      "internal": "Internal Tool"
+    }
+    context_parts.append(f"Audience: {audience_map.get(workflow['audience'], workflow['audience'])}")
+  
+  if workflow.get("platform"):
+    platform_map = {
+      "desktop": "Desktop-first",
+      "mobile": "Mobile-first",
+      "responsive": "Responsive",
+      "app": "App-like UI"
+    }
+    context_parts.append(f"Platform: {platform_map.get(workflow['platform'], workflow['platform'])}")
+  
+  # Prepend context to input text if provided
+  if context_parts:
+    context_string = "Context: " + ", ".join(context_parts) + "\n\n"
+    workflow["input_as_text"] = context_string + workflow["input_as_text"]
+  
+  # Build content array for multimodal input (text + image)
+  # Note: For user messages, we use "input_text" but for assistant messages in history, we need "output_text"
+  classify_content = [{"type": "input_text", "text": workflow["input_as_text"]}]
+  conversation_content = [{"type": "input_text", "text": workflow["input_as_text"]}]
+  
+  # Add images if provided (up to 3)
+  image_data_urls = workflow.get("image_data_urls") or []
+  # Backward compatibility: if single image_data_url is provided, add it to the list
+  if workflow.get("image_data_url") and len(image_data_urls) == 0:
+    image_data_urls = [workflow["image_data_url"]]
+  
+  # Add all images to classify and conversation content
+  for image_data_url in image_data_urls[:3]:  # Limit to 3 images
+    classify_content.append({
+      "type": "input_image",
+      "image_url": image_data_url  # Full data URL: data:image/png;base64,...
+    })
+    conversation_content.append({
+      "type": "input_image",
+      "image_url": image_data_url  # Full data URL: data:image/png;base64,...
+    })
+  
+  # Use provided conversation history or create new one
+  if workflow.get("conversation_history") and len(workflow["conversation_history"]) > 0:
+    # Convert provided history to TResponseInputItem format
+    conversation_history: list[TResponseInputItem] = []
+    history_messages = workflow["conversation_history"]
+    
+    # Process all history messages except the last one (which is the current message)
+    for i, msg in enumerate(history_messages):
+      # Skip the last message as we'll add it separately with the current content
+      if i == len(history_messages) - 1 and msg.get("role") == "user":
+        continue
       
-      # Add all images to classify and conversation content
-      for image_data_url in image_data_urls[:3]:  # Limit to 3 images
-        classify_content.append({
-          "type": "input_image",
-          "image_url": image_data_url  # Full data URL: data:image/png;base64,...
-        })
-        conversation_content.append({
-          "type": "input_image",
-          "image_url": image_data_url  # Full data URL: data:image/png;base64,...
-        })
+      # Ensure content is in the right format
+      msg_content = msg.get("content", [])
+      msg_role = msg.get("role", "user")
       
-      # Use provided conversation history or create new one
-      if workflow.get("conversation_history") and len(workflow["conversation_history"]) > 0:
-        # Convert provided history to TResponseInputItem format
-        conversation_history: list[TResponseInputItem] = []
-        history_messages = workflow["conversation_history"]
-        
-        # Process all history messages except the last one (which is the current message)
-        for i, msg in enumerate(history_messages):
-          # Skip the last message as we'll add it separately with the current content
-          if i == len(history_messages) - 1 and msg.get("role") == "user":
-            continue
-          
-          # Ensure content is in the right format
-          msg_content = msg.get("content", [])
-          msg_role = msg.get("role", "user")
-          
-          if isinstance(msg_content, str):
-            # Convert string to list format
-            # Use "output_text" for assistant messages, "input_text" for user messages
-            content_type = "output_text" if msg_role == "assistant" else "input_text"
-            msg_content = [{"type": content_type, "text": msg_content}]
-          elif not isinstance(msg_content, list):
-            # Skip if content is not in expected format
-            continue
-          else:
-            # Convert content items to correct format based on role
-            valid_content = []
-            for c in msg_content:
-              if isinstance(c, dict):
-                # If it's already in the right format, check the type
-                if c.get("type") == "input_text" and msg_role == "assistant":
-                  # Convert assistant messages from input_text to output_text
-                  valid_content.append({"type": "output_text", "text": c.get("text", "")})
-                elif c.get("type") == "input_text" and msg_role == "user":
-                  # Keep input_text for user messages
-                  valid_content.append(c)
-                elif c.get("type") == "output_text":
-                  # Already correct
-                  valid_content.append(c)
-                elif c.get("type") == "input_image":
-                  # Keep images as-is
-                  valid_content.append(c)
-                elif c.get("text"):
-                  # Convert to correct type based on role
-                  content_type = "output_text" if msg_role == "assistant" else "input_text"
-                  valid_content.append({"type": content_type, "text": c.get("text", "")})
-            msg_content = valid_content
-          
-          # Only add if content is not empty
-          if msg_content and len(msg_content) > 0:
-            # Validate that content items have text or are images
-            valid_content = [c for c in msg_content if (c.get("text") or c.get("type") == "input_image")]
-            if valid_content:
-              conversation_history.append({
-                "role": msg_role,
-                "content": valid_content
-              })
-        
-        # Add current message with proper content format
-        conversation_history.append({
-          "role": "user",
-          "content": conversation_content
-        })
+      if isinstance(msg_content, str):
+        # Convert string to list format
+        # Use "output_text" for assistant messages, "input_text" for user messages
+        content_type = "output_text" if msg_role == "assistant" else "input_text"
+        msg_content = [{"type": content_type, "text": msg_content}]
+      elif not isinstance(msg_content, list):
+        # Skip if content is not in expected format
+        continue
       else:
-        # No history provided, create new conversation
-        conversation_history: list[TResponseInputItem] = [
-          {
-            "role": "user",
-            "content": conversation_content
-          }
-        ]
-      classify_input = workflow["input_as_text"]
-      classify_result_temp = await Runner.run(
-        classify,
-        input=[
-          {
-            "role": "user",
-            "content": classify_content
-          }
-        ],
-        run_config=RunConfig(trace_metadata={
-          "__trace_source__": "agent-builder",
-          "workflow_id": "wf_693ea7d0d2ec8190abef29c7b23c575a0927a02c5db24fdb"
-        })
-      )
-      classify_result = {
-        "output_text": classify_result_temp.final_output.json(),
-        "output_parsed": classify_result_temp.final_output.model_dump()
-      }
-      classify_category = classify_result["output_parsed"]["category"]
-      classify_output = {"category": classify_category}
-      
-      # Route to SEO agent if category is seo_question
-      if classify_category == "seo_question":
-        seo_review_result_temp = await Runner.run(
-          seo_reviewer,
-          input=conversation_history,
-          run_config=RunConfig(trace_metadata={
-            "__trace_source__": "agent-builder",
-            "workflow_id": "wf_693ea7d0d2ec8190abef29c7b23c575a0927a02c5db24fdb"
-          })
-        )
-        
-        conversation_history.extend([item.to_input_item() for item in seo_review_result_temp.new_items])
-        
-        seo_review_result = {
-          "output_text": seo_review_result_temp.final_output_as(str)
-        }
-        return seo_review_result
+        # Convert content items to correct format based on role
+        valid_content = []
+        for c in msg_content:
+          if isinstance(c, dict):
+            # If it's already in the right format, check the type
+            if c.get("type") == "input_text" and msg_role == "assistant":
+              # Convert assistant messages from input_text to output_text
+              valid_content.append({"type": "output_text", "text": c.get("text", "")})
+            elif c.get("type") == "input_text" and msg_role == "user":
+              # Keep input_text for user messages
+              valid_content.append(c)
+            elif c.get("type") == "output_text":
+              # Already correct
+              valid_content.append(c)
+            elif c.get("type") == "input_image":
+              # Keep images as-is
+              valid_content.append(c)
+            elif c.get("text"):
+              # Convert to correct type based on role
+              content_type = "output_text" if msg_role == "assistant" else "input_text"
+              valid_content.append({"type": content_type, "text": c.get("text", "")})
+        msg_content = valid_content
       
-      # Route to Translator agent if category is translation_request
-      if classify_category == "translation_request":
-        # Translator needs the previous critique from conversation history
-        # The conversation_history should contain the previous critique as assistant messages
-        translation_result_temp = await Runner.run(
-          translator,
-          input=conversation_history,
-          run_config=RunConfig(trace_metadata={
-            "__trace_source__": "agent-builder",
-            "workflow_id": "wf_693ea7d0d2ec8190abef29c7b23c575a0927a02c5db24fdb"
+      # Only add if content is not empty
+      if msg_content and len(msg_content) > 0:
+        # Validate that content items have text or are images
+        valid_content = [c for c in msg_content if (c.get("text") or c.get("type") == "input_image")]
+        if valid_content:
+          conversation_history.append({
+            "role": msg_role,
+            "content": valid_content
           })
-        )
-        
-        conversation_history.extend([item.to_input_item() for item in translation_result_temp.new_items])
-        
-        translation_result = {
-          "output_text": translation_result_temp.final_output_as(str)
-        }
-        return translation_result
-      
-      # Route to AI Readiness agent if category is ai_readiness
-      if classify_category == "ai_readiness":
-        ai_readiness_result_temp = await Runner.run(
-          ai_readiness_agent,
-          input=conversation_history,
-          run_config=RunConfig(trace_metadata={
-            "__trace_source__": "agent-builder",
-            "workflow_id": "wf_693ea7d0d2ec8190abef29c7b23c575a0927a02c5db24fdb"
-          })
-        )
-        
-        conversation_history.extend([item.to_input_item() for item in ai_readiness_result_temp.new_items])
-        
-        ai_readiness_result = {
-          "output_text": ai_readiness_result_temp.final_output_as(str)
-        }
-        return ai_readiness_result
+    
+    # Add current message with proper content format
+    conversation_history.append({
+      "role": "user",
+      "content": conversation_content
+    })
+  else:
+    # No history provided, create new conversation
+    conversation_history: list[TResponseInputItem] = [
+      {
+        "role": "user",
+        "content": conversation_content
+      }
+    ]
+  return classify_content, conversation_history
+
+
+def _run_config() -> RunConfig:
+  return RunConfig(trace_metadata={
+    "__trace_source__": "agent-builder",
+    "workflow_id": "wf_693ea7d0d2ec8190abef29c7b23c575a0927a02c5db24fdb"
+  })
+
+
+async def _classify(classify_content: list[dict], ruled_category: str | None) -> str:
+  # Bare URLs, code, lone screenshots and explicit requests skip the model round trip;
+  # callers run preclassify() once and pass its answer in
+  if ruled_category is not None:
+    _classify_stats["rules"] += 1
+    return ruled_category
+  _classify_stats["agent"] += 1
+  classify_result_temp = await Runner.run(
+    classify,
+    input=[
+      {
+        "role": "user",
+        "content": classify_content
+      }
+    ],
+    run_config=_run_config()
+  )
+  return classify_result_temp.final_output.model_dump()["category"]
+
+
+# Categories with a dedicated agent; all others get the Proofit evaluation.
+# The translator relies on the previous critique being in the conversation history.
+_ROUTES = {
+  "seo_question": seo_reviewer,
+  "translation_request": translator,
+  "ai_readiness": ai_readiness_agent,
+}
+_DEFAULT_AGENT = proofit_design_evaluation
+# Every agent whose instructions or model shape an answer (see workflow_cache)
+WORKFLOW_AGENTS = (classify, _DEFAULT_AGENT, *_ROUTES.values())
+
+# Start the default agent alongside the Classify agent, since most messages end up there,
+# and cancel it if the category routes elsewhere. Opt-in: a miss costs the prompt tokens already sent.
+SPECULATIVE_ROUTING = os.getenv("PROOFIT_SPECULATIVE_ROUTING", "0") not in ("0", "false", "no")
+
+_classify_stats = {"rules": 0, "agent": 0}
+# Per category: runs where the default agent was started speculatively, how many used it,
+# the latency that saved and the time cancelled runs had spent. Hits whose run was then
+# abandoned (client gone) or failed are only counted as aborted, so they skew neither the
+# hit rate nor the latency saved
+_speculation_stats: dict[str, dict] = {}
+
+
+def _route(classify_category: str) -> Agent:
+  return _ROUTES.get(classify_category, _DEFAULT_AGENT)
+
+
+def _speculation_category(category: str) -> dict:
+  return _speculation_stats.setdefault(category, {"runs": 0, "hits": 0, "aborted": 0, "saved_s": 0.0, "wasted_s": 0.0})
+
+
+def _record_speculation(category: str, hit: bool, saved_s: float = 0.0, wasted_s: float = 0.0) -> None:
+  stats = _speculation_category(category)
+  stats["runs"] += 1
+  stats["hits"] += hit
+  stats["saved_s"] += saved_s
+  stats["wasted_s"] += wasted_s
+
+
+def _record_aborted_speculation(category: str) -> None:
+  _speculation_category(category)["aborted"] += 1
+
+
+def workflow_stats() -> dict:
+  """Classification fast-path and speculative routing counters"""
+  routes = {}
+  for category, stats in sorted(_speculation_stats.items()):
+    routes[category] = {
+      "agent": _route(category).name,
+      "runs": stats["runs"],
+      "hits": stats["hits"],
+      "aborted": stats["aborted"],
+      "hit_rate": round(stats["hits"] / stats["runs"], 3) if stats["runs"] else None,
+      "latency_saved_ms": round(stats["saved_s"] * 1000),
+      "avg_latency_saved_ms": round(stats["saved_s"] * 1000 / stats["hits"]) if stats["hits"] else 0,
+      "cancelled_run_ms": round(stats["wasted_s"] * 1000),
+    }
+  runs = sum(stats["runs"] for stats in _speculation_stats.values())
+  hits = sum(stats["hits"] for stats in _speculation_stats.values())
+  return {
+    "classify": dict(_classify_stats),
+    "speculation": {
+      "enabled": SPECULATIVE_ROUTING,
+      "agent": _DEFAULT_AGENT.name,
+      "runs": runs,
+      "hits": hits,
+      "aborted": sum(stats["aborted"] for stats in _speculation_stats.values()),
+      "hit_rate": round(hits / runs, 3) if runs else None,
+      "latency_saved_ms": round(sum(stats["saved_s"] for stats in _speculation_stats.values()) * 1000),
+      "routes": routes,
+    },
+  }
+
+
+def _discard_result(task: asyncio.Task) -> None:
+  # A cancelled speculative run may already have failed; nobody is waiting for its error
+  if not task.cancelled():
+    task.exception()
+
+
+async def _run_speculative(classify_content: list[dict], conversation_history: list[TResponseInputItem]) -> dict:
+  """Classify while the default agent already runs, keeping its answer when the category routes to it"""
+  started = time.perf_counter()
+  speculative = asyncio.create_task(Runner.run(_DEFAULT_AGENT, input=conversation_history, run_config=_run_config()))
+  speculative.add_done_callback(_discard_result)
+  try:
+    classify_category = await _classify(classify_content, None)
+  except BaseException:
+    speculative.cancel()
+    raise
+  classified_s = time.perf_counter() - started
+  
+  agent = _route(classify_category)
+  if agent is not _DEFAULT_AGENT:
+    speculative.cancel()
+    _record_speculation(classify_category, hit=False, wasted_s=classified_s)
+    result_temp = await Runner.run(agent, input=conversation_history, run_config=_run_config())
+    return {"output_text": result_temp.final_output_as(str), "category": classify_category}
+  
+  try:
+    result_temp = await speculative
+  except BaseException:
+    _record_aborted_speculation(classify_category)
+    raise
+  # Run sequentially this would have taken classify + run; concurrently it takes the longer of the two
+  _record_speculation(classify_category, hit=True, saved_s=min(classified_s, time.perf_counter() - started))
+  return {"output_text": result_temp.final_output_as(str), "category": classify_category}
+
+
+async def run_workflow(workflow_input: WorkflowInput):
+  try:
+    with trace("Proofit"):
+      classify_content, conversation_history = _build_inputs(workflow_input)
+      ruled_category = preclassify(classify_content)
+      if SPECULATIVE_ROUTING and ruled_category is None:
+        return await _run_speculative(classify_content, conversation_history)
+      classify_category = await _classify(classify_content, ruled_category)
       
-      # All other categories get Proofit evaluation
       # Use conversation_history which includes the image if provided
-      proofit_design_evaluation_result_temp = await Runner.run(
-        proofit_design_evaluation,
+      result_temp = await Runner.run(
+        _route(classify_category),
         input=conversation_history,
-        run_config=RunConfig(trace_metadata={
-          "__trace_source__": "agent-builder",
-          "workflow_id": "wf_693ea7d0d2ec8190abef29c7b23c575a0927a02c5db24fdb"
-        })
+        run_config=_run_config()
       )
-
-      conversation_history.extend([item.to_input_item() for item in proofit_design_evaluation_result_temp.new_items])
-
-      proofit_design_evaluation_result = {
-        "output_text": proofit_design_evaluation_result_temp.final_output_as(str)
+      return {
+        "output_text": result_temp.final_output_as(str),
+        "category": classify_category
       }
-      return proofit_design_evaluation_result
   except Exception as e:
     # Log error and re-raise to let the caller handle it
     import traceback
@@ -1929,3 +1996,62 @@ async def run_workflow(workflow_input: WorkflowInput):
     print(f"Traceback: {error_trace}")
     raise  # Re-raise to let the caller handle it
 
+
+async def run_workflow_streamed(workflow_input: WorkflowInput) -> AsyncIterator[dict]:
+  """
+  Run the workflow, yielding the answer as it is generated.
+  
+  Yields {"type": "classified", "category"} once routing is decided, then
+  {"type": "delta", "delta"} for each chunk of answer text, and finally
+  {"type": "done", "output_text"} with the complete answer (the same text
+  run_workflow returns). Closing the generator early cancels the model run.
+  """
+  try:
+    with trace("Proofit"):
+      classify_content, conversation_history = _build_inputs(workflow_input)
+      started = time.perf_counter()
+      speculative = None
+      ruled_category = preclassify(classify_content)
+      if SPECULATIVE_ROUTING and ruled_category is None:
+        # The streamed run starts in the background; its events queue up until read
+        speculative = Runner.run_streamed(_DEFAULT_AGENT, input=conversation_history, run_config=_run_config())
+      try:
+        classify_category = await _classify(classify_content, ruled_category)
+      except BaseException:
+        if speculative is not None:
+          speculative.cancel()
+        raise
+      classified_s = time.perf_counter() - started
+      
+      agent = _route(classify_category)
+      if speculative is not None and agent is _DEFAULT_AGENT:
+        result_temp = speculative
+      else:
+        if speculative is not None:
+          speculative.cancel()
+          _record_speculation(classify_category, hit=False, wasted_s=classified_s)
+          speculative = None
+        result_temp = Runner.run_streamed(agent, input=conversation_history, run_config=_run_config())
+      completed = False
+      try:
+        yield {"type": "classified", "category": classify_category}
+        async for event in result_temp.stream_events():
+          if event.type == "raw_response_event" and event.data.type == "response.output_text.delta":
+            yield {"type": "delta", "delta": event.data.delta}
+        completed = True
+      finally:
+        if not result_temp.is_complete:
+          # The client went away: stop generating tokens nobody will read
+          result_temp.cancel()
+        if speculative is not None:
+          if completed:
+            _record_speculation(classify_category, hit=True, saved_s=min(classified_s, time.perf_counter() - started))
+          else:
+            _record_aborted_speculation(classify_category)
+      yield {"type": "done", "output_text": result_temp.final_output_as(str)}
+  except Exception as e:
+    import traceback
+    error_trace = traceback.format_exc()
+    print(f"Error in run_workflow_streamed: {e}")
+    print(f"Traceback: {error_trace}")
+    raise
@@ -0,0 +1,535 @@
+"""
+Exact-match cache of Proofit workflow answers
+
+A request is keyed on the user it is for, its normalized text, the SHA-256
+of each image's bytes, mode, audience, platform, the conversation history it
+continues, and a
+fingerprint of every agent's instructions, model and settings and of the
+classification rules, so editing a prompt or a rule or switching a model
+never serves an answer the new workflow would not give. Answers live in an
+in-memory LRU and in a SQLite file, each with its own TTL; a disk hit is
+promoted to memory. Identical requests that arrive while the first is still
+running (frontend retries), streamed or not, wait for its answer instead of
+starting another run.
+
+Re-uploads of a screenshot rarely have the same bytes, so with an image
+distance set, answers for requests with images are also indexed by the
+images' perceptual hashes under their intent (the user and the request's
+words, without the image bytes). A request whose images all land within a
+small Hamming distance of a cached answer's, with colours that match too, is
+served that answer. Answers are never shared between users.
+"""
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+import numpy as np
+
+import classify_rules
+from chatkit_store import SQLiteConnectionManager
+from image_hash import hamming_distances, image_signatures, tile_differences
+
+
+# Bump when the way answers are produced changes outside the agents (routing, input building)
+CACHE_VERSION = 1
+# Look-alike image thresholds. Re-encodes, 1-2px crops and a cursor on 1440x900
+# screenshots measure up to 8 bits and 9 tile levels (tests/test_image_hash.py);
+# a 20px layout shift is 22 bits or more away, a recoloured button 150+ levels
+RECOMMENDED_IMAGE_DISTANCE = 12
+TILE_DIFFERENCE = 12
+
+
+def normalize_text(text: str) -> str:
+    """Unicode-normalized text with runs of whitespace collapsed, so re-sent prompts match"""
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
+
+def workflow_images(workflow_input: Any) -> list[str]:
+    """The image data URLs run_workflow sends to the agents (at most 3)"""
+    image_data_urls = workflow_input.image_data_urls or []
+    if workflow_input.image_data_url and not image_data_urls:
+        image_data_urls = [workflow_input.image_data_url]
+    return image_data_urls[:3]
+
+
+def decode_data_url(data_url: str) -> bytes | None:
+    """The bytes of a base64 data URL, or None for anything else"""
+    header, _, payload = data_url.partition(",")
+    if not header.startswith("data:") or not header.endswith(";base64"):
+        return None
+    try:
+        return base64.b64decode(payload)
+    except (binascii.Error, ValueError):
+        return None
+
+
+def image_digest(data_url: str) -> str:
+    """SHA-256 of an image's bytes; the same picture sent with another media type or line wrapping matches"""
+    data = decode_data_url(data_url)
+    return hashlib.sha256(data if data is not None else data_url.encode("utf-8")).hexdigest()
+
+
+def agents_fingerprint(agents: tuple[Any, ...]) -> str:
+    """Hash of what shapes each agent's answers: instructions, model, settings, output type and tools"""
+    digest = hashlib.sha256()
+    for agent in agents:
+        digest.update(json.dumps({
+            "name": agent.name,
+            "instructions": agent.instructions if isinstance(agent.instructions, str) else repr(agent.instructions),
+            "model": str(agent.model),
+            "model_settings": agent.model_settings.to_json_dict(),
+            "output_type": getattr(agent.output_type, "__name__", repr(agent.output_type)),
+            "tools": sorted(tool.name for tool in agent.tools),
+        }, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def rules_fingerprint() -> str:
+    """Hash of the classification rules and their threshold, which pick the agent for many messages without a model"""
+    with open(classify_rules.__file__, "rb") as f:
+        source = f.read()
+    return hashlib.sha256(json.dumps({
+        "source": hashlib.sha256(source).hexdigest(),
+        "min_confidence": classify_rules.MIN_CONFIDENCE,
+    }, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def cache_key(workflow_input: Any, fingerprint: str, scope: str | None = None) -> str:
+    """
+    Key of a request's answer. scope is the user (or tenant) the answer is for:
+    an answer critiques that user's screenshots and may quote them, so it is
+    never served to anyone else.
+    """
+    history = json.dumps(workflow_input.conversation_history or [], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(json.dumps({
+        "version": CACHE_VERSION,
+        "agents": fingerprint,
+        "scope": scope,
+        "text": normalize_text(workflow_input.input_as_text),
+        "images": [image_digest(url) for url in workflow_images(workflow_input)],
+        "mode": workflow_input.mode,
+        "audience": workflow_input.audience,
+        "platform": workflow_input.platform,
+        # A follow-up ("make this engineer-ready") means something else in another conversation
+        "history": hashlib.sha256(history.encode("utf-8")).hexdigest(),
+    }, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def intent_key(workflow_input: Any, fingerprint: str, scope: str | None = None) -> str:
+    """
+    Everything in cache_key except the image bytes, with the text reduced to its
+    words: requests with the same intent and look-alike images share an answer.
+    """
+    history = json.dumps(workflow_input.conversation_history or [], sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(json.dumps({
+        "version": CACHE_VERSION,
+        "agents": fingerprint,
+        "scope": scope,
+        "text": " ".join(re.sub(r"[^\w\s]", " ", normalize_text(workflow_input.input_as_text).lower()).split()),
+        "image_count": len(workflow_images(workflow_input)),
+        "mode": workflow_input.mode,
+        "audience": workflow_input.audience,
+        "platform": workflow_input.platform,
+        "history": hashlib.sha256(history.encode("utf-8")).hexdigest(),
+    }, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def _discard_result(future: asyncio.Future) -> None:
+    # Nobody may be waiting on a failed run; read its error so asyncio does not log it
+    if not future.cancelled():
+        future.exception()
+
+
+class WorkflowCache:
+    """
+    Two-tier exact-match cache of run_workflow results.
+    
+    memory_ttl_s and disk_ttl_s bound how old a cached answer may be in each
+    tier; max_entries=0 turns the memory tier off and db_path=None the disk tier.
+    
+    With image_distance set, requests with images also match cached answers for
+    look-alike images (see image_hash): same intent, every image within
+    image_distance bits of the cached one's perceptual hash and no colour tile
+    more than tile_difference (0-255) apart. Re-encodes, crops and cursors
+    reach 8 bits and 9 tile levels, so RECOMMENDED_IMAGE_DISTANCE (12) and
+    TILE_DIFFERENCE (12) leave a few bits and levels of margin; small edits
+    such as a shortened label can still land within both.
+    
+    key(), run() and run_streamed() take the scope (user or tenant) a request
+    belongs to, and only answers cached under the same scope are served.
+    """
+    
+    def __init__(
+        self,
+        agents: tuple[Any, ...],
+        db_path: str | None = "./chatkit_data/workflow_cache.db",
+        max_entries: int = 256,
+        memory_ttl_s: float = 3600,
+        disk_ttl_s: float = 86400,
+        image_distance: int | None = None,
+        tile_difference: int = TILE_DIFFERENCE,
+    ):
+        self.rules_fingerprint = rules_fingerprint()
+        self.fingerprint = hashlib.sha256((agents_fingerprint(agents) + self.rules_fingerprint).encode("utf-8")).hexdigest()
+        self.max_entries = max_entries
+        self.memory_ttl_s = memory_ttl_s
+        self.disk_ttl_s = disk_ttl_s
+        self.image_distance = image_distance
+        self.tile_difference = tile_difference
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+        # Image signatures of answers in the memory tier when there is no disk tier: intent -> key -> (hashes, tiles)
+        self._signatures: dict[str, dict[str, tuple[bytes, bytes]]] = {}
+        self._signature_intents: dict[str, str] = {}
+        self.connections = SQLiteConnectionManager(db_path) if db_path and disk_ttl_s > 0 else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.similar_hits = 0
+        self.joined = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.undecodable_images = 0
+        self._puts = 0
+        if self.connections is not None:
+            with self.connections.write() as conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS workflow_cache (
+                        key TEXT PRIMARY KEY,
+                        output_text TEXT NOT NULL,
+                        category TEXT,
+                        created_at REAL NOT NULL,
+                        expires_at REAL NOT NULL
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_workflow_cache_expires ON workflow_cache(expires_at)")
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS workflow_cache_images (
+                        key TEXT PRIMARY KEY,
+                        intent TEXT NOT NULL,
+                        hashes BLOB NOT NULL,
+                        tiles BLOB NOT NULL
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_workflow_cache_images_intent ON workflow_cache_images(intent)")
+                # Entries left over from earlier runs that have expired since
+                self._purge(conn, time.time())
+    
+    @staticmethod
+    def _purge(conn, now: float) -> None:
+        conn.execute("DELETE FROM workflow_cache WHERE expires_at < ?", (now,))
+        conn.execute("DELETE FROM workflow_cache_images WHERE key NOT IN (SELECT key FROM workflow_cache)")
+    
+    def key(self, workflow_input: Any, scope: str | None = None) -> str:
+        return cache_key(workflow_input, self.fingerprint, scope)
+    
+    def _remember(self, key: str, result: dict, expires_at: float) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (expires_at, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            old_key, _ = self._entries.popitem(last=False)
+            self._forget_signature(old_key)
+            self.evictions += 1
+    
+    def _forget_signature(self, key: str) -> None:
+        intent = self._signature_intents.pop(key, None)
+        if intent is not None:
+            signatures = self._signatures[intent]
+            del signatures[key]
+            if not signatures:
+                del self._signatures[intent]
+    
+    async def _lookup(self, key: str) -> tuple[dict | None, str | None]:
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                return entry[1], "memory"
+            del self._entries[key]
+            self._forget_signature(key)
+        if self.connections is not None:
+            row = await self.connections.run_read(lambda conn: conn.execute(
+                "SELECT output_text, category, expires_at FROM workflow_cache WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone())
+            if row is not None:
+                result = {"output_text": row[0], "category": row[1]}
+                self._remember(key, result, min(row[2], now + self.memory_ttl_s))
+                return result, "disk"
+        return None, None
+    
+    async def get(self, key: str) -> tuple[dict | None, str | None]:
+        """The cached result for a key and the tier it came from ("memory" or "disk")"""
+        result, source = await self._lookup(key)
+        if source == "memory":
+            self.memory_hits += 1
+        elif source == "disk":
+            self.disk_hits += 1
+        return result, source
+    
+    async def _image_signature(self, workflow_input: Any, scope: str | None) -> tuple[str, Any, Any] | None:
+        """The intent key, perceptual hashes and colour tiles of a request's images, if it has any"""
+        if self.image_distance is None:
+            return None
+        images = [decode_data_url(url) for url in workflow_images(workflow_input)]
+        if not images:
+            return None
+        if any(data is None for data in images):
+            self.undecodable_images += 1
+            return None
+        signatures = await asyncio.to_thread(image_signatures, images)
+        if signatures is None:
+            self.undecodable_images += 1
+            return None
+        return intent_key(workflow_input, self.fingerprint, scope), signatures[0], signatures[1]
+    
+    async def _find_similar(self, signature: tuple[str, Any, Any]) -> dict | None:
+        """A cached answer for the same intent whose images all look like the request's"""
+        intent, hashes, tiles = signature
+        if self.connections is not None:
+            now = time.time()
+            rows = await self.connections.run_read(lambda conn: conn.execute("""
+                SELECT i.key, i.hashes, i.tiles FROM workflow_cache_images i
+                JOIN workflow_cache c ON c.key = i.key
+                WHERE i.intent = ? AND c.expires_at > ?
+            """, (intent, now)).fetchall())
+        else:
+            rows = [(key, *signature_bytes) for key, signature_bytes in self._signatures.get(intent, {}).items()]
+        if not rows:
+            return None
+        # Every candidate compared at once: (candidates, images) distances
+        candidate_hashes = np.frombuffer(b"".join(row[1] for row in rows), dtype=np.uint8).reshape(len(rows), *hashes.shape)
+        candidate_tiles = np.frombuffer(b"".join(row[2] for row in rows), dtype=np.uint8).reshape(len(rows), *tiles.shape)
+        distances = hamming_distances(candidate_hashes, hashes)
+        close = (distances <= self.image_distance).all(axis=1) & (tile_differences(candidate_tiles, tiles) <= self.tile_difference).all(axis=1)
+        for index in np.argsort(np.where(close, distances.max(axis=1), np.iinfo(np.int64).max))[:close.sum()]:
+            result, _ = await self._lookup(rows[index][0])
+            if result is not None:
+                return result
+        return None
+    
+    async def put(self, key: str, result: dict, signature: tuple[str, Any, Any] | None = None) -> None:
+        if not result.get("output_text"):
+            return
+        now = time.time()
+        result = {"output_text": result["output_text"], "category": result.get("category")}
+        self._remember(key, result, now + self.memory_ttl_s)
+        if signature is not None:
+            intent, hashes, tiles = signature
+            signature_bytes = (hashes.tobytes(), tiles.tobytes())
+            if self.connections is None and key in self._entries:
+                self._forget_signature(key)
+                self._signatures.setdefault(intent, {})[key] = signature_bytes
+                self._signature_intents[key] = intent
+        if self.connections is None:
+            return
+        self._puts += 1
+        purge = self._puts % 100 == 0
+        
+        def _write(conn) -> None:
+            conn.execute(
+                "INSERT OR REPLACE INTO workflow_cache (key, output_text, category, created_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (key, result["output_text"], result["category"], now, now + self.disk_ttl_s),
+            )
+            if signature is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO workflow_cache_images (key, intent, hashes, tiles) VALUES (?, ?, ?, ?)",
+                    (key, signature[0], *signature_bytes),
+                )
+            if purge:
+                self._purge(conn, now)
+        await self.connections.run_write(_write)
+    
+    async def _cached(
+        self, key: str, workflow_input: Any, scope: str | None
+    ) -> tuple[dict | None, str | None, tuple[str, Any, Any] | None]:
+        """A cached answer for the key or for look-alike images, its tier, and the request's image signature"""
+        result, source = await self.get(key)
+        if result is not None:
+            return result, source, None
+        signature = await self._image_signature(workflow_input, scope)
+        if signature is not None:
+            result = await self._find_similar(signature)
+            if result is not None:
+                self.similar_hits += 1
+                return result, "similar", signature
+        return None, None, signature
+    
+    async def _join(self, inflight: asyncio.Future) -> dict | None:
+        """The answer of a run already in flight, or None if that run was cancelled (its client went away)"""
+        try:
+            result = await asyncio.shield(inflight)
+        except asyncio.CancelledError:
+            if not inflight.cancelled():
+                raise
+            return None
+        self.joined += 1
+        return result
+    
+    async def run(
+        self,
+        workflow_input: Any,
+        run_workflow: Callable[[Any], Awaitable[dict]],
+        key: str | None = None,
+        scope: str | None = None,
+    ) -> tuple[dict, str | None]:
+        """run_workflow's result for an input, from the cache when possible, with the tier it came from"""
+        key = key or self.key(workflow_input, scope)
+        signature = None
+        looked_up = False
+        while True:
+            inflight = self._inflight.get(key)
+            if inflight is None and not looked_up:
+                looked_up = True
+                result, source, signature = await self._cached(key, workflow_input, scope)
+                if result is not None:
+                    return result, source
+                # The lookups yielded to the loop, so the same request may have started meanwhile
+                inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+            result = await self._join(inflight)
+            if result is not None:
+                return result, "inflight"
+        
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_discard_result)
+        self._inflight[key] = future
+        try:
+            result = await run_workflow(workflow_input)
+            await self.put(key, result, signature)
+            future.set_result(result)
+            return result, None
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._inflight[key]
+    
+    async def run_streamed(
+        self, workflow_input: Any, run_workflow_streamed: Callable[[Any], AsyncIterator[dict]], scope: str | None = None
+    ) -> AsyncIterator[dict]:
+        """
+        run_workflow_streamed's events, replayed as one delta from the cache on a hit.
+        
+        A request identical to one still streaming waits for that run's answer
+        and replays it, rather than starting a second run; if the first client
+        goes away before the answer is done, a waiting request runs it itself.
+        """
+        key = self.key(workflow_input, scope)
+        result = signature = None
+        looked_up = False
+        while True:
+            inflight = self._inflight.get(key)
+            if inflight is None and not looked_up:
+                looked_up = True
+                result, _, signature = await self._cached(key, workflow_input, scope)
+                if result is not None:
+                    break
+                inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+            result = await self._join(inflight)
+            if result is not None:
+                break
+        if result is not None:
+            if result["category"]:
+                yield {"type": "classified", "category": result["category"]}
+            yield {"type": "delta", "delta": result["output_text"]}
+            yield {"type": "done", "output_text": result["output_text"]}
+            return
+        
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_discard_result)
+        self._inflight[key] = future
+        category = None
+        events = run_workflow_streamed(workflow_input)
+        try:
+            async for event in events:
+                if event["type"] == "classified":
+                    category = event["category"]
+                elif event["type"] == "done":
+                    result = {"output_text": event["output_text"], "category": category}
+                    await self.put(key, result, signature)
+                    future.set_result(result)
+                yield event
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+            raise
+        finally:
+            # Closed early (the client went away) or cancelled: requests waiting on this run start their own
+            if not future.done():
+                future.cancel()
+            del self._inflight[key]
+            await events.aclose()
+    
+    async def invalidate(self, key: str | None = None) -> int:
+        """Drop one cached answer, or every one when key is None; returns how many were dropped"""
+        if key is None:
+            dropped = len(self._entries)
+            self._entries.clear()
+            self._signatures.clear()
+            self._signature_intents.clear()
+        else:
+            dropped = 1 if self._entries.pop(key, None) is not None else 0
+            self._forget_signature(key)
+        if self.connections is not None:
+            def _delete(conn) -> int:
+                if key is None:
+                    conn.execute("DELETE FROM workflow_cache_images")
+                    return conn.execute("DELETE FROM workflow_cache").rowcount
+                conn.execute("DELETE FROM workflow_cache_images WHERE key = ?", (key,))
+                return conn.execute("DELETE FROM workflow_cache WHERE key = ?", (key,)).rowcount
+            dropped = max(dropped, await self.connections.run_write(_delete))
+        self.invalidations += dropped
+        return dropped
+    
+    async def stats(self) -> dict:
+        """Hit/miss counters per tier for sizing the cache and its TTLs"""
+        disk_entries = None
+        if self.connections is not None:
+            now = time.time()
+            disk_entries = await self.connections.run_read(
+                lambda conn: conn.execute("SELECT COUNT(*) FROM workflow_cache WHERE expires_at > ?", (now,)).fetchone()[0]
+            )
+        hits = self.memory_hits + self.disk_hits + self.similar_hits + self.joined
+        lookups = hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "disk_entries": disk_entries,
+            "memory_ttl_s": self.memory_ttl_s,
+            "disk_ttl_s": self.disk_ttl_s if self.connections is not None else None,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "similar_image_hits": self.similar_hits,
+            "joined_inflight": self.joined,
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "image_distance": self.image_distance,
+            "tile_difference": self.tile_difference if self.image_distance is not None else None,
+            "undecodable_images": self.undecodable_images,
+            "agents_fingerprint": self.fingerprint[:16],
+            "rules_fingerprint": self.rules_fingerprint[:16],
+        }
+    
+    def close(self) -> None:
+        if self.connections is not None:
+            self.connections.close()